@@ -8,20 +8,32 @@ import os
 import random
 from PIL import Image
 from imgaug import augmenters as iaa
-from .processing.DeepFakeMask import dfl_full, facehull, components, extended, random_components
 import cv2
 import pickle
 import tqdm
 import torch
 from torch.utils import data
-from data.processing.blend_utils.faceBlending import Blender
+from data.processing.blend_utils.faceBlending import Blender, feather_blend
+from data.processing.blend_utils.masked_color_transfer import mean_shift_transfer
 from data.processing.aug_trans.aug_trans import Augmentator, data_transform
-from .dataset_util import is_image_file
-from data.processing.find_faces import find_face_landmark
+from .dataset_util import is_image_file, make_video_index, video_name
+from data.processing.landmark_index import LandmarkIndex, ann_options
+from data.processing.landmark_store import LandmarkStore
+from data.processing.mask_cache import MaskCache
+from data.processing.landmark_extraction import select_frames
+from data.processing import face_detection
+from data.processing.deform_bank import get_deform_bank, random_displacement, remap_mask
+from data.processing import mask_codec
+from .frame_cache import SharedFrameCache
 from . import transforms
 import elasticdeform
 
 
+def sample_seed(run_seed, pass_id, index):
+    """ seed of one sample, independent of worker and batch order """
+    return int(np.random.SeedSequence([run_seed, pass_id, index]).generate_state(1)[0])
+
+
 def drawLandmark(img, landmark):
     for (x, y) in landmark:
         cv2.circle(img, (int(x), int(y)), 1, (0, 0, 255), -1)
@@ -34,6 +46,12 @@ class I2GDataset(data.Dataset):
 
         self.landmarks_record = []
         self.data_list = []
+        self.landmark_index = None
+        landmark_cache = getattr(opt, 'landmark_cache', None)
+        if not landmark_cache:
+            landmark_cache = LandmarkStore.default_prefix(dir_real)
+        self.landmark_store = LandmarkStore(landmark_cache, dir_real)
+        self.mask_cache = MaskCache(MaskCache.default_path(landmark_cache))
 
         self.distortion = iaa.Sequential(
             [iaa.PiecewiseAffine(scale=(0.01, 0.05))])
@@ -46,118 +64,199 @@ class I2GDataset(data.Dataset):
             self.transform = transforms.get_transform(opt, for_val=is_val)
         self.mask_transform = transforms.get_mask_transform(
             opt, for_val=is_val)
+        self.deform_bank = get_deform_bank(opt)
+        self.frame_cache = None
         self.opt = opt
 
         self.last_type = 'fake'
+        self.seed = None
+        self.pass_id = 0
+        # alternate: each worker alternates real and fake samples
+        # balanced: index 2k is frame k real, 2k+1 frame k fake, see BalancedBatchSampler
+        # pair: one item is the real face and its fake from a single decode
+        self.sampling = getattr(opt, 'sampling', 'alternate')
+        if self.sampling not in ('alternate', 'balanced', 'pair'):
+            raise ValueError('unknown sampling %s' % self.sampling)
+        if self.sampling == 'pair' and getattr(opt, 'batched_blend', False):
+            raise ValueError('sampling pair does not support batched_blend')
 
     def __len__(self):
+        if self.sampling == 'balanced':
+            return 2 * len(self.data_list)
         return len(self.data_list)
 
-    def __getitem__(self, index):
-        face_img, mask, is_forgery = self.gen_datapoint_from(
-            self.data_list[index], self.opt.loadSize)
-        # face_img = (face_img.transpose(2, 0, 1) / 255.).astype(np.float32)
-        face_img = Image.fromarray(face_img)
-        mask = Image.fromarray(np.uint8(mask * 255), 'L')
+    def sample_frame(self, index):
+        """ background frame and 'real' / 'fake' of a dataset index """
+        if self.sampling == 'balanced':
+            return self.data_list[index // 2], 'real' if index % 2 == 0 else 'fake'
+        return self.data_list[index], self.next_type()
+
+    def set_seed(self, seed, pass_id=0):
+        """ make every sample a function of (seed, pass_id, index) """
+        self.seed = seed
+        self.pass_id = pass_id
+
+    def seed_sample(self, index):
+        seed = sample_seed(self.seed, self.pass_id, index)
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        # next_type() flips this: even indices are real, odd are fake,
+        # the same order the unseeded toggle gives a single worker
+        self.last_type = 'fake' if index % 2 == 0 else 'real'
+        return seed
 
-        face_img = self.transform(face_img)
-        mask = self.mask_transform(mask)
+    def __getitem__(self, index):
+        seed = self.seed_sample(index) if self.seed is not None else -1
+        if getattr(self.opt, 'batched_blend', False):
+            item = self.get_blend_item(index)
+            item['seed'] = seed
+            return item
+        if self.sampling == 'pair':
+            item = self.get_pair_item(index)
+            item['seed'] = seed
+            return item
+        path, data_type = self.sample_frame(index)
+        face_img, mask, is_forgery, partner, params = self.gen_datapoint_from(
+            path, self.opt.loadSize, data_type)
+        face_img, mask = self.to_tensors(face_img, mask)
         return_obj = {
             'img': face_img,
             'mask': mask,
-            'label': is_forgery
+            'label': is_forgery,
+            'path': path,
+            'partner': partner,
+            'seed': seed,
+            'mask_params': mask_codec.to_bytes(params)
         }
 
         return return_obj
 
-    def get32frames(self):
-        total_frames = os.listdir(self.dir_real)
-        orig_vid = set([x.split('_')[0] for x in total_frames])
-        new_data_list = []
-        landmark_list = {}
-        again = True
-        for i, vid_name in enumerate(orig_vid):
-            print("%d/%d: %s" % (i, len(orig_vid), vid_name))
-            vids = list(filter(lambda x: x.split('_')[
-                        0] == vid_name, total_frames))
-            for i in range(32):
-                while again:
-                    selected_frame = random.sample(vids, 1)[0]
-                    try:
-                        path = os.path.join(self.dir_real, selected_frame)
-                        img = Image.open(path).convert('RGB')
-                        face_hull = find_face_landmark(np.array(img))
-                        point_num = face_hull.shape[0]
-                        face_hull = np.reshape(face_hull, [point_num, 2])
-                        new_data_list.append(selected_frame)
-                        landmark_list[selected_frame] = face_hull
-                        again = False
-                    except:
-                        again = True
-                vids = [item for item in vids if item not in selected_frame]
-                again = True
+    def to_tensors(self, face_img, mask):
+        # face_img = (face_img.transpose(2, 0, 1) / 255.).astype(np.float32)
+        face_img = Image.fromarray(face_img)
+        mask = Image.fromarray(np.uint8(mask * 255), 'L')
+        return self.transform(face_img), self.mask_transform(mask)
+
+    def get_pair_item(self, index):
+        """ the real face and a fake on it, both from one decode of the frame """
+        path = self.data_list[index]
+        background_face = self.load_frame(path)
+        items = [self.gen_datapoint_from(path, self.opt.loadSize, data_type, background_face)
+                 for data_type in ('real', 'fake')]
+        tensors = [self.to_tensors(face_img, mask) for face_img, mask, _, _, _ in items]
+        return {
+            'img': torch.stack([face_img for face_img, _ in tensors]),
+            'mask': torch.stack([mask for _, mask in tensors]),
+            'label': torch.tensor([label for _, _, label, _, _ in items]),
+            'path': path,
+            'partner': items[1][3],
+            'mask_params': np.stack([mask_codec.to_bytes(params) for _, _, _, _, params in items])
+        }
+
+    def get_blend_item(self, index):
+        """ uncomposited inputs for BatchCompositor, blending runs per batch """
+        size = self.opt.loadSize
+        background_face_path, data_type = self.sample_frame(index)
+        if data_type == 'fake':
+            background_face, foreground_face, hull, deformed, partner, _ = \
+                self.get_blend_inputs(background_face_path)
+        else:
+            background_face = self.load_frame(background_face_path)
+            foreground_face = background_face
+            partner = ''
+            hull = np.zeros(background_face.shape[:2], dtype=np.uint8)
+            deformed = np.zeros(background_face.shape[:2], dtype=np.float32)
+
+        def resize(x):
+            return cv2.resize(x, (size, size), interpolation=cv2.INTER_LINEAR)
+
+        return {
+            'background': torch.from_numpy(resize(background_face)).permute(2, 0, 1).contiguous(),
+            'foreground': torch.from_numpy(resize(foreground_face)).permute(2, 0, 1).contiguous(),
+            'hull': torch.from_numpy(np.uint8(resize(hull) > 0))[None],
+            'deformed': torch.from_numpy(resize(deformed.astype(np.float32)))[None],
+            # the blur kernel is scaled by this, get_blended_face blurs at frame size
+            'scale': torch.tensor([size / background_face.shape[1], size / background_face.shape[0]]),
+            'label': int(data_type == 'real'),
+            'path': background_face_path,
+            'partner': partner
+        }
+
+    def get32frames(self, seed=None):
+        """ select 32 frames with a detectable face per video """
+        if seed is None:
+            seed = random.getrandbits(32)
+        videos = make_video_index(self.dir_real)
+        num_workers = getattr(self.opt, 'landmark_workers', 0)
+        face_detection.set_policy(getattr(self.opt, 'face_detect', 'full'))
+        new_data_list, landmark_list = select_frames(
+            videos, self.landmark_store, frames_per_video=32, seed=seed,
+            num_workers=num_workers)
         self.data_list = new_data_list
         self.landmarks_record = landmark_list
+        self.landmark_index = LandmarkIndex(self.data_list, self.landmarks_record,
+                                            ann=ann_options(self.opt))
+        # hull polygons are computed here once, the workers inherit them
+        self.mask_cache.prepare(self.landmarks_record)
+        self.mask_cache.save()
+
+        cache_mb = getattr(self.opt, 'frame_cache_mb', 0)
+        if cache_mb and self.frame_cache is None:
+            self.frame_cache = SharedFrameCache(
+                cache_mb * 2 ** 20, max_frames=sum(len(v) for v in videos.values()),
+                slot_bytes=self.frame_slot_bytes(),
+                size=getattr(self.opt, 'frame_cache_size', 0))
+        if self.frame_cache is not None:
+            self.frame_cache.set_frames(self.data_list)
+
+    def frame_slot_bytes(self, sample=64):
+        """ bytes of the largest RGB frame among the first sample selected ones """
+        sizes = [Image.open(os.path.join(self.dir_real, path)).size
+                 for path in self.data_list[:sample]]
+        return max((w * h * 3 for w, h in sizes), default=1)
+
+    def read_frame(self, path):
+        return io.imread(os.path.join(self.dir_real, path))
+
+    def load_frame(self, path):
+        """ decoded frame, resized to --frame_cache_size if the cache is on and has one """
+        if self.frame_cache is None:
+            return self.read_frame(path)
+        return self.frame_cache.get(path, self.read_frame)
+
+    def frame_scale(self, path):
+        """ (sx, sy) from landmark to load_frame(path) coordinates, None if equal """
+        if self.frame_cache is None:
+            return None
+        sx, sy = self.frame_cache.scale(path)
+        if sx == 1 and sy == 1:
+            return None
+        return (sx, sy)
 
     def total_euclidean_distance(self, a, b):
         assert len(a.shape) == 2
         return np.sum(np.linalg.norm(a-b, axis=1))
 
-    def random_get_hull(self, landmark, img1):
+    def random_get_hull(self, path, shape):
+        """ uint8 (H, W) blending region of a frame, 255 inside, mask type, parts """
         random_or_not = random.choice([0, 1])
         if random_or_not == 0:
             hull_type = random.choice([0, 1, 2, 3])
             hull_type = 3
-            
-            if hull_type == 0:
-                mask = dfl_full(landmarks=landmark.astype(
-                    'int32'), face=img1, channels=3).mask
-                return mask/255
-            elif hull_type == 1:
-                mask = extended(landmarks=landmark.astype(
-                    'int32'), face=img1, channels=3).mask
-                return mask/255
-            elif hull_type == 2:
-                mask = components(landmarks=landmark.astype(
-                    'int32'), face=img1, channels=3).mask
-                return mask/255
-            elif hull_type == 3:
-                mask = facehull(landmarks=landmark.astype(
-                    'int32'), face=img1, channels=3).mask
-                return mask/255
+            mask_type = ['dfl_full', 'extended', 'components', 'facehull'][hull_type]
+            parts = None
         else:
-            mask = random_components(landmarks=landmark.astype(
-                    'int32'), face=img1, channels=3).mask
-            return mask/255
+            # same draws as random_components over its 8 parts
+            mask_type = 'random_components'
+            parts = random.sample(range(8), random.randint(0, 8 - 1))
+        mask = self.mask_cache.mask(path, self.landmarks_record[path], shape,
+                                    mask_type, parts, self.frame_scale(path))
+        return mask, mask_type, parts
 
     def blendImages(self, src, dst, mask, featherAmount=0.2):
-
-        maskIndices = np.where(mask != 0)
-
-        src_mask = np.ones_like(mask)
-        dst_mask = np.zeros_like(mask)
-
-        maskPts = np.hstack(
-            (maskIndices[1][:, np.newaxis], maskIndices[0][:, np.newaxis]))
-        faceSize = np.max(maskPts, axis=0) - np.min(maskPts, axis=0)
-        featherAmount = featherAmount * np.max(faceSize)
-
-        hull = cv2.convexHull(maskPts)
-        dists = np.zeros(maskPts.shape[0])
-        for i in range(maskPts.shape[0]):
-            dists[i] = cv2.pointPolygonTest(
-                hull, (int(maskPts[i, 0]), int(maskPts[i, 1])), True)
-
-        weights = np.clip(dists / featherAmount, 0, 1)
-
-        composedImg = np.copy(dst)
-        composedImg[maskIndices[0], maskIndices[1]] = weights[:, np.newaxis] * src[maskIndices[0],
-                                                                                   maskIndices[1]] + (1 - weights[:, np.newaxis]) * dst[maskIndices[0], maskIndices[1]]
-        composedMask = np.copy(dst_mask)
-        composedMask[maskIndices[0], maskIndices[1]] = weights[:, np.newaxis] * src_mask[maskIndices[0], maskIndices[1]] + (
-            1 - weights[:, np.newaxis]) * dst_mask[maskIndices[0], maskIndices[1]]
-
-        return composedImg, composedMask
+        # composed mask is the feather weight inside the mask, 0 outside
+        return feather_blend(src, dst, mask, featherAmount)
 
     def composite(self, background, foreground, alphamask):
         "pastes the foreground image into the background image using the mask"
@@ -183,30 +282,22 @@ class I2GDataset(data.Dataset):
     # borrow from https://github.com/MarekKowalski/FaceSwap
 
     def colorTransfer(self, src, dst, mask):
-        transferredDst = np.copy(dst)
-
-        maskIndices = np.where(mask != 0)
-
-        maskedSrc = src[maskIndices[0], maskIndices[1]].astype(np.int32)
-        maskedDst = dst[maskIndices[0], maskIndices[1]].astype(np.int32)
+        return mean_shift_transfer(src, dst, mask)
 
-        meanSrc = np.mean(maskedSrc, axis=0)
-        meanDst = np.mean(maskedDst, axis=0)
-
-        maskedDst = maskedDst - meanDst
-        maskedDst = maskedDst + meanSrc
-        maskedDst = np.clip(maskedDst, 0, 255)
-
-        transferredDst[maskIndices[0], maskIndices[1]] = maskedDst
-
-        return transferredDst
-
-    def gen_datapoint_from(self, background_face_path, size):
-        # background_face_path = random.choice(self.data_list)
+    def next_type(self):
+        # alternate real and fake samples
         data_type = 'real' if self.last_type == 'fake' else 'fake'
         self.last_type = data_type
+        return data_type
+
+    def gen_datapoint_from(self, background_face_path, size, data_type=None,
+                           background_face=None):
+        # background_face_path = random.choice(self.data_list)
+        if data_type is None:
+            data_type = self.next_type()
         if data_type == 'fake':
-            face_img, mask = self.get_blended_face(background_face_path, size)
+            face_img, mask, partner, params = self.get_blended_face(
+                background_face_path, size, background_face)
             face_img = Image.fromarray(face_img)
             face_img = face_img.resize((size, size), Image.BILINEAR)
             face_img = np.array(face_img)
@@ -216,14 +307,17 @@ class I2GDataset(data.Dataset):
             mask = 1 - mask
             # mask = (1 - mask) * mask * 4
         else:
-            face_img = io.imread(os.path.join(
-                self.dir_real, background_face_path))
+            face_img = background_face
+            if face_img is None:
+                face_img = self.load_frame(background_face_path)
 
             face_img = Image.fromarray(face_img)
             face_img = face_img.resize((size, size), Image.BILINEAR)
             face_img = np.array(face_img)
 
             mask = np.ones((size, size))
+            partner = ''
+            params = mask_codec.make_params(1, size)
 
         # random jpeg compression after BI pipeline
         if random.randint(0, 1):
@@ -236,36 +330,60 @@ class I2GDataset(data.Dataset):
         if random.randint(0, 1):
             face_img = np.flip(face_img, 1).copy()
             mask = np.flip(mask, 1).copy()
+            params['flip'] = 1
 
-        return face_img, mask, int(data_type == 'real')
+        return face_img, mask, int(data_type == 'real'), partner, params
 
-    def get_blended_face(self, background_face_path, size):
-        background_face = io.imread(os.path.join(
-            self.dir_real, background_face_path))
+    def get_blend_inputs(self, background_face_path, background_face=None):
+        """ decode both faces and build the color transfer and blending masks """
+        if background_face is None:
+            background_face = self.load_frame(background_face_path)
         background_landmark = self.landmarks_record[background_face_path]
 
         foreground_face_path = self.search_similar_face(
             background_landmark, background_face_path)
-        foreground_face = io.imread(os.path.join(
-            self.dir_real, foreground_face_path))
+        foreground_face = self.load_frame(foreground_face_path)
+
+        # get random type of initial blending mask, uint8 single channel
+        mask_color, mask_type, parts = self.random_get_hull(
+            background_face_path, background_face.shape)
+        # everything the mask is built from, see mask_codec
+        params = dict(mask_type=mask_codec.MASK_TYPES.index(mask_type),
+                      parts=mask_codec.parts_to_bits(parts or []),
+                      height=mask_color.shape[0], width=mask_color.shape[1],
+                      scale=self.frame_scale(background_face_path) or (1, 1),
+                      landmarks=np.asarray(background_landmark, dtype=np.int32).reshape(-1, 2))
 
-        # get random type of initial blending mask
-        mask = self.random_get_hull(background_landmark, background_face)
         # # random deform mask
+        mask = mask_color.astype(np.float32) / 255
+        if self.deform_bank is not None:
+            index, maps = self.deform_bank.draw(mask.shape)
+            mask = remap_mask(mask, maps)
+            params.update(deform=mask_codec.DEFORM_BANK, deform_seed=self.deform_bank.seed,
+                          deform_index=index, sigma=self.deform_bank.sigma,
+                          points=self.deform_bank.points)
+        else:
+            # deform_random_grid(mask, sigma=4, points=6) with a recorded seed
+            deform_seed = np.random.randint(2 ** 31)
+            displacement = random_displacement(np.random.RandomState(deform_seed), 4, 6)
+            mask = elasticdeform.deform_grid(mask, displacement)
+            params.update(deform=mask_codec.DEFORM_GRID, deform_seed=deform_seed,
+                          sigma=4, points=6)
 
-        mask_color = mask
+        return background_face, foreground_face, mask_color, mask, foreground_face_path, params
 
-        mask = mask[:, :, 0:1]
+    def get_blended_face(self, background_face_path, size, background_face=None):
+        background_face, foreground_face, mask_color, mask, foreground_face_path, params = \
+            self.get_blend_inputs(background_face_path, background_face)
 
-        mask = elasticdeform.deform_random_grid(
-            mask[:, :, 0], sigma=4, points=6)
         mask = cv2.GaussianBlur(mask, (35, 35), 0)
+        params = mask_codec.make_params(0, size, blur=35, **params)
 
         mask = np.stack((mask,)*3, axis=-1)
 
         # apply color transfer
         foreground_face = self.colorTransfer(
-            background_face, foreground_face, mask_color * 255)
+            background_face, foreground_face, mask_color)
 
         # blend two face
         blended_face = self.composite(
@@ -274,30 +392,13 @@ class I2GDataset(data.Dataset):
 
         mask = mask[:, :, 0]
 
-        return blended_face, mask
+        return blended_face, mask, foreground_face_path, params
 
     def search_similar_face(self, this_landmark, background_face_path):
-        min_dist = 99999999
-
-        # random sample 5000 frame from all frams:
-        # sample_num = int(self.data_size * 0.2)
-        # sample_num = len(self.data_list)
-        # all_candidate_path = random.sample(self.data_list, k=sample_num)
-        all_candidate_path = self.data_list
-
-        # filter all frame that comes from the same video as background face
-        all_candidate_path = filter(lambda x: x.split(
-            '_')[0] != background_face_path.split('_')[0], all_candidate_path)
-        all_candidate_path = list(all_candidate_path)
-
-        # loop throungh all candidates frame to get best match
-        for candidate_path in all_candidate_path:
-            candidate_landmark = self.landmarks_record[candidate_path].astype(
-                np.float32)
-            candidate_distance = self.total_euclidean_distance(
-                candidate_landmark, this_landmark)
-            if candidate_distance < min_dist:
-                min_dist = candidate_distance
-                min_path = candidate_path
-
-        return min_path
+        # nearest frame from a different video than the background face,
+        # optionally a random pick among the top k nearest
+        topk = getattr(self.opt, 'donor_topk', 1)
+        return self.landmark_index.search(
+            this_landmark, video_name(background_face_path), topk=topk,
+            frame_name=background_face_path,
+            temperature=getattr(self.opt, 'donor_temperature', None))
@@ -21,6 +21,32 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
+def video_name(path):
+    """ .../000_003_012.png -> 000 """
+    return os.path.basename(path).split('_')[0]
+
+
+def make_video_index(dir):
+    """Group the images of a folder by video in a single directory scan.
+
+    Returns a dict video name -> sorted list of frame names.
+    """
+    index = {}
+    with os.scandir(dir) as it:
+        for entry in it:
+            if is_image_file(entry.name):
+                index.setdefault(video_name(entry.name), []).append(entry.name)
+    return {vid: sorted(index[vid]) for vid in sorted(index)}
+
+
+def group_by_video(paths):
+    """ video name -> list of positions in paths, in one pass """
+    groups = {}
+    for i, path in enumerate(paths):
+        groups.setdefault(video_name(path), []).append(i)
+    return groups
+
+
 def make_dataset(dir, max_dataset_size=float("inf")):
     cache = dir.rstrip('/') + '.txt'
     if os.path.isfile(cache):
@@ -0,0 +1,156 @@
+import multiprocessing as mp
+import numpy as np
+import cv2
+
+
+class SharedFrameCache(object):
+    """LRU cache of decoded frames shared by the DataLoader workers.
+
+    Frames are stored as uint8 in a shared RawArray with as many slots of
+    slot_bytes as fit in budget_bytes. By default a frame keeps its decoded
+    shape, so the blend sees the same pixels as without the cache, and
+    frames larger than a slot are decoded on every use. With size > 0
+    frames are resized to (size, size, 3) instead, which fits more of them
+    in the budget but changes the aspect ratio of non square frames; the
+    original shape of every decoded frame is then kept, so landmarks can
+    be mapped to the resized frame.
+    The cache is created in the main process before the workers start,
+    and the workers inherit it. Frames are addressed by their position in
+    the list given to set_frames().
+    """
+
+    def __init__(self, budget_bytes, max_frames, slot_bytes=None, size=0):
+        self.size = size
+        if size:
+            slot_bytes = size * size * 3
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = max(int(budget_bytes // self.slot_bytes), 1)
+        self.max_frames = max_frames
+        self.lock = mp.Lock()
+        self.data = mp.RawArray('B', self.num_slots * self.slot_bytes)
+        self.slot_frame = mp.RawArray('i', self.num_slots)
+        self.slot_shape = mp.RawArray('i', self.num_slots * 3)
+        self.ticks = mp.RawArray('q', self.num_slots)
+        self.frame_slot = mp.RawArray('i', max_frames)
+        self.frame_shape = mp.RawArray('i', max_frames * 2)
+        self.counters = mp.RawArray('q', 4)  # clock, hits, misses, uncached
+        self.names = []
+        self.index = {}
+        self.views()
+        self.slots_view[...] = -1
+        self.frame_slot_view[...] = -1
+
+    def views(self):
+        self.frames = np.frombuffer(self.data, dtype=np.uint8).reshape(
+            self.num_slots, self.slot_bytes)
+        self.slots_view = np.frombuffer(self.slot_frame, dtype=np.int32)
+        self.slot_shapes_view = np.frombuffer(self.slot_shape, dtype=np.int32).reshape(-1, 3)
+        self.ticks_view = np.frombuffer(self.ticks, dtype=np.int64)
+        self.frame_slot_view = np.frombuffer(self.frame_slot, dtype=np.int32)
+        self.shapes_view = np.frombuffer(self.frame_shape, dtype=np.int32).reshape(-1, 2)
+        self.counters_view = np.frombuffer(self.counters, dtype=np.int64)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['frames', 'slots_view', 'slot_shapes_view', 'ticks_view',
+                  'frame_slot_view', 'shapes_view', 'counters_view']:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.views()
+
+    def set_frames(self, names):
+        """Address frames by their position in names.
+
+        Call it from the main process while no worker is running; cached
+        frames that are still listed stay cached.
+        """
+        names = list(names)
+        if len(names) > self.max_frames:
+            raise ValueError('%d frames, the cache was sized for %d'
+                             % (len(names), self.max_frames))
+        index = {name: i for i, name in enumerate(names)}
+        shapes = np.zeros((len(names), 2), dtype=np.int32)
+        for slot in range(self.num_slots):
+            old = self.slots_view[slot]
+            if old < 0:
+                continue
+            new = index.get(self.names[old], -1)
+            if new >= 0:
+                shapes[new] = self.shapes_view[old]
+            else:
+                self.ticks_view[slot] = 0
+            self.slots_view[slot] = new
+        self.frame_slot_view[...] = -1
+        for slot in np.flatnonzero(self.slots_view >= 0):
+            self.frame_slot_view[self.slots_view[slot]] = slot
+        self.shapes_view[...] = 0
+        self.shapes_view[:len(names)] = shapes
+        self.names = names
+        self.index = index
+
+    def slot_frame_view(self, slot):
+        h, w, c = self.slot_shapes_view[slot]
+        shape = (h, w, c) if c else (h, w)
+        return self.frames[slot, :int(np.prod(shape))].reshape(shape)
+
+    def get(self, name, loader):
+        """ uint8 frame, decoded with loader(name) on a miss """
+        i = self.index[name]
+        with self.lock:
+            self.counters_view[0] += 1
+            slot = self.frame_slot_view[i]
+            if slot >= 0:
+                self.counters_view[1] += 1
+                self.ticks_view[slot] = self.counters_view[0]
+                return self.slot_frame_view(slot).copy()
+            self.counters_view[2] += 1
+        img = loader(name)
+        shape = img.shape[:2]
+        if self.size and shape != (self.size, self.size):
+            img = cv2.resize(img, (self.size, self.size),
+                             interpolation=cv2.INTER_AREA)
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        with self.lock:
+            self.shapes_view[i] = shape
+            if self.frame_slot_view[i] >= 0:
+                # another worker cached it meanwhile
+                return img
+            if img.nbytes > self.slot_bytes:
+                self.counters_view[3] += 1
+                return img
+            slot = int(np.argmin(self.ticks_view))
+            old = self.slots_view[slot]
+            if old >= 0:
+                self.frame_slot_view[old] = -1
+            self.frames[slot, :img.nbytes] = img.reshape(-1)
+            # 0 channels marks a 2d frame
+            self.slot_shapes_view[slot] = img.shape[:2] + (img.shape[2] if img.ndim == 3 else 0,)
+            self.slots_view[slot] = i
+            self.frame_slot_view[i] = slot
+            self.ticks_view[slot] = self.counters_view[0]
+        return img
+
+    def scale(self, name):
+        """ (sx, sy) from original frame coordinates to cached ones """
+        h, w = self.shapes_view[self.index[name]]
+        if h == 0 or not self.size:
+            return 1., 1.
+        return self.size / w, self.size / h
+
+    def stats(self):
+        _, hits, misses, uncached = self.counters_view
+        used = int((self.slots_view >= 0).sum())
+        return dict(hits=int(hits), misses=int(misses), uncached=int(uncached),
+                    hit_rate=hits / max(hits + misses, 1),
+                    slots_used=used, slots=self.num_slots)
+
+    def __str__(self):
+        s = self.stats()
+        slot = ('%dx%d' % (self.size, self.size) if self.size
+                else '%.1f MB' % (self.slot_bytes / 2 ** 20))
+        return ('frame cache: %.1f%% hits (%d/%d), %d/%d slots of %s, %d frames too large'
+                % (100 * s['hit_rate'], s['hits'], s['hits'] + s['misses'],
+                   s['slots_used'], s['slots'], slot, s['uncached']))
@@ -5,6 +5,7 @@ from PIL import Image
 import numpy as np
 import torch
 from . import transforms
+from data.processing import mask_codec
 import random
 
 class PairedDataset(data.Dataset):
@@ -12,7 +13,8 @@ class PairedDataset(data.Dataset):
     e.g. corresponding real and manipulated images
     """
 
-    def __init__(self, opt, im_path_real, im_path_fake, is_val=False, with_mask=False):
+    def __init__(self, opt, im_path_real, im_path_fake, is_val=False, with_mask=False,
+                 mask_size=None):
         """Initialize this dataset class.
 
         Parameters:
@@ -21,6 +23,9 @@ class PairedDataset(data.Dataset):
             im_path_fake -- path to folder of fake images
             is_val -- is this training or validation? used to determine
             transform
+            mask_size -- masks stored as parameters (generate_I2G.py
+            --mask_format params) are rendered at this size, default the
+            stored one
         """
         super().__init__()
         self.dir_real = im_path_real
@@ -46,7 +51,14 @@ class PairedDataset(data.Dataset):
         self.fake_size = len(self.fake_paths)
         self.transform = transforms.get_transform(opt, for_val=is_val)
 
-        if self.with_mask:
+        self.mask_params = None
+        self.mask_size = mask_size
+        if self.with_mask and not os.path.isdir(self.dir_real.replace('face', 'mask')):
+            # <split>/mask_params.npy, row n is the mask of face/<n>.png
+            self.mask_params = [np.load(mask_codec.params_path(os.path.dirname(d.rstrip('/'))))
+                                for d in (self.dir_real, self.dir_fake)]
+            self.orig_transform = transforms.get_mask_transform(opt, for_val=is_val)
+        elif self.with_mask:
             self.real_mask_paths = sorted([os.path.join(self.dir_real.replace('face', 'mask'), im) for im in os.listdir(self.dir_real.replace('face', 'mask'))])
             self.fake_mask_paths = sorted([os.path.join(self.dir_fake.replace('face', 'mask'), im) for im in os.listdir(self.dir_fake.replace('face', 'mask'))])
             self.orig_transform = transforms.get_mask_transform(opt, for_val=is_val)
@@ -76,7 +88,14 @@ class PairedDataset(data.Dataset):
         real = self.transform(real_img)
         fake = self.transform(fake_img)
 
-        if self.with_mask:
+        if self.with_mask and self.mask_params is not None:
+            real_mask, fake_mask = [
+                mask_codec.render_mask_image(params[int(os.path.splitext(os.path.basename(path))[0])],
+                                             self.mask_size)
+                for params, path in zip(self.mask_params, (real_path, fake_path))]
+            real_mask = self.orig_transform(real_mask)
+            fake_mask = self.orig_transform(fake_mask)
+        elif self.with_mask:
             real_mask_path = self.real_mask_paths[index % self.real_mask_size]
             fake_mask_path = self.fake_mask_paths[index % self.fake_mask_size]
             # apply image transformation
@@ -7,6 +7,7 @@ import torch
 from . import transforms
 import random
 from data.processing.find_faces import find_face_cvhull
+from data.processing import face_detection
 import cv2
 import elasticdeform
 
@@ -51,6 +52,8 @@ class PairedMaskDataset(data.Dataset):
         self.mask_transform = transforms.get_mask_transform(opt, for_val=is_val)
         self.opt = opt
         self.last_mask = np.ones((1, 1, 2))
+        # the data workers fork after this and keep the policy
+        face_detection.set_policy(getattr(opt, 'face_detect', 'full'))
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -22,7 +22,7 @@ logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 def get_available_masks():
     """ Return a list of the available masks for cli """
     masks = sorted([name for name, obj in inspect.getmembers(sys.modules[__name__])
-                    if inspect.isclass(obj) and name != "Mask"])
+                    if inspect.isclass(obj) and name not in ("Mask", "PartMask")])
     masks.append("none")
     # logger.debug(masks)
     return masks
@@ -77,154 +77,136 @@ class Mask():
         return retval
 
 
+def dfl_full_parts(landmarks):
+    """ point sets of the dfl_full parts, each filled as its convex hull """
+    nose_ridge = (landmarks[27:31], landmarks[33:34])
+    jaw = (landmarks[0:17],
+           landmarks[48:68],
+           landmarks[0:1],
+           landmarks[8:9],
+           landmarks[16:17])
+    eyes = (landmarks[17:27],
+            landmarks[0:1],
+            landmarks[27:28],
+            landmarks[16:17],
+            landmarks[33:34])
+    return [np.concatenate(item) for item in [jaw, nose_ridge, eyes]]
+
+
+def components_parts(landmarks):
+    """ point sets of the components parts """
+    r_jaw = (landmarks[0:9], landmarks[17:18])
+    l_jaw = (landmarks[8:17], landmarks[26:27])
+    r_cheek = (landmarks[17:20], landmarks[8:9])
+    l_cheek = (landmarks[24:27], landmarks[8:9])
+    nose_ridge = (landmarks[19:25], landmarks[8:9],)
+    r_eye = (landmarks[17:22], landmarks[27:28], landmarks[31:36], landmarks[8:9])
+    l_eye = (landmarks[22:27], landmarks[27:28], landmarks[31:36], landmarks[8:9])
+    nose = (landmarks[27:31], landmarks[31:36])
+    parts = [r_jaw, l_jaw, r_cheek, l_cheek, nose_ridge, r_eye, l_eye, nose]
+    return [np.concatenate(item) for item in parts]
+
+
+def extended_parts(landmarks):
+    """ components parts with the eyebrow points extended up the forehead """
+    landmarks = landmarks.copy()
+    # mid points between the side of face and eye point
+    ml_pnt = (landmarks[36] + landmarks[0]) // 2
+    mr_pnt = (landmarks[16] + landmarks[45]) // 2
+
+    # mid points between the mid points and eye
+    ql_pnt = (landmarks[36] + ml_pnt) // 2
+    qr_pnt = (landmarks[45] + mr_pnt) // 2
+
+    # Top of the eye arrays
+    bot_l = np.array((ql_pnt, landmarks[36], landmarks[37], landmarks[38], landmarks[39]))
+    bot_r = np.array((landmarks[42], landmarks[43], landmarks[44], landmarks[45], qr_pnt))
+
+    # Eyebrow arrays
+    top_l = landmarks[17:22]
+    top_r = landmarks[22:27]
+
+    # Adjust eyebrow arrays
+    landmarks[17:22] = top_l + ((top_l - bot_l) // 2)
+    landmarks[22:27] = top_r + ((top_r - bot_r) // 2)
+    return components_parts(landmarks)
+
+
+def facehull_parts(landmarks):
+    return [np.array(landmarks).reshape((-1, 2))]
+
+
+MASK_PARTS = {
+    'dfl_full': dfl_full_parts,
+    'components': components_parts,
+    'extended': extended_parts,
+    'facehull': facehull_parts,
+    'random_components': extended_parts,
+}
+
+
+def part_hulls(landmarks, mask_type):
+    """ convex hulls of the parts of a mask type, int32 landmarks """
+    return [cv2.convexHull(points) for points in MASK_PARTS[mask_type](landmarks)]  # pylint: disable=no-member
+
+
+def rasterize_hulls(hulls, shape, dtype=np.uint8, value=255):
+    """single channel mask of the union of the hulls
+
+    facehull used to be filled with LINE_AA into a float32 mask; OpenCV
+    only antialiases 8-bit images, so that is the same as LINE_8 here.
+    """
+    mask = np.zeros(shape[:2], dtype=dtype)
+    for hull in hulls:
+        cv2.fillConvexPoly(mask, hull, value)  # pylint: disable=no-member
+    return mask
+
+
+class PartMask(Mask):
+    """ Mask filled with the convex hulls of the parts of mask_type """
+    mask_type = None
+
+    def build_mask(self):
+        hulls = self.select_parts(part_hulls(self.landmarks, self.mask_type))
+        mask = rasterize_hulls(hulls, self.face.shape, dtype=np.float32,
+                               value=255.)
+        return mask[:, :, None]
+
+    def select_parts(self, hulls):
+        return hulls
+
+
 # used in random_get_hull
-class dfl_full(Mask):  # pylint: disable=invalid-name
+class dfl_full(PartMask):  # pylint: disable=invalid-name
     """ DFL facial mask """
-    def build_mask(self):
-        mask = np.zeros(self.face.shape[0:2] + (1, ), dtype=np.float32)
-
-        nose_ridge = (self.landmarks[27:31], self.landmarks[33:34])
-        jaw = (self.landmarks[0:17],
-               self.landmarks[48:68],
-               self.landmarks[0:1],
-               self.landmarks[8:9],
-               self.landmarks[16:17])
-        eyes = (self.landmarks[17:27],
-                self.landmarks[0:1],
-                self.landmarks[27:28],
-                self.landmarks[16:17],
-                self.landmarks[33:34])
-        parts = [jaw, nose_ridge, eyes]
-
-        for item in parts:
-            merged = np.concatenate(item)
-            cv2.fillConvexPoly(mask, cv2.convexHull(merged), 255.)  # pylint: disable=no-member
-        return mask
+    mask_type = 'dfl_full'
 
 
 # used in random_get_hull
-class components(Mask):  # pylint: disable=invalid-name
+class components(PartMask):  # pylint: disable=invalid-name
     """ Component model mask """
-    def build_mask(self):
-        mask = np.zeros(self.face.shape[0:2] + (1, ), dtype=np.float32)
-
-        r_jaw = (self.landmarks[0:9], self.landmarks[17:18])
-        l_jaw = (self.landmarks[8:17], self.landmarks[26:27])
-        r_cheek = (self.landmarks[17:20], self.landmarks[8:9])
-        l_cheek = (self.landmarks[24:27], self.landmarks[8:9])
-        nose_ridge = (self.landmarks[19:25], self.landmarks[8:9],)
-        r_eye = (self.landmarks[17:22],
-                 self.landmarks[27:28],
-                 self.landmarks[31:36],
-                 self.landmarks[8:9])
-        l_eye = (self.landmarks[22:27],
-                 self.landmarks[27:28],
-                 self.landmarks[31:36],
-                 self.landmarks[8:9])
-        nose = (self.landmarks[27:31], self.landmarks[31:36])
-        parts = [r_jaw, l_jaw, r_cheek, l_cheek, nose_ridge, r_eye, l_eye, nose]
-
-        for item in parts:
-            merged = np.concatenate(item)
-            cv2.fillConvexPoly(mask, cv2.convexHull(merged), 255.)  # pylint: disable=no-member
-        return mask
+    mask_type = 'components'
 
 
 # used in random_get_hull
-class extended(Mask):  # pylint: disable=invalid-name
+class extended(PartMask):  # pylint: disable=invalid-name
     """ Extended mask
         Based on components mask. Attempts to extend the eyebrow points up the forehead
     """
-    def build_mask(self):
-        mask = np.zeros(self.face.shape[0:2] + (1, ), dtype=np.float32)
-
-        landmarks = self.landmarks.copy()
-        # mid points between the side of face and eye point
-        ml_pnt = (landmarks[36] + landmarks[0]) // 2
-        mr_pnt = (landmarks[16] + landmarks[45]) // 2
-
-        # mid points between the mid points and eye
-        ql_pnt = (landmarks[36] + ml_pnt) // 2
-        qr_pnt = (landmarks[45] + mr_pnt) // 2
-
-        # Top of the eye arrays
-        bot_l = np.array((ql_pnt, landmarks[36], landmarks[37], landmarks[38], landmarks[39]))
-        bot_r = np.array((landmarks[42], landmarks[43], landmarks[44], landmarks[45], qr_pnt))
-
-        # Eyebrow arrays
-        top_l = landmarks[17:22]
-        top_r = landmarks[22:27]
-
-        # Adjust eyebrow arrays
-        landmarks[17:22] = top_l + ((top_l - bot_l) // 2)
-        landmarks[22:27] = top_r + ((top_r - bot_r) // 2)
-
-        r_jaw = (landmarks[0:9], landmarks[17:18])
-        l_jaw = (landmarks[8:17], landmarks[26:27])
-        r_cheek = (landmarks[17:20], landmarks[8:9])
-        l_cheek = (landmarks[24:27], landmarks[8:9])
-        nose_ridge = (landmarks[19:25], landmarks[8:9],)
-        r_eye = (landmarks[17:22], landmarks[27:28], landmarks[31:36], landmarks[8:9])
-        l_eye = (landmarks[22:27], landmarks[27:28], landmarks[31:36], landmarks[8:9])
-        nose = (landmarks[27:31], landmarks[31:36])
-        parts = [r_jaw, l_jaw, r_cheek, l_cheek, nose_ridge, r_eye, l_eye, nose]
-
-        for item in parts:
-            merged = np.concatenate(item)
-            cv2.fillConvexPoly(mask, cv2.convexHull(merged), 255.)  # pylint: disable=no-member
-        return mask
+    mask_type = 'extended'
 
 
 # used in random_get_hull
-class facehull(Mask):  # pylint: disable=invalid-name
+class facehull(PartMask):  # pylint: disable=invalid-name
     """ Basic face hull mask """
-    def build_mask(self):
-        mask = np.zeros(self.face.shape[0:2] + (1, ), dtype=np.float32)
-        hull = cv2.convexHull(  # pylint: disable=no-member
-            np.array(self.landmarks).reshape((-1, 2)))
-        cv2.fillConvexPoly(mask, hull, 255.0, lineType=cv2.LINE_AA)  # pylint: disable=no-member
-        return mask
+    mask_type = 'facehull'
 
 # used in random_get_hull
-class random_components(Mask):  # pylint: disable=invalid-name
+class random_components(PartMask):  # pylint: disable=invalid-name
     """ Extended mask
         Based on components mask. Attempts to extend the eyebrow points up the forehead
     """
-    def build_mask(self):
-        mask = np.zeros(self.face.shape[0:2] + (1, ), dtype=np.float32)
-
-        landmarks = self.landmarks.copy()
-        # mid points between the side of face and eye point
-        ml_pnt = (landmarks[36] + landmarks[0]) // 2
-        mr_pnt = (landmarks[16] + landmarks[45]) // 2
-
-        # mid points between the mid points and eye
-        ql_pnt = (landmarks[36] + ml_pnt) // 2
-        qr_pnt = (landmarks[45] + mr_pnt) // 2
-
-        # Top of the eye arrays
-        bot_l = np.array((ql_pnt, landmarks[36], landmarks[37], landmarks[38], landmarks[39]))
-        bot_r = np.array((landmarks[42], landmarks[43], landmarks[44], landmarks[45], qr_pnt))
-
-        # Eyebrow arrays
-        top_l = landmarks[17:22]
-        top_r = landmarks[22:27]
-
-        # Adjust eyebrow arrays
-        landmarks[17:22] = top_l + ((top_l - bot_l) // 2)
-        landmarks[22:27] = top_r + ((top_r - bot_r) // 2)
-
-        r_jaw = (landmarks[0:9], landmarks[17:18])
-        l_jaw = (landmarks[8:17], landmarks[26:27])
-        r_cheek = (landmarks[17:20], landmarks[8:9])
-        l_cheek = (landmarks[24:27], landmarks[8:9])
-        nose_ridge = (landmarks[19:25], landmarks[8:9],)
-        r_eye = (landmarks[17:22], landmarks[27:28], landmarks[31:36], landmarks[8:9])
-        l_eye = (landmarks[22:27], landmarks[27:28], landmarks[31:36], landmarks[8:9])
-        nose = (landmarks[27:31], landmarks[31:36])
-        parts = [r_jaw, l_jaw, r_cheek, l_cheek, nose_ridge, r_eye, l_eye, nose]
-        parts = random.sample(parts, random.randint(0,len(parts)-1))
-        for item in parts:
-            merged = np.concatenate(item)
-            cv2.fillConvexPoly(mask, cv2.convexHull(merged), 255.)  # pylint: disable=no-member
-        return mask
\ No newline at end of file
+    mask_type = 'random_components'
+
+    def select_parts(self, hulls):
+        return random.sample(hulls, random.randint(0, len(hulls)-1))
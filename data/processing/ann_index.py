@@ -0,0 +1,100 @@
+import math
+import random
+import numpy as np
+
+
+def normalize_vectors(vectors, center=None, scale=None):
+    """Flattened landmarks centered on the pool mean and scaled to unit rms.
+
+    A translation and one global scale, so nearest neighbours under the
+    flattened l2 distance do not change and split thresholds are well
+    conditioned for any image size.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    if center is None:
+        center = vectors.mean(0)
+    vectors = vectors - center
+    if scale is None:
+        scale = float(np.sqrt((vectors ** 2).sum(1).mean())) or 1.
+    return vectors / scale, center, scale
+
+
+class RPForest(object):
+    """Random projection forest for approximate nearest neighbours.
+
+    Every tree splits its rows at the median of a random projection, one
+    projection per depth, until leaves hold at most leaf_size rows. A
+    query descends each tree to one leaf, and the union of those leaves
+    are the candidates. A query costs about num_trees * leaf_size
+    distance computations, independent of the pool size. Building costs
+    one (N, D) x (D, depth) product and a sort per level and tree.
+    """
+
+    def __init__(self, vectors, num_trees=8, leaf_size=64, seed=0):
+        self.vectors, self.center, self.scale = normalize_vectors(vectors)
+        self.leaf_size = leaf_size
+        rng = np.random.RandomState(seed)
+        n, dim = self.vectors.shape
+        self.depth = max(int(math.ceil(math.log2(max(n / leaf_size, 1)))), 0)
+        self.trees = [self.build_tree(rng.randn(dim, self.depth).astype(np.float32))
+                      for _ in range(num_trees)]
+
+    def build_tree(self, directions):
+        """ (directions, thresholds (2^depth - 1,), leaves) of one tree
+
+        Node i has children 2i+1 and 2i+2, leaf j is node 2^depth - 1 + j
+        and holds the rows leaves[j].
+        """
+        projections = self.vectors.dot(directions)
+        thresholds = np.zeros(2 ** self.depth - 1, dtype=np.float32)
+        nodes = [np.arange(len(self.vectors))]
+        for level in range(self.depth):
+            children = []
+            for i, rows in enumerate(nodes):
+                node = 2 ** level - 1 + i
+                values = projections[rows, level]
+                order = np.argsort(values, kind='stable')
+                half = len(rows) // 2
+                if len(rows) > 1:
+                    thresholds[node] = (values[order[half - 1]] + values[order[half]]) / 2
+                children += [rows[order[:half]], rows[order[half:]]]
+            nodes = children
+        return directions, thresholds, nodes
+
+    def leaf(self, tree, vector):
+        directions, thresholds, _ = tree
+        projection = vector.dot(directions)
+        node = 0
+        for level in range(self.depth):
+            node = 2 * node + (2 if projection[level] >= thresholds[node] else 1)
+        return node - (2 ** self.depth - 1)
+
+    def candidates(self, vector):
+        """ rows sharing a leaf with the query in any tree """
+        vector = (np.asarray(vector, dtype=np.float32).reshape(-1) - self.center) / self.scale
+        leaves = [tree[2][self.leaf(tree, vector)] for tree in self.trees]
+        return np.unique(np.concatenate(leaves))
+
+
+def sample_neighbors(rows, dists, k=1, temperature=None, rng=random):
+    """k distinct rows among the neighbours (rows, with their distances).
+
+    temperature None picks uniformly, 0 takes the nearest, otherwise rows
+    are drawn with probability exp(-(d - d_min) / (temperature * mean d)),
+    so the temperature is relative to the neighbourhood's scale.
+    """
+    rows = list(rows)
+    k = min(k, len(rows))
+    if temperature is None:
+        return rng.sample(rows, k)
+    dists = np.asarray(dists, dtype=np.float64)
+    if temperature == 0:
+        return [rows[i] for i in np.argsort(dists, kind='stable')[:k]]
+    logits = -(dists - dists.min()) / (temperature * max(dists.mean(), 1e-12))
+    weights = np.exp(logits - logits.max())
+    picked = []
+    for _ in range(k):
+        i = rng.choices(range(len(rows)), weights=weights)[0]
+        picked.append(rows[i])
+        weights[i] = 0
+    return picked
@@ -0,0 +1,136 @@
+'''
+Batched I2G compositing on torch tensors.
+
+The dataset workers only decode frames and build the masks; color
+transfer, the gaussian blur of the blending mask and alpha compositing
+run here over a whole batch, on the GPU when one is available.
+
+The masks arrive resized to loadSize, while I2GDataset blurs them at the
+size of the decoded frame. Given the scale from frame to loadSize, the
+blur kernel of each sample is scaled with it, as in mask_codec.render_mask;
+blur_parity measures what is left of the difference.
+'''
+
+import torch
+import torch.nn.functional as F
+
+
+def gaussian_kernel1d_sigma(kernel_size, sigma=0):
+    ''' sigma of gaussian_kernel1d '''
+    return sigma if sigma > 0 else 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+
+def gaussian_kernel1d(kernel_size, sigma=0):
+    ''' same kernel as cv2.getGaussianKernel, sigma <= 0 derives it from the size '''
+    sigma = gaussian_kernel1d_sigma(kernel_size, sigma)
+    x = torch.arange(kernel_size, dtype=torch.float32) - (kernel_size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+class BatchCompositor(object):
+    ''' color transfer + blur + alpha composite for a batch of I2G fakes '''
+
+    def __init__(self, kernel_size=35, sigma=0, device=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.kernel = gaussian_kernel1d(kernel_size, sigma).to(self.device)
+
+    def blur(self, mask, scale=None):
+        '''separable gaussian blur of (N, 1, H, W), reflect-101 border like
+        OpenCV. scale (N, 2) of (sx, sy) scales the kernel of each sample.
+        '''
+        if scale is None:
+            pad = self.kernel_size // 2
+            kx = self.kernel.view(1, 1, 1, -1)
+            ky = self.kernel.view(1, 1, -1, 1)
+            mask = F.conv2d(F.pad(mask, (pad, pad, 0, 0), mode='reflect'), kx)
+            mask = F.conv2d(F.pad(mask, (0, 0, pad, pad), mode='reflect'), ky)
+            return mask
+        # one kernel per sample and axis, zero padded to a common size,
+        # the samples are the channels of a grouped convolution
+        n = mask.shape[0]
+        scale = scale.float().cpu()
+        sigma = gaussian_kernel1d_sigma(self.kernel_size, self.sigma)
+        half = (self.kernel_size // 2 * scale).round().clamp(min=1).long()
+        pad = int(half.max())
+        kernels = torch.zeros(n, 2, 2 * pad + 1)
+        for i in range(n):
+            for axis in range(2):
+                h = int(half[i, axis])
+                kernels[i, axis, pad - h:pad + h + 1] = gaussian_kernel1d(
+                    2 * h + 1, sigma * float(scale[i, axis]))
+        kernels = kernels.to(mask.device)
+        mask = mask.view(1, n, *mask.shape[2:])
+        mask = F.conv2d(F.pad(mask, (pad, pad, 0, 0), mode='reflect'),
+                        kernels[:, 0].view(n, 1, 1, -1), groups=n)
+        mask = F.conv2d(F.pad(mask, (0, 0, pad, pad), mode='reflect'),
+                        kernels[:, 1].view(n, 1, -1, 1), groups=n)
+        return mask.view(n, 1, *mask.shape[2:])
+
+    def color_transfer(self, background, foreground, region):
+        ''' shift the mean color of foreground to background inside region '''
+        region = region.float()
+        count = region.sum(dim=(2, 3)).clamp(min=1)
+        mean_bg = (background * region).sum(dim=(2, 3)) / count
+        mean_fg = (foreground * region).sum(dim=(2, 3)) / count
+        shifted = foreground + (mean_bg - mean_fg)[:, :, None, None]
+        # values are truncated to uint8 in the per-sample version
+        shifted = shifted.clamp(0, 255).floor()
+        return torch.where(region > 0, shifted, foreground)
+
+    def __call__(self, background, foreground, hull, deformed, scale=None):
+        '''
+        background, foreground: (N, 3, H, W) uint8
+        hull: (N, 1, H, W) color transfer region, nonzero inside
+        deformed: (N, 1, H, W) float deformed blending mask before blur,
+            all zeros for real samples
+        scale: (N, 2) loadSize over the decoded frame width and height,
+            None blurs with the fixed kernel
+        return: images (N, 3, H, W) float in [0, 1], masks (N, 1, H, W)
+            float, 1 for untouched pixels as in I2GDataset
+        '''
+        background = background.to(self.device, non_blocking=True).float()
+        foreground = foreground.to(self.device, non_blocking=True).float()
+        hull = hull.to(self.device, non_blocking=True)
+        deformed = deformed.to(self.device, non_blocking=True).float()
+
+        foreground = self.color_transfer(background, foreground, hull)
+        alpha = self.blur(deformed, scale)
+        blended = alpha * foreground + (1 - alpha) * background
+        blended = blended.floor().clamp(0, 255) / 255
+        return blended, 1 - alpha
+
+
+def blur_parity(mask, size, kernel_size=35):
+    """(max, mean) absolute difference of the blurred blending mask between
+    I2GDataset, which blurs the float (H, W) mask and resizes it to size,
+    and BatchCompositor, which blurs the resized mask, with the kernel
+    scaled and with the fixed one: {'scaled': .., 'fixed': ..}
+    """
+    import cv2
+    import numpy as np
+    from PIL import Image
+    h, w = mask.shape
+    blurred = cv2.GaussianBlur(mask, (kernel_size, kernel_size), 0)
+    reference = np.array(Image.fromarray(blurred).resize((size, size), Image.BILINEAR))
+    small = torch.from_numpy(cv2.resize(mask, (size, size), interpolation=cv2.INTER_LINEAR))[None, None]
+    compositor = BatchCompositor(kernel_size, device='cpu')
+    result = {}
+    for name, scale in [('scaled', torch.tensor([[size / w, size / h]])), ('fixed', None)]:
+        diff = np.abs(compositor.blur(small, scale)[0, 0].numpy() - reference)
+        result[name] = float(diff.max()), float(diff.mean())
+    return result
+
+
+if __name__ == '__main__':
+    # ellipse hulls at frame sizes around and above loadSize 256
+    import cv2
+    import numpy as np
+    for frame in [256, 320, 384, 512, 720]:
+        mask = np.zeros((frame, frame), np.float32)
+        cv2.ellipse(mask, (frame // 2, frame // 2), (frame // 4, frame // 3), 0, 0, 360, 1, -1)
+        print(frame, blur_parity(mask, 256))
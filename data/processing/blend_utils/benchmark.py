@@ -0,0 +1,241 @@
+'''
+Micro-benchmarks for the blending helpers.
+
+    python -m data.processing.blend_utils.benchmark feather --sizes 256 512
+'''
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+import numpy as np
+import cv2
+import elasticdeform
+
+from data.processing.blend_utils.faceBlending import (
+    feather_weights, random_deform, piecewise_affine_transform, piecewise_affine_remap,
+    get_roi, Blender)
+from data.processing.deform_bank import ElasticDeformBank
+from data.processing.landmark_index import LandmarkIndex
+
+
+def random_face_mask(size, rng):
+    ''' convex hull of random points around the image center, (h, w, 3) float '''
+    mask = np.zeros((size, size, 3), dtype=np.float64)
+    points = rng.randint(int(size * 0.15), int(size * 0.85), size=(12, 2))
+    cv2.fillConvexPoly(mask, cv2.convexHull(points.astype(np.int32)), (1., 1., 1.))
+    return mask
+
+
+def timeit(fn, args_list, repeat=1):
+    ''' samples per second of fn over the argument list '''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for args in args_list:
+            fn(*args)
+    elapsed = time.perf_counter() - start
+    return repeat * len(args_list) / elapsed
+
+
+def feather_weights_loop(mask, featherAmount=0.2):
+    ''' the per-pixel pointPolygonTest loop feather_weights replaced '''
+    maskIndices = np.where(mask[:, :, 0] != 0)
+    maskPts = np.hstack((maskIndices[1][:, np.newaxis], maskIndices[0][:, np.newaxis]))
+    faceSize = np.max(maskPts, axis=0) - np.min(maskPts, axis=0)
+    featherAmount = featherAmount * np.max(faceSize)
+    hull = cv2.convexHull(maskPts)
+    dists = np.zeros(maskPts.shape[0])
+    for i in range(maskPts.shape[0]):
+        dists[i] = cv2.pointPolygonTest(hull, (int(maskPts[i, 0]), int(maskPts[i, 1])), True)
+    weights = np.zeros(mask.shape[:2])
+    weights[maskIndices] = np.clip(dists / featherAmount, 0, 1)
+    return weights
+
+
+def bench_feather(sizes, samples, rng):
+    print('feather: pointPolygonTest loop vs distance transform')
+    for size in sizes:
+        masks = [(random_face_mask(size, rng),) for _ in range(samples)]
+        diff = max(np.abs(feather_weights_loop(m) - feather_weights(m)).max()
+                   for (m,) in masks)
+        loop = timeit(feather_weights_loop, masks)
+        fast = timeit(feather_weights, masks)
+        print('  %4d: loop %8.1f/s  dt %8.1f/s  x%.1f  max |dw| %.4f'
+              % (size, loop, fast, fast / loop, diff))
+
+
+def iou(a, b):
+    a, b = a > 0.5, b > 0.5
+    return (a & b).sum() / max((a | b).sum(), 1)
+
+
+def deform_stats(deformed, mask):
+    ''' mean IoU with the input mask, mean pairwise IoU between samples '''
+    to_mask = [iou(d, mask) for d in deformed]
+    pairs = [iou(deformed[i], deformed[i + 1]) for i in range(len(deformed) - 1)]
+    return np.mean(to_mask), np.std(to_mask), np.mean(pairs)
+
+
+def bench_deform(sizes, samples, rng):
+    print('deform: elasticdeform per sample vs ElasticDeformBank(64) + remap')
+    print('  IoU to the mask (mean/std) and between consecutive samples, lower is more diverse')
+    random.seed(rng.randint(1 << 31))
+    for size in sizes:
+        mask = random_face_mask(size, rng)[:, :, 0]
+        bank = ElasticDeformBank(size=64, seed=rng.randint(1 << 31))
+        start = time.perf_counter()
+        bank.get_bank(mask.shape)
+        build = time.perf_counter() - start
+        args_list = [(mask,)] * samples
+
+        def direct(m):
+            return elasticdeform.deform_random_grid(m, sigma=4, points=6)
+
+        def blurred(fn):
+            return lambda m: cv2.GaussianBlur(fn(m), (35, 35), 0)
+
+        rate_direct = timeit(direct, args_list)
+        rate_bank = timeit(bank.deform, args_list, repeat=10)
+        rate_direct_blur = timeit(blurred(direct), args_list)
+        rate_bank_blur = timeit(blurred(bank.deform), args_list, repeat=10)
+        n = max(samples, 50)
+        stats_direct = deform_stats([direct(mask) for _ in range(n)], mask)
+        stats_bank = deform_stats([bank.deform(mask) for _ in range(n)], mask)
+        print('  %4d: elasticdeform %7.1f/s (+blur %7.1f/s)  bank %7.1f/s (+blur %7.1f/s)  x%.1f  build %.2fs'
+              % (size, rate_direct, rate_direct_blur, rate_bank, rate_bank_blur,
+                 rate_bank / rate_direct, build))
+        print('        IoU elasticdeform %.3f/%.3f pairs %.3f   bank %.3f/%.3f pairs %.3f'
+              % (stats_direct + stats_bank))
+
+
+def bench_warp(sizes, samples, rng):
+    print('warp: skimage PiecewiseAffineTransform + warp vs grid remap (Blender warp_backend)')
+    np.random.seed(rng.randint(1 << 31))
+    for size in sizes:
+        masks = [random_face_mask(size, rng) for _ in range(samples)]
+        args_list = [(m,) + random_deform(m.shape[:2], 4, 4) for m in masks]
+        rate_sk = timeit(piecewise_affine_transform, args_list)
+        rate_cv = timeit(piecewise_affine_remap, args_list, repeat=10)
+        ious = [iou(piecewise_affine_transform(*args)[:, :, 0],
+                    piecewise_affine_remap(*args)[:, :, 0]) for args in args_list]
+        print('  %4d: skimage %7.1f/s  remap %7.1f/s  x%.1f  IoU min %.3f mean %.3f'
+              % (size, rate_sk, rate_cv, rate_cv / rate_sk, np.min(ious), np.mean(ious)))
+
+
+def get_roi_loop(warped):
+    ''' the histogram scan get_roi replaced '''
+    height, width = warped.shape[:2]
+    left, up, right, bot = 0, 0, width, height
+    gray = warped[:, :, 0]
+    rowHistogram, colHistogram = gray.sum(axis=0), gray.sum(axis=1)
+    for i in range(width):
+        if rowHistogram[i] != 0:
+            left = i
+            break
+    for i in range(width-1, -1, -1):
+        if rowHistogram[i] != 0:
+            right = i
+            break
+    for i in range(height):
+        if colHistogram[i] != 0:
+            up = i
+            break
+    for i in range(height-1, -1, -1):
+        if colHistogram[i] != 0:
+            bot = i
+            break
+    return left, up, right, bot
+
+
+def search_list(self, idx):
+    ''' Blender.search with the list exclusion it replaced '''
+    topk = min(len(self.lms)-1, self.topk)
+    selectNum = min(self.selectNum, topk)
+    scores = ((self.lms - self.lms[idx])**2).sum(-1)
+    idxes = np.argpartition(scores, topk)[:topk]
+    ignoring = [i for i in range(idx-100, idx+100)]
+    filteredIndexes = [i for i in idxes if i not in ignoring]
+    return random.sample(filteredIndexes, k=selectNum)
+
+
+def bench_roi(sizes, samples, rng):
+    print('roi: get_roi histogram loops vs boolean projections')
+    for size in sizes:
+        masks = [(cv2.GaussianBlur(random_face_mask(size, rng), (35, 35), 0),)
+                 for _ in range(samples)]
+        masks.append((np.zeros((size, size, 3)),))
+        same = all(get_roi_loop(m) == get_roi(m) for (m,) in masks)
+        loop = timeit(get_roi_loop, masks, repeat=10)
+        fast = timeit(get_roi, masks, repeat=10)
+        print('  %4d: loop %8.1f/s  argmax %8.1f/s  x%.1f  same %s'
+              % (size, loop, fast, fast / loop, same))
+
+
+def bench_search(sizes, samples, rng):
+    print('search: Blender.search list vs index-mask exclusion, topk 100, 16*size frames')
+    for size in sizes:
+        lms = rng.rand(16 * size, 136).astype(np.float32) * size
+        blender = SimpleNamespace(lms=lms, topk=100, selectNum=1, forest=None,
+                                  temperature=None)
+        args_list = [(blender, int(i)) for i in rng.randint(len(lms), size=samples)]
+        seed = rng.randint(1 << 31)
+        random.seed(seed)
+        ref = [search_list(*args) for args in args_list]
+        random.seed(seed)
+        same = ref == [Blender.search(*args) for args in args_list]
+        loop = timeit(search_list, args_list, repeat=10)
+        fast = timeit(Blender.search, args_list, repeat=10)
+        print('  %4d: list %8.1f/s  mask %8.1f/s  x%.1f  same %s'
+              % (size, loop, fast, fast / loop, same))
+
+
+def random_landmark_pool(n, size, rng):
+    ''' n jittered, shifted and scaled copies of a few base faces, (n, 68, 2) '''
+    bases = rng.rand(32, 68, 2) * size * 0.6 + size * 0.2
+    pool = bases[rng.randint(len(bases), size=n)]
+    scale = 1 + 0.1 * rng.randn(n, 1, 1)
+    shift = size * 0.05 * rng.randn(n, 1, 2)
+    center = pool.mean(1, keepdims=True)
+    return (pool - center) * scale + center + shift + rng.randn(n, 68, 2) * size * 0.01
+
+
+def bench_ann(sizes, samples, rng):
+    print('ann: LandmarkIndex exact vs RPForest(8 trees, leaf 64) top-10, 64*size frames')
+    for size in sizes:
+        n = 64 * size
+        pool = random_landmark_pool(n, 256, rng)
+        names = ['%d_%d' % (i // 32, i) for i in range(n)]
+        exact = LandmarkIndex(names, pool)
+        start = time.perf_counter()
+        ann = LandmarkIndex(names, pool, ann=dict(num_trees=8, leaf_size=64))
+        build = time.perf_counter() - start
+        queries = [(pool[i], names[i].split('_')[0]) for i in rng.randint(n, size=max(samples, 50))]
+        recall = np.mean([len(np.intersect1d(exact.query(q, v, topk=10), ann.query(q, v, topk=10))) / 10.
+                          for q, v in queries])
+        rate_exact = timeit(lambda q, v: exact.query(q, v, topk=10), queries)
+        rate_ann = timeit(lambda q, v: ann.query(q, v, topk=10), queries)
+        print('  %7d: exact %8.1f q/s  ann %8.1f q/s  x%.1f  recall@10 %.3f  build %.2fs'
+              % (n, rate_exact, rate_ann, rate_ann / rate_exact, recall, build))
+
+
+BENCHMARKS = {
+    'feather': bench_feather,
+    'deform': bench_deform,
+    'warp': bench_warp,
+    'roi': bench_roi,
+    'search': bench_search,
+    'ann': bench_ann,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='blend_utils micro-benchmarks')
+    parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS),
+                        help='benchmarks to run: %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.RandomState(args.seed)
+    for name in args.names:
+        BENCHMARKS[name](args.sizes, args.samples, rng)
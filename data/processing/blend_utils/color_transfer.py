@@ -10,6 +10,7 @@ update: 引入 mask，基于指定像素点的色彩迁移
 # import the necessary packages
 import numpy as np
 import cv2
+from data.processing.blend_utils.masked_color_transfer import masked_mean_std, reinhard_transfer
 
 def color_transfer(source, target, clip=True, preserve_paper=True, mask=None):
 	"""
@@ -41,52 +42,10 @@ def color_transfer(source, target, clip=True, preserve_paper=True, mask=None):
 	transfer: NumPy array
 		OpenCV image (w, h, 3) NumPy array (uint8)
 	"""
-	# convert the images from the RGB to L*ab* color space, being
-	# sure to utilizing the floating point data type (note: OpenCV
-	# expects floats to be 32-bit, so use that instead of 64-bit)
-	source = cv2.cvtColor(source, cv2.COLOR_BGR2LAB).astype("float32")
-	target = cv2.cvtColor(target, cv2.COLOR_BGR2LAB).astype("float32")
-
-	# compute color statistics for the source and target images
-	(lMeanSrc, lStdSrc, aMeanSrc, aStdSrc, bMeanSrc, bStdSrc) = image_stats(source, mask)
-	(lMeanTar, lStdTar, aMeanTar, aStdTar, bMeanTar, bStdTar) = image_stats(target, mask)
-
-	# subtract the means from the target image
-	(l, a, b) = cv2.split(target)
-	l -= lMeanTar
-	a -= aMeanTar
-	b -= bMeanTar
-
-	if preserve_paper:
-		# scale by the standard deviations using paper proposed factor
-		l = (lStdTar / lStdSrc) * l
-		a = (aStdTar / aStdSrc) * a
-		b = (bStdTar / bStdSrc) * b
-	else:
-		# scale by the standard deviations using reciprocal of paper proposed factor
-		l = (lStdSrc / lStdTar) * l
-		a = (aStdSrc / aStdTar) * a
-		b = (bStdSrc / bStdTar) * b
-
-	# add in the source mean
-	l += lMeanSrc
-	a += aMeanSrc
-	b += bMeanSrc
-
-	# clip/scale the pixel intensities to [0, 255] if they fall
-	# outside this range
-	l = _scale_array(l, clip=clip)
-	a = _scale_array(a, clip=clip)
-	b = _scale_array(b, clip=clip)
-
-	# merge the channels together and convert back to the RGB color
-	# space, being sure to utilize the 8-bit unsigned integer data
-	# type
-	transfer = cv2.merge([l, a, b])
-	transfer = cv2.cvtColor(transfer.astype("uint8"), cv2.COLOR_LAB2BGR)
-	
-	# return the color transferred image
-	return transfer
+	# masked statistics and the per-channel affine map run in
+	# masked_color_transfer without gathering the masked pixels
+	return reinhard_transfer(source, target, mask=mask, clip=clip,
+		preserve_paper=preserve_paper)
 
 def image_stats(image, mask=None):
 	"""
@@ -100,67 +59,9 @@ def image_stats(image, mask=None):
 	channels, respectively
 	"""
 	# compute the mean and standard deviation of each channel
-	(l, a, b) = cv2.split(image)
-	if mask is not None:
-		# import pdb
-		# pdb.set_trace()
-		l, a, b = l.reshape(-1), a.reshape(-1), b.reshape(-1)
-		mask = mask.reshape(-1)
-		l, a, b = l[mask], a[mask], b[mask]
-		# import pdb
-		# pdb.set_trace()
-	(lMean, lStd) = (l.mean(), l.std())
-	(aMean, aStd) = (a.mean(), a.std())
-	(bMean, bStd) = (b.mean(), b.std())
+	(mean, std) = masked_mean_std(image, mask)
+	(lMean, aMean, bMean) = mean
+	(lStd, aStd, bStd) = std
 
 	# return the color statistics
 	return (lMean, lStd, aMean, aStd, bMean, bStd)
-
-def _min_max_scale(arr, new_range=(0, 255)):
-	"""
-	Perform min-max scaling to a NumPy array
-	Parameters:
-	-------
-	arr: NumPy array to be scaled to [new_min, new_max] range
-	new_range: tuple of form (min, max) specifying range of
-		transformed array
-	Returns:
-	-------
-	NumPy array that has been scaled to be in
-	[new_range[0], new_range[1]] range
-	"""
-	# get array's current min and max
-	mn = arr.min()
-	mx = arr.max()
-
-	# check if scaling needs to be done to be in new_range
-	if mn < new_range[0] or mx > new_range[1]:
-		# perform min-max scaling
-		scaled = (new_range[1] - new_range[0]) * (arr - mn) / (mx - mn) + new_range[0]
-	else:
-		# return array if already in range
-		scaled = arr
-
-	return scaled
-
-def _scale_array(arr, clip=True):
-	"""
-	Trim NumPy array values to be in [0, 255] range with option of
-	clipping or scaling.
-	Parameters:
-	-------
-	arr: array to be trimmed to [0, 255] range
-	clip: should array be scaled by np.clip? if False then input
-		array will be min-max scaled to range
-		[max([arr.min(), 0]), min([arr.max(), 255])]
-	Returns:
-	-------
-	NumPy array that has been scaled to be in [0, 255] range
-	"""
-	if clip:
-		scaled = np.clip(arr, 0, 255)
-	else:
-		scale_range = (max([arr.min(), 0]), min([arr.max(), 255]))
-		scaled = _min_max_scale(arr, new_range=scale_range)
-
-	return scaled
\ No newline at end of file
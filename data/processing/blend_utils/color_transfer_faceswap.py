@@ -1,28 +1,13 @@
 import numpy as np
 import cv2
+from data.processing.blend_utils.masked_color_transfer import mean_shift_transfer
 
 # from https://github.com/ondyari/FaceForensics/tree/master/dataset/FaceSwapKowalski
 
 #uwaga, tutaj src to obraz, z ktorego brany bedzie kolor
 def colorTransfer(src, dst, mask):
-    transferredDst = np.copy(dst)
-    #indeksy nie czarnych pikseli maski
-    maskIndices = np.where(mask != 0)
-    #src[maskIndices[0], maskIndices[1]] zwraca piksele w nie czarnym obszarze maski
-
-    maskedSrc = src[maskIndices[0], maskIndices[1]].astype(np.int32)
-    maskedDst = dst[maskIndices[0], maskIndices[1]].astype(np.int32)
-
-    meanSrc = np.mean(maskedSrc, axis=0)
-    meanDst = np.mean(maskedDst, axis=0)
-
-    maskedDst = maskedDst - meanDst
-    maskedDst = maskedDst + meanSrc
-    maskedDst = np.clip(maskedDst, 0, 255)
-
-    transferredDst[maskIndices[0], maskIndices[1]] = maskedDst
-
-    return transferredDst
+    # masked mean shift without gathering the masked pixels
+    return mean_shift_transfer(src, dst, mask)
 
 def color_transfer(source, target, clip=None, preserve_paper=None, mask=None):
     # print('faceswap color transfer')
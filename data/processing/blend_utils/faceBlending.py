@@ -4,7 +4,8 @@ Reference from @author Zhuolin Fu
 
 '''
 
-import argparse, sys, os
+import argparse, sys, os, time
+from collections import OrderedDict
 from os.path import basename, splitext
 # from PIL import Image
 from functools import partial
@@ -25,6 +26,7 @@ if COLOR_TRANSFER == 'faceswap':
 else:
     from data.processing.blend_utils.color_transfer import color_transfer
 from data.processing.blend_utils.utils import files, FACIAL_LANDMARKS_IDXS, shape_to_np
+from data.processing.ann_index import RPForest, sample_neighbors
 
 
 def cv_loader(path, gray=False):
@@ -75,25 +77,15 @@ def get_roi(warped):
     return: left, up, right, bot.
     '''
     height, width = warped.shape[:2]
-    left, up, right, bot = 0, 0, width, height
-    gray = warped[:, :, 0]
-    rowHistogram, colHistogram = gray.sum(axis=0), gray.sum(axis=1)
-    for i in range(width):
-        if rowHistogram[i] != 0:
-            left = i
-            break
-    for i in range(width-1, -1, -1):
-        if rowHistogram[i] != 0:
-            right = i
-            break
-    for i in range(height):
-        if colHistogram[i] != 0:
-            up = i
-            break
-    for i in range(height-1, -1, -1):
-        if colHistogram[i] != 0:
-            bot = i
-            break
+    gray = warped[:, :, 0] != 0
+    # 非零列/行的布尔投影, argmax 取第一个 True
+    cols, rows = gray.any(axis=0), gray.any(axis=1)
+    if not cols.any():
+        return 0, 0, width, height
+    left = int(cols.argmax())
+    right = width - 1 - int(cols[::-1].argmax())
+    up = int(rows.argmax())
+    bot = height - 1 - int(rows[::-1].argmax())
     ''' Old style Implementeation. Maybe something is wrong.
     for i, num in enumerate(rowHistogram):
         if left == 0 and num !=0:
@@ -113,6 +105,53 @@ def forge(srcRgb, targetRgb, mask):
 
     return (mask * targetRgb + (1 - mask) * srcRgb).astype(np.uint8)
 
+def feather_weights(mask, featherAmount=0.2):
+    '''羽化权重: 像素到 mask 凸包边界的距离 / featherAmount, 截断到 [0, 1]
+    Same weights as calling cv2.pointPolygonTest for every mask pixel, but
+    from one distance transform over the rasterized hull.
+    mask: (h, w) or (h, w, c), nonzero inside.
+    return: (h, w) float64 weights, 0 outside the mask.
+    '''
+    region = mask != 0
+    if region.ndim == 3:
+        region = region.any(axis=2)
+    region8 = region.astype(np.uint8)
+    # the hull of the outer contours is the hull of all mask pixels
+    contours = cv2.findContours(region8, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not contours:
+        return np.zeros(region.shape)
+    hull = cv2.convexHull(np.concatenate(contours))
+    x, y, w, h = cv2.boundingRect(hull)
+    featherAmount = featherAmount * (max(w, h) - 1)
+    # rasterize the hull in its bounding box, padded by one pixel so the
+    # hull never touches the border of the distance transform
+    hullMask = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    cv2.fillConvexPoly(hullMask, hull - (x - 1, y - 1), 1)
+    dists = cv2.distanceTransform(hullMask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    # pixels on the hull edge are 1 away from the outside, pointPolygonTest gives 0
+    dists = dists[1:-1, 1:-1]
+    dists -= 1
+    dists /= featherAmount
+    weights = np.zeros(region.shape)
+    weights[y:y + h, x:x + w] = np.clip(dists, 0, 1)
+    weights[~region] = 0
+    return weights
+
+
+def feather_blend(src, dst, mask, featherAmount=0.2):
+    '''按羽化权重融合 src 到 dst
+    return: composed image (dst dtype), alpha with the shape of mask.
+    '''
+    weights = feather_weights(mask, featherAmount)
+    w = weights[:, :, np.newaxis] if dst.ndim == 3 else weights
+    composedImg = (w * src + (1 - w) * dst).astype(dst.dtype)
+    if mask.ndim == 3:
+        alpha = np.where(mask != 0, weights[:, :, np.newaxis], 0)
+    else:
+        alpha = weights
+    return composedImg, alpha.astype(mask.dtype)
+
+
 def get_bounding(mask):
     bounding = 4 * mask * (1 - mask)
     # print(type(mask), mask.shape, mask.dtype)
@@ -204,6 +243,53 @@ def piecewise_affine_transform(image, srcAnchor, tgtAnchor):
     return warped
 
 
+def interp_weights(values, knots):
+    '''线性插值权重矩阵 (len(values), len(knots))，每行至多两个非零'''
+    n = len(knots)
+    idx = np.clip(np.searchsorted(knots, values, side='right') - 1, 0, n - 2)
+    t = (values - knots[idx]) / (knots[idx + 1] - knots[idx])
+    weights = np.zeros((len(values), n), dtype=np.float32)
+    weights[np.arange(len(values)), idx] = 1 - t
+    weights[np.arange(len(values)), idx + 1] = t
+    return weights
+
+
+def piecewise_affine_remap(image, srcAnchor, tgtAnchor):
+    '''piecewise_affine_transform 的 OpenCV 版本, Return 0-1 range, float32
+    The anchor displacement of the random_deform grid is interpolated
+    bilinearly per grid cell instead of per Delaunay triangle, as two small
+    matrix products, and applied with one cv2.remap. Anchors are (x, y)
+    points like in skimage, so points outside the anchor grid map outside
+    the image as they do there.
+    '''
+    h, w = image.shape[:2]
+    knotsX = np.unique(srcAnchor[:, 0])
+    knotsY = np.unique(srcAnchor[:, 1])
+    disp = np.zeros((len(knotsX), len(knotsY), 2), dtype=np.float32)
+    disp[np.searchsorted(knotsX, srcAnchor[:, 0]),
+         np.searchsorted(knotsY, srcAnchor[:, 1])] = tgtAnchor - srcAnchor
+    xs = np.arange(w, dtype=np.float32)
+    ys = np.arange(h, dtype=np.float32)
+    wx = interp_weights(xs, knotsX.astype(np.float32))
+    wy = interp_weights(ys, knotsY.astype(np.float32))
+    mapX = xs[np.newaxis, :] + wy @ disp[:, :, 0].T @ wx.T
+    mapY = ys[:, np.newaxis] + wy @ disp[:, :, 1].T @ wx.T
+    outside = (xs[np.newaxis, :] > knotsX[-1]) | (ys[:, np.newaxis] > knotsY[-1])
+    mapX[outside] = -w
+    if image.dtype == np.uint8:
+        image = image.astype(np.float32) / 255
+    else:
+        image = image.astype(np.float32)
+    return cv2.remap(image, mapX, mapY, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+WARP_BACKENDS = {
+    'skimage': piecewise_affine_transform,
+    'cv': piecewise_affine_remap,
+}
+
+
 def distance(lms1, lms2):
     return np.linalg.norm(lms1 - lms2)  # 两landmarks的二范数 = 欧几里得距离
 
@@ -267,7 +353,9 @@ class Blender:
     '''
     def __init__(self, ldmPath, dataPath, topk=100, selectNum=1, \
             gaussianKernel=5, gaussianSigma=7, loader='cv',
-            pixel_aug=None, spatial_aug=None, aug_at_load=False
+            pixel_aug=None, spatial_aug=None, aug_at_load=False,
+            warp_backend='cv', profile=False,
+            donor_search='exact', ann_trees=8, ann_leaf_size=64, temperature=None
         ):
         # 格式读取、转化。
         self.relativePaths, lms = [], []
@@ -302,6 +390,35 @@ class Blender:
         self.aug_at_load = aug_at_load
         print('[Blender]: aug_at_load:', self.aug_at_load)
 
+        # skimage: PiecewiseAffineTransform + warp, cv: dense grid + cv2.remap
+        self.warp_fn = WARP_BACKENDS[warp_backend]
+        self.profile = profile
+        self.timings = OrderedDict()
+        self.timed = 0
+
+        # exact: argpartition over all N, ann: random projection forest candidates
+        self.forest = None
+        if donor_search == 'ann' and ldmPath:
+            self.forest = RPForest(self.lms, num_trees=ann_trees, leaf_size=ann_leaf_size)
+        # None: uniform among the topk, else see sample_neighbors
+        self.temperature = temperature
+
+    def tic(self, stage, start):
+        ''' 累计 core 各阶段耗时, returns the new start time '''
+        now = time.perf_counter()
+        if self.profile:
+            self.timings[stage] = self.timings.get(stage, 0.) + now - start
+        return now
+
+    def timing_report(self):
+        ''' mean milliseconds per core() call of every stage '''
+        n = max(self.timed, 1)
+        total = sum(self.timings.values())
+        lines = ['[Blender]: core %.2f ms/blend over %d blends' % (1e3 * total / n, self.timed)]
+        for stage, t in self.timings.items():
+            lines.append('  %-14s %8.2f ms %5.1f%%' % (stage, 1e3 * t / n, 100 * t / max(total, 1e-12)))
+        return '\n'.join(lines)
+
     def __len__(self):
         return self.lms.shape[0]
 
@@ -355,41 +472,28 @@ class Blender:
 
         src = color_transfer(dst, src, preserve_paper=False, mask=mask)
 
-        #indeksy nie czarnych pikseli maski
-        maskIndices = np.where(mask != 0)
-        #te same indeksy tylko, ze teraz w jednej macierzy, gdzie kazdy wiersz to jeden piksel (x, y)
-        maskPts = np.hstack((maskIndices[1][:, np.newaxis], maskIndices[0][:, np.newaxis]))
-        faceSize = np.max(maskPts, axis=0) - np.min(maskPts, axis=0)
-        featherAmount = featherAmount * np.max(faceSize)
-
-        hull = cv2.convexHull(maskPts)
-        dists = np.zeros(maskPts.shape[0])
-        for i in range(maskPts.shape[0]):
-            dists[i] = cv2.pointPolygonTest(hull, (maskPts[i, 0], maskPts[i, 1]), True)
-
-        weights = np.clip(dists / featherAmount, 0, 1)
-        # import pdb; pdb.set_trace()
-
-        composedImg = np.copy(dst)
-        composedImg[maskIndices[0], maskIndices[1]] = weights[:, np.newaxis] * src[maskIndices[0], maskIndices[1]] + (1 - weights[:, np.newaxis]) * dst[maskIndices[0], maskIndices[1]]
-        alpha_mask = np.zeros_like(mask)
-        alpha_mask[maskIndices[0], maskIndices[1]] = weights[:, np.newaxis] * 1
+        composedImg, alpha_mask = feather_blend(src, dst, mask, featherAmount)
         xray = get_bounding(alpha_mask)
         return composedImg, xray
 
     def core(self, i, j):
         '''贴合：用 i 的背景，接纳 j 的前景（j 攻击 i）
         '''
+        start = time.perf_counter()
         imgPair = [self.img_loader(k, do_aug=self.aug_at_load) for k in (i, j)]
         lms = [self.lms[i].reshape(-1,2) for k in (i, j)]
-        
+        start = self.tic('load', start)
+
         hullMask = convex_hull(imgPair[0].shape, lms[0])  # todo: shrink mask.
+        start = self.tic('hull', start)
         # 只对 mask 部分 random deform
         left, up, right, bot = get_roi(hullMask)
         left, up, right, bot = (left+0)//2, (up+0)//2, (right+hullMask.shape[1])//2, (bot+hullMask.shape[0])//2
         centerHullMask = hullMask[up:bot, left:right, :]
+        start = self.tic('roi', start)
         anchors, deformedAnchors = random_deform(centerHullMask.shape[:2], 4, 4)  # todo 方法不够理想
-        warpedMask = piecewise_affine_transform(centerHullMask, anchors, deformedAnchors)
+        warpedMask = self.warp_fn(centerHullMask, anchors, deformedAnchors)
+        start = self.tic('warp', start)
         # 伪造区域随机化：进一步缩放+平移抖动
         warpedMask = linear_deform(warpedMask, scale=SCALE, shake_h=SHAKE_H, random=True)
         # 将 warped 区域限制在人脸范围内，避免背景的影响
@@ -397,11 +501,14 @@ class Blender:
         # 还原
         warped = np.zeros_like(hullMask, dtype=warpedMask.dtype)
         warped[up:bot, left:right, :] = warpedMask
+        start = self.tic('linear_deform', start)
         # pdb.set_trace()
         if BLEND_TYPE == 'faceswap':
             resultantFace, resultantBounding = self.core_alpha(imgPair, warped)
         else:
             resultantFace, resultantBounding = self.core_xray(imgPair, warped)
+        self.tic('blend', start)
+        self.timed += self.profile
 
         return resultantFace, resultantBounding
 
@@ -411,19 +518,43 @@ class Blender:
         topk = min(len(self.lms)-1, self.topk)
         selectNum = min(self.selectNum, topk)
         pivot = self.lms[idx]
+        if self.forest is not None:
+            # 近似: 只在 forest 的候选里找 topK
+            rows = self.forest.candidates(pivot)
+            rows = rows[(rows < idx - 100) | (rows >= idx + 100)]
+            if len(rows) >= selectNum:
+                scores = ((self.lms[rows] - pivot)**2).sum(-1)
+                k = min(topk, len(rows))
+                order = np.argpartition(scores, k - 1)[:k]
+                return sample_neighbors(rows[order].tolist(), scores[order], selectNum, self.temperature)
         subs = self.lms-pivot
         scores = (subs**2).sum(-1)  # l2 距离
         idxes = np.argpartition(scores, topk)[:topk]  # topK
         # 去重
-        # 要忽略的集合
-        ignoring = [idx]
-        ignoring = [i for i in range(idx-100, idx+100)]  # 前后的100个都不要了
-        filteredIndexes = [i for i in idxes if i not in ignoring]
+        # 要忽略的集合: [idx-100, idx+100) 前后的100个都不要了
+        idxes = idxes[(idxes < idx - 100) | (idxes >= idx + 100)]
         # pdb.set_trace()
-        outs = sample(filteredIndexes, k=selectNum)  # 对 idx 去重
+        outs = sample_neighbors(idxes.tolist(), scores[idxes], selectNum, self.temperature)  # 对 idx 去重
         # pdb.set_trace()
         return outs
 
+    def blend_pair(self, i, j):
+        ''' core + pixel aug, saved to OUT_PATH as <i>_<j>.png / <i>_<j>_label.png '''
+        # start = time.clock()
+        blended, label = self.core(i, j)  # 0.64s
+        # time_core = time.clock() - start
+        # print('TIME core:', time_core)
+        if self.pixel_aug:
+            blended = self.pixel_aug(blended)
+        if SAVE_BLEND:
+            name = '{}_{}'.format(i, j)  # j attack i
+            status = 0
+            blended_bgr = cv2.cvtColor(blended, cv2.COLOR_RGB2BGR)
+            status += cv2.imwrite(osp.join(OUT_PATH, name+'.png'), blended_bgr)
+            status += cv2.imwrite(osp.join(OUT_PATH, name+'_label'+'.png'), label*255)
+            assert status == 2, 'Error: image saving failed: {}/{}'.format(OUT_PATH, name)
+        return blended, label
+
     def blend_i(self, i, get_path=False):
         """blend: default do aug
         """
@@ -435,19 +566,7 @@ class Blender:
         # print('TIME search:', time_search) 
         for j in js:
             j_path = self.relativePaths[j]
-            # start = time.clock()
-            blended, label = self.core(i, j)  # 0.64s
-            # time_core = time.clock() - start
-            # print('TIME core:', time_core)
-            if self.pixel_aug:
-                blended = self.pixel_aug(blended)
-            if SAVE_BLEND:
-                name = '{}_{}'.format(i, j)  # j attack i
-                status = 0
-                blended_bgr = cv2.cvtColor(blended, cv2.COLOR_RGB2BGR)
-                status += cv2.imwrite(osp.join(OUT_PATH, name+'.png'), blended_bgr)
-                status += cv2.imwrite(osp.join(OUT_PATH, name+'_label'+'.png'), label*255)
-                assert status == 2, 'Error: image saving failed: {}/{}'.format(OUT_PATH, name)
+            blended, label = self.blend_pair(i, j)
             if get_path:
                 yield blended, label, i_path, j_path  # generator
             else:
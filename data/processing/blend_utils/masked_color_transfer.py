@@ -0,0 +1,116 @@
+"""
+Masked color transfer kernels.
+
+The masked moments come from one cv2.meanStdDev pass over the image with
+the mask, and the mean shift is written with a masked, saturating
+cv2.add, so no index arrays or gathered pixel copies are built. The
+batch_* variants take (N, H, W, C) images and (N, H, W) masks and write
+into one output batch; on the CPU a loop over these kernels is faster
+than einsum/matmul reductions over the whole batch. BatchCompositor has
+the torch version of the mean shift.
+
+mean_shift_transfer -- RGB mean shift of FaceSwap / I2GDataset
+reinhard_transfer   -- L*a*b* mean and std transfer, Reinhard et al. 2001
+"""
+
+import numpy as np
+import cv2
+
+
+def as_mask(mask, shape):
+    """ (H, W) uint8 mask, nonzero inside, from a bool/float/(H, W, C) mask """
+    if mask is None:
+        return np.ones(shape[:2], dtype=np.uint8)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    if mask.dtype == np.bool_:
+        mask = mask.view(np.uint8)
+    elif mask.dtype != np.uint8:
+        mask = (mask != 0).view(np.uint8)
+    return np.ascontiguousarray(mask)
+
+
+def masked_mean_std(image, mask=None):
+    """ per-channel mean and (population) std of the pixels inside mask """
+    mean, std = cv2.meanStdDev(image, mask=as_mask(mask, image.shape))
+    return mean[:, 0], std[:, 0]
+
+
+def mean_shift_transfer(src, dst, mask, out=None):
+    """Shift the mean color of dst inside mask to the one of src.
+
+    Same result as the FaceSwap colorTransfer: pixels outside the mask are
+    untouched, inside they are dst - mean(dst) + mean(src) clipped to
+    [0, 255] and truncated. dst is integer valued, so truncating the shift
+    once gives the same pixels. Pass out=dst to work in place.
+    """
+    mask = as_mask(mask, dst.shape)
+    mean_src = cv2.mean(src, mask=mask)
+    mean_dst = cv2.mean(dst, mask=mask)
+    shift = tuple(float(np.floor(s - d)) for s, d in zip(mean_src, mean_dst))
+    if out is None:
+        out = dst.copy()
+    elif out is not dst:
+        out[...] = dst
+    cv2.add(out, shift, dst=out, mask=mask)
+    return out
+
+
+def _scale_channels(lab, clip):
+    if clip:
+        return np.clip(lab, 0, 255, out=lab)
+    for c in range(lab.shape[-1]):
+        channel = lab[..., c]
+        mn, mx = channel.min(), channel.max()
+        lo, hi = max(mn, 0), min(mx, 255)
+        if mn < lo or mx > hi:
+            channel[...] = (hi - lo) * (channel - mn) / (mx - mn) + lo
+    return lab
+
+
+def reinhard_transfer(source, target, mask=None, clip=True, preserve_paper=True):
+    """Transfer the L*a*b* statistics inside mask of source onto target.
+
+    source, target: BGR uint8 images. The whole target is transformed with
+    the statistics of the masked pixels, as in color_transfer.color_transfer.
+    """
+    source = cv2.cvtColor(source, cv2.COLOR_BGR2LAB).astype(np.float32)
+    target = cv2.cvtColor(target, cv2.COLOR_BGR2LAB).astype(np.float32)
+    mean_src, std_src = masked_mean_std(source, mask)
+    mean_tar, std_tar = masked_mean_std(target, mask)
+    if preserve_paper:
+        scale = std_tar / np.maximum(std_src, 1e-6)
+    else:
+        scale = std_src / np.maximum(std_tar, 1e-6)
+    # (x - mean_tar) * scale + mean_src as one multiply-add per channel
+    target *= scale.astype(np.float32)
+    target += (mean_src - mean_tar * scale).astype(np.float32)
+    target = _scale_channels(target, clip)
+    return cv2.cvtColor(target.astype(np.uint8), cv2.COLOR_LAB2BGR)
+
+
+def batch_masked_mean_std(images, masks):
+    """ (N, C) mean and std of (N, H, W, C) images inside (N, H, W) masks """
+    stats = [masked_mean_std(image, mask) for image, mask in zip(images, masks)]
+    return (np.stack([mean for mean, _ in stats]),
+            np.stack([std for _, std in stats]))
+
+
+def batch_mean_shift_transfer(src, dst, masks, out=None):
+    """ mean_shift_transfer over (N, H, W, 3) uint8 batches, out=dst for in place """
+    if out is None:
+        out = np.empty_like(dst)
+    for i in range(len(dst)):
+        mean_shift_transfer(src[i], dst[i], masks[i], out=out[i])
+    return out
+
+
+def batch_reinhard_transfer(source, target, masks, clip=True, preserve_paper=True,
+                            out=None):
+    """ reinhard_transfer over (N, H, W, 3) uint8 BGR batches """
+    if out is None:
+        out = np.empty_like(target)
+    for i in range(len(target)):
+        out[i] = reinhard_transfer(source[i], target[i], masks[i], clip,
+                                   preserve_paper)
+    return out
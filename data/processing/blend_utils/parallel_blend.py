@@ -0,0 +1,191 @@
+'''
+Multi-process driver for Blender.
+
+    python -m data.processing.blend_utils.parallel_blend --ldm lms.json \
+        --data /path/to/frames --out /path/to/blended --workers 8 --target 100000
+
+The (N, 136) landmark matrix and the relative paths are copied once into
+shared RawArrays which the pool workers inherit when they are forked, so
+nothing of size N is pickled to or copied into a worker. Index ranges are
+handed out to the workers, each one runs Blender.search + blend_pair and
+writes <i>_<j>.png and <i>_<j>_label.png to the output path like
+Blender.blend_i. A shared counter stops all workers at the target count.
+'''
+
+import argparse
+import os
+import random
+import time
+import multiprocessing as mp
+from collections import defaultdict
+import numpy as np
+
+from data.processing.blend_utils import faceBlending
+
+
+class SharedPaths(object):
+    ''' read only list of str kept as fixed width utf-8 in a RawArray '''
+
+    def __init__(self, paths):
+        encoded = [p.encode('utf-8') for p in paths]
+        self.width = max([len(p) for p in encoded] + [1])
+        self.count = len(encoded)
+        self.data = mp.RawArray('B', self.count * self.width)
+        self.views()
+        self.array[:] = encoded
+
+    def views(self):
+        self.array = np.frombuffer(self.data, dtype='S%d' % self.width)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['array']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.views()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.array[i].decode('utf-8')
+
+
+def share_array(array):
+    ''' copy of array backed by a RawArray '''
+    array = np.ascontiguousarray(array)
+    raw = mp.RawArray(np.ctypeslib.as_ctypes_type(array.dtype), array.size)
+    shared = np.frombuffer(raw, dtype=array.dtype).reshape(array.shape)
+    shared[...] = array
+    return shared
+
+
+# state of a pool worker, set by init_worker
+_worker = {}
+
+
+def init_worker(blender, out_path, counter, target):
+    faceBlending.SAVE_BLEND = True
+    faceBlending.OUT_PATH = out_path
+    _worker.update(blender=blender, counter=counter, target=target)
+
+
+def reached():
+    target = _worker['target']
+    return target is not None and _worker['counter'].value >= target
+
+
+def claim():
+    ''' reserve one blend of the target count, False once it is reached '''
+    counter = _worker['counter']
+    with counter.get_lock():
+        if reached():
+            return False
+        counter.value += 1
+        return True
+
+
+def blend_range(task):
+    ''' blend the indices [start, stop), returns (pid, blends, seconds) '''
+    start, stop, seed = task
+    blender = _worker['blender']
+    if reached():
+        # the remaining tasks return right away
+        return os.getpid(), 0, 0.
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed % (1 << 32))
+    count = 0
+    begin = time.perf_counter()
+    for i in range(start, stop):
+        js = blender.search(i)
+        for j in js:
+            if not claim():
+                return os.getpid(), count, time.perf_counter() - begin
+            blender.blend_pair(i, j)
+            count += 1
+    return os.getpid(), count, time.perf_counter() - begin
+
+
+class ParallelBlender(object):
+    '''Runs Blender.blend_pair for index ranges in a process pool.
+
+    blender -- a loaded Blender; its lms and relativePaths are replaced by
+        shared copies, the object itself keeps working in this process
+    chunk -- indices per task
+    seed -- seeds every task with seed + its start index, so a range gives
+        the same donors and deformations whichever worker runs it
+    '''
+
+    def __init__(self, blender, num_workers=4, out_path=None, chunk=64, seed=None):
+        blender.lms = share_array(blender.lms)
+        blender.relativePaths = SharedPaths(blender.relativePaths)
+        self.blender = blender
+        self.num_workers = num_workers
+        self.out_path = faceBlending.OUT_PATH if out_path is None else out_path
+        self.chunk = chunk
+        self.seed = seed
+        self.stats = defaultdict(lambda: [0, 0.])  # pid -> [blends, seconds]
+
+    def tasks(self, start, stop):
+        for s in range(start, stop, self.chunk):
+            seed = None if self.seed is None else self.seed + s
+            yield s, min(s + self.chunk, stop), seed
+
+    def run(self, target=None, start=0, stop=None, verbose=True):
+        ''' blend the indices [start, stop) until target blends are written, returns the count '''
+        stop = len(self.blender) if stop is None else stop
+        os.makedirs(self.out_path, exist_ok=True)
+        counter = mp.Value('q', 0)
+        # fork: the workers inherit the blender and the RawArrays instead of pickling them
+        ctx = mp.get_context('fork')
+        begin = time.perf_counter()
+        with ctx.Pool(self.num_workers, initializer=init_worker,
+                      initargs=(self.blender, self.out_path, counter, target)) as pool:
+            for pid, count, seconds in pool.imap_unordered(blend_range, self.tasks(start, stop)):
+                self.stats[pid][0] += count
+                self.stats[pid][1] += seconds
+                if verbose:
+                    total = sum(n for n, _ in self.stats.values())
+                    print('\r[ParallelBlender]: %d blends, %.1f blends/s'
+                          % (total, total / (time.perf_counter() - begin)), end='', flush=True)
+        if verbose:
+            print()
+        return sum(n for n, _ in self.stats.values())
+
+    def report(self):
+        ''' blends per second of every worker '''
+        lines = []
+        for i, (pid, (count, seconds)) in enumerate(sorted(self.stats.items())):
+            lines.append('  worker %d (pid %d): %d blends, %.2f blends/s'
+                         % (i, pid, count, count / max(seconds, 1e-9)))
+        total = sum(n for n, _ in self.stats.values())
+        return '\n'.join(['[ParallelBlender]: %d blends by %d workers' % (total, len(self.stats))] + lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='blend with a process pool')
+    parser.add_argument('--ldm', required=True, help='json [[path, landmarks], ...]')
+    parser.add_argument('--data', required=True, help='root of the relative frame paths')
+    parser.add_argument('--out', required=True, help='output dir of blends and labels')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--target', type=int, default=None, help='stop after this many blends')
+    parser.add_argument('--chunk', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--topk', type=int, default=100)
+    parser.add_argument('--warp_backend', default='cv', choices=['cv', 'skimage'])
+    parser.add_argument('--donor_search', default='exact', choices=['exact', 'ann'])
+    parser.add_argument('--temperature', type=float, default=None,
+                        help='donor sampling temperature among the topk, unset is uniform')
+    args = parser.parse_args()
+
+    blender = faceBlending.Blender(
+        ldmPath=args.ldm, dataPath=args.data, topk=args.topk, selectNum=1,
+        gaussianKernel=[31, 63], gaussianSigma=[7, 15], warp_backend=args.warp_backend,
+        donor_search=args.donor_search, temperature=args.temperature)
+    driver = ParallelBlender(blender, num_workers=args.workers, out_path=args.out,
+                             chunk=args.chunk, seed=args.seed)
+    driver.run(target=args.target)
+    print(driver.report())
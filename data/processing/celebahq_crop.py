@@ -1,11 +1,10 @@
 from PIL import Image
-import dlib
 import cv2
 import scipy.ndimage
 import numpy as np
 
-detector = dlib.get_frontal_face_detector()
-predictor = dlib.shape_predictor('resources/shape_predictor_68_face_landmarks.dat')
+# dlib models are loaded on first use, see face_detection.set_policy
+from data.processing.face_detection import face_landmarks
 
 def rot90(v):
     return np.array([-v[1], v[0]])
@@ -35,23 +34,31 @@ def rect_to_bb(rect):
     return (x, y, w, h)
 
 def I2G_crop(im, landmarks=None):
-    gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
-    rects = detector(gray, 1)
-    if not rects:
+    ''' 1024 celebahq_crop of the first detected face, and its 68 landmarks '''
+    shape = face_landmarks(im)
+    if shape is None:
         return None
-    shape = predictor(gray, rects[0])
-    shape = shape_to_np(shape)
+    img, _ = celebahq_crop(im, five_points_of(shape))
+    return img, shape
+
+def five_points(im):
+    ''' eyes, nose and mouth corners of the first detected face, None without a face '''
+    shape = face_landmarks(im)
+    if shape is None:
+        return None
+    return five_points_of(shape)
 
+def five_points_of(shape):
+    ''' eyes, nose and mouth corners of 68 landmarks '''
     lefteye = np.mean(shape[[37, 38, 40, 41], :], axis=0)
     righteye = np.mean(shape[[43, 44, 46, 47], :], axis=0)
     nose = shape[30]
     leftmouth = shape[48]
     rightmouth = shape[54]
-    lm = np.stack([lefteye, righteye, nose, leftmouth, rightmouth])
-
-    img = Image.fromarray(im)
+    return np.stack([lefteye, righteye, nose, leftmouth, rightmouth])
 
-    # Choose oriented crop rectangle.
+def crop_quad(lm):
+    ''' oriented crop rectangle of the five points, and its zoom '''
     eye_avg = (lm[0] + lm[1]) * 0.5 + 0.5
     mouth_avg = (lm[3] + lm[4]) * 0.5 + 0.5
     eye_to_eye = lm[1] - lm[0]
@@ -63,15 +70,17 @@ def I2G_crop(im, landmarks=None):
     c = eye_avg + eye_to_mouth * 0.1
     quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
     zoom = 128 / (np.hypot(*x) * 2)
+    return quad, zoom
 
-    # Shrink.
-    shrink = int(np.floor(0.5 / zoom))
+def shrink_image(img, quad, zoom, shrink):
     if shrink > 1:
         size = (int(np.round(float(img.size[0]) / shrink)), int(np.round(float(img.size[1]) / shrink)))
         img = img.resize(size, Image.ANTIALIAS)
         quad /= shrink
         zoom *= shrink
+    return img, quad, zoom
 
+def crop_image(img, quad, zoom):
     # Crop.
     border = max(int(np.round(128 * 0.1 / zoom)), 3)
     crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
@@ -79,15 +88,9 @@ def I2G_crop(im, landmarks=None):
     if crop[2] - crop[0] < img.size[0] or crop[3] - crop[1] < img.size[1]:
         img = img.crop(crop)
         quad -= crop[0:2]
+    return img, quad, border
 
-    # Simulate super-resolution.
-    superres = int(np.exp2(np.ceil(np.log2(zoom))))
-    if superres > 1:
-        img = img.resize((img.size[0] * superres, img.size[1] * superres), Image.ANTIALIAS)
-        quad *= superres
-        zoom /= superres
-
-    # Pad.
+def pad_image(img, quad, zoom, border):
     pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
     pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - img.size[0] + border, 0), max(pad[3] - img.size[1] + border, 0))
     if max(pad) > border - 4:
@@ -101,60 +104,57 @@ def I2G_crop(im, landmarks=None):
         img += (np.median(img, axis=(0,1)) - img) * np.clip(mask, 0.0, 1.0)
         img = Image.fromarray(np.uint8(np.clip(np.round(img), 0, 255)), 'RGB')
         quad += pad[0:2]
-
-    # Transform.
-    img = img.transform((512, 512), Image.QUAD, (quad + 0.5).flatten(), Image.BILINEAR)
-    img = img.resize((1024, 1024), Image.ANTIALIAS)
-    return img, shape
-
-def celebahq_crop(im, landmarks=None):
+    return img, quad
+
+def celebahq_crop(im, landmarks=None, outsize=None):
+    '''
+    Aligned face crop of an RGB frame, and the five points it is aligned on.
+
+    Without outsize the crop is 1024x1024: warped to 512x512 and upsampled,
+    callers resize it to their size. With outsize the frame is shrunk to
+    at most one pixel per output pixel and the quad is warped once,
+    straight to outsize x outsize; see crop_parity for its difference to
+    resizing the 1024 crop.
+    '''
     if landmarks is None:
-        gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
-        rects = detector(gray, 1)
-        if not rects:
+        lm = five_points(im)
+        if lm is None:
             return None
-        shape = predictor(gray, rects[0])
-        shape = shape_to_np(shape)
-
-        lefteye = np.mean(shape[[37, 38, 40, 41], :], axis=0)
-        righteye = np.mean(shape[[43, 44, 46, 47], :], axis=0)
-        nose = shape[30]
-        leftmouth = shape[48]
-        rightmouth = shape[54]
-        lm = np.stack([lefteye, righteye, nose, leftmouth, rightmouth])
     else:
         lm = landmarks
 
     img = Image.fromarray(im)
 
     # Choose oriented crop rectangle.
-    eye_avg = (lm[0] + lm[1]) * 0.5 + 0.5
-    mouth_avg = (lm[3] + lm[4]) * 0.5 + 0.5
-    eye_to_eye = lm[1] - lm[0]
-    eye_to_mouth = mouth_avg - eye_avg
-    x = eye_to_eye - rot90(eye_to_mouth)
-    x /= np.hypot(*x)
-    x *= max(np.hypot(*eye_to_eye) * 2.0, np.hypot(*eye_to_mouth) * 1.8)
-    y = rot90(x)
-    c = eye_avg + eye_to_mouth * 0.1
-    quad = np.stack([c - x - y, c - x + y, c + x + y, c + x - y])
-    zoom = 128 / (np.hypot(*x) * 2)
+    quad, zoom = crop_quad(lm)
+
+    if outsize is not None:
+        # the 1024 crop samples the quad shifted by half the pixels it shrinks
+        # the frame by, see shrink_image; shift it alike for parity
+        shrink = int(np.floor(0.5 / zoom))
+        if shrink > 1:
+            quad += (shrink - 1) * 0.5
+        # crop first, then only the crop is shrunk
+        img, quad, _ = crop_image(img, quad, zoom)
+        # frame pixels per output pixel
+        shrink = 128 / (zoom * outsize)
+        if shrink > 1:
+            # quad in pixel centers of the shrunk crop
+            size = (max(int(np.round(img.size[0] / shrink)), 1), max(int(np.round(img.size[1] / shrink)), 1))
+            quad = (quad + 0.5) * (np.float64(size) / img.size) - 0.5
+            img = img.resize(size, Image.LANCZOS)
+            zoom *= shrink
+        border = max(int(np.round(128 * 0.1 / zoom)), 3)
+        img, quad = pad_image(img, quad, zoom, border)
+        img = img.transform((outsize, outsize), Image.QUAD, (quad + 0.5).flatten(), Image.BICUBIC)
+        return img, lm
 
     # Shrink.
     shrink = int(np.floor(0.5 / zoom))
-    if shrink > 1:
-        size = (int(np.round(float(img.size[0]) / shrink)), int(np.round(float(img.size[1]) / shrink)))
-        img = img.resize(size, Image.ANTIALIAS)
-        quad /= shrink
-        zoom *= shrink
+    img, quad, zoom = shrink_image(img, quad, zoom, shrink)
 
     # Crop.
-    border = max(int(np.round(128 * 0.1 / zoom)), 3)
-    crop = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-    crop = (max(crop[0] - border, 0), max(crop[1] - border, 0), min(crop[2] + border, img.size[0]), min(crop[3] + border, img.size[1]))
-    if crop[2] - crop[0] < img.size[0] or crop[3] - crop[1] < img.size[1]:
-        img = img.crop(crop)
-        quad -= crop[0:2]
+    img, quad, border = crop_image(img, quad, zoom)
 
     # Simulate super-resolution.
     superres = int(np.exp2(np.ceil(np.log2(zoom))))
@@ -164,21 +164,52 @@ def celebahq_crop(im, landmarks=None):
         zoom /= superres
 
     # Pad.
-    pad = (int(np.floor(min(quad[:,0]))), int(np.floor(min(quad[:,1]))), int(np.ceil(max(quad[:,0]))), int(np.ceil(max(quad[:,1]))))
-    pad = (max(-pad[0] + border, 0), max(-pad[1] + border, 0), max(pad[2] - img.size[0] + border, 0), max(pad[3] - img.size[1] + border, 0))
-    if max(pad) > border - 4:
-        pad = np.maximum(pad, int(np.round(128 * 0.3 / zoom)))
-        img = np.pad(np.float32(img), ((pad[1], pad[3]), (pad[0], pad[2]), (0, 0)), 'reflect')
-        h, w, _ = img.shape
-        y, x, _ = np.mgrid[:h, :w, :1]
-        mask = 1.0 - np.minimum(np.minimum(np.float32(x) / pad[0], np.float32(y) / pad[1]), np.minimum(np.float32(w-1-x) / pad[2], np.float32(h-1-y) / pad[3]))
-        blur = 128 * 0.02 / zoom
-        img += (scipy.ndimage.gaussian_filter(img, [blur, blur, 0]) - img) * np.clip(mask * 3.0 + 1.0, 0.0, 1.0)
-        img += (np.median(img, axis=(0,1)) - img) * np.clip(mask, 0.0, 1.0)
-        img = Image.fromarray(np.uint8(np.clip(np.round(img), 0, 255)), 'RGB')
-        quad += pad[0:2]
+    img, quad = pad_image(img, quad, zoom, border)
 
     # Transform.
     img = img.transform((512, 512), Image.QUAD, (quad + 0.5).flatten(), Image.BILINEAR)
     img = img.resize((1024, 1024), Image.ANTIALIAS)
     return img, lm
+
+# bound of crop_parity: the fast path is not pixel identical to resizing
+# the 1024 crop, test frames differ by a mean of 1.2-2.1 and at most 20-50
+# levels, on edges
+PARITY_MAX_DIFF = 64
+PARITY_MEAN_DIFF = 3.
+
+def crop_parity(im, landmarks=None, outsize=256, check=True):
+    '''
+    (max, mean) absolute uint8 difference of celebahq_crop(im, outsize=outsize)
+    to the 1024 crop resized to outsize with LANCZOS, None without a face.
+    With check, raises AssertionError beyond PARITY_MAX_DIFF or PARITY_MEAN_DIFF.
+    '''
+    if landmarks is None:
+        landmarks = five_points(im)
+        if landmarks is None:
+            return None
+    reference = celebahq_crop(im, landmarks)[0].resize((outsize, outsize), Image.LANCZOS)
+    fast = celebahq_crop(im, landmarks, outsize)[0]
+    diff = np.abs(np.int16(reference) - np.int16(fast))
+    if check:
+        assert diff.max() <= PARITY_MAX_DIFF and diff.mean() <= PARITY_MEAN_DIFF, \
+            'fast crop differs by max %d, mean %.3f' % (diff.max(), diff.mean())
+    return int(diff.max()), float(diff.mean())
+
+if __name__ == '__main__':
+    import argparse
+    from skimage import io
+    parser = argparse.ArgumentParser(description='celebahq_crop outsize fast path against the 1024 crop')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--outsize', type=int, nargs='+', default=[128, 256])
+    args = parser.parse_args()
+    for outsize in args.outsize:
+        results = [r for r in (crop_parity(io.imread(p), outsize=outsize, check=False)
+                               for p in args.images) if r is not None]
+        if results:
+            worst = max(r[0] for r in results), max(r[1] for r in results)
+            ok = worst[0] <= PARITY_MAX_DIFF and worst[1] <= PARITY_MEAN_DIFF
+            print('outsize %d: %d faces, max abs diff %d, mean abs diff %.3f (worst %.3f), %s'
+                  % (outsize, len(results), worst[0], np.mean([r[1] for r in results]), worst[1],
+                     'within tolerance' if ok else 'OUT OF TOLERANCE'))
+            if not ok:
+                raise SystemExit(1)
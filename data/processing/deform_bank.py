@@ -0,0 +1,101 @@
+import random
+import numpy as np
+import cv2
+import elasticdeform
+
+
+def random_displacement(rng, sigma=4, points=6):
+    """ control grid displacement drawn like elasticdeform.deform_random_grid """
+    return rng.randn(2, points, points) * sigma
+
+
+def deform_maps(shape, displacement):
+    """Sampling maps of an elastic deformation for cv2.remap.
+
+    The B-spline upsampling of the control grid is applied to the identity
+    coordinates, which gives where each output pixel samples the input.
+    """
+    ys, xs = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float64)
+    map_y, map_x = elasticdeform.deform_grid(
+        [ys, xs], displacement, order=1, mode='nearest')
+    # fixed point maps are smaller and remap faster than float32 ones
+    return cv2.convertMaps(map_x.astype(np.float32), map_y.astype(np.float32),
+                           cv2.CV_16SC2)
+
+
+def random_deform_maps(shape, sigma=4, points=6, rng=np.random):
+    """Sampling maps of one random elastic deformation for cv2.remap.
+
+    The displacement is drawn and interpolated exactly like
+    elasticdeform.deform_random_grid(x, sigma, points).
+    """
+    return deform_maps(shape, random_displacement(rng, sigma, points))
+
+
+def remap_mask(mask, maps):
+    map1, map2 = maps
+    return cv2.remap(mask, map1, map2, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+class ElasticDeformBank(object):
+    """Bank of precomputed elastic deformations of the I2G blending masks.
+
+    Fields are built lazily per mask shape, the first use of a shape
+    generates the whole bank for it. After every refresh draws the drawn
+    field is replaced by a new one, 0 keeps the bank fixed. Fields are
+    generated from (seed, shape, counter) and picked with the random
+    module, so seeded samples of a fixed bank are reproducible in any
+    worker; refreshing depends on how many draws a worker made.
+    """
+
+    def __init__(self, size=64, refresh=0, sigma=4, points=6, seed=0):
+        self.size = size
+        self.refresh = refresh
+        self.sigma = sigma
+        self.points = points
+        self.seed = seed
+        self.banks = {}
+        self.generated = {}
+        self.draws = 0
+
+    def displacement(self, shape, n):
+        """ control grid displacement of the n-th field generated for shape """
+        rng = np.random.RandomState([self.seed, shape[0], shape[1], n])
+        return random_displacement(rng, self.sigma, self.points)
+
+    def new_field(self, shape):
+        n = self.generated.get(shape, 0)
+        self.generated[shape] = n + 1
+        return n, deform_maps(shape, self.displacement(shape, n))
+
+    def get_bank(self, shape):
+        if shape not in self.banks:
+            self.banks[shape] = [self.new_field(shape) for _ in range(self.size)]
+        return self.banks[shape]
+
+    def draw(self, shape):
+        """ (n, remap maps) of a random field of the bank, n identifies it """
+        bank = self.get_bank(shape)
+        i = random.randrange(len(bank))
+        self.draws += 1
+        field = bank[i]
+        if self.refresh and self.draws % self.refresh == 0:
+            bank[i] = self.new_field(shape)
+        return field
+
+    def deform(self, mask):
+        """ deformed copy of a 2d mask """
+        _, maps = self.draw(mask.shape[:2])
+        return remap_mask(mask, maps)
+
+
+def get_deform_bank(opt):
+    """ ElasticDeformBank from the deform_bank options, None if disabled """
+    size = getattr(opt, 'deform_bank', 0)
+    if not size:
+        return None
+    seed = getattr(opt, 'seed', None)
+    return ElasticDeformBank(size=size,
+                             refresh=getattr(opt, 'deform_bank_refresh', 0),
+                             seed=0 if seed is None else seed)
@@ -0,0 +1,395 @@
+'''
+Shared dlib face detection for the preprocessing and the datasets.
+
+The HOG detector runs on a downscaled grayscale frame, its rectangles are
+mapped back to full resolution and the shape predictor runs there. How
+far the frame is downscaled is a policy spec:
+
+    full            full resolution with 1x upsampling, as before
+    scale:<s>       resize by s
+    max_side:<px>   longer side at most px
+    face_size:<f>   faces expected to be f pixels wide, or f times the
+                    shorter side for f <= 1, are brought down to 1.5x the
+                    smallest face the detector finds (80px, halved per
+                    upsampling)
+
+and ,upsample:<n> sets the detector upsampling of the other policies
+(default 0), e.g. 'max_side:640,upsample:1'. The models are loaded on
+first use, so importing this module is cheap, and set_policy changes the
+detector of find_faces and celebahq_crop in this process and in pool
+workers forked after it.
+
+    python -m data.processing.face_detection frames/ --sample 200 \
+        --policies full scale:0.5 max_side:640 face_size:0.4
+
+reports the speed of each policy, how many of the faces found by 'full'
+it finds and its landmark error (mean point distance over the
+inter-ocular distance). On 200 1280x720 frames with faces 0.15-0.45 of
+the frame height, composed from still photos, one core:
+
+    full                 470 ms/frame            recall 1      error 0
+    full,upsample:0      119 ms/frame   x3.8     recall 1      error .015
+    scale:0.5             31 ms/frame   x15      recall .96    error .015
+    max_side:640          31 ms/frame   x15      recall .96    error .015
+    face_size:0.3         42 ms/frame   x11      recall .995   error .013
+    face_size:0.15       119 ms/frame   x3.9     recall 1      error .015
+
+Most of the error comes from the predictor starting on a different
+rectangle, full,upsample:0 does not downscale at all.
+
+LandmarkTracker detects only on keyframes of a video and runs just the
+shape predictor in between. With --track the same report compares it to
+detecting on every frame of the first --sample frames of each video
+directory, with --track --synthetic on videos made by moving still
+images (synthetic_video). On 8 such 1280x720 videos of 150 frames,
+keyframe_interval 25, no re-detection was triggered by jitter or drift:
+
+    full            detect 461 ms/frame   track 21 ms/frame   x22   error .012
+    full, flow                            track 25 ms/frame   x18   error .013
+    max_side:640    detect  34 ms/frame   track 3.8 ms/frame  x8.8  error .013
+
+with 0.04 detections per frame and the error against per frame
+detection below .08 on every frame.
+'''
+
+import os
+import time
+import random
+import numpy as np
+import cv2
+
+PREDICTOR_PATH = 'resources/shape_predictor_68_face_landmarks.dat'
+# smallest face dlib's HOG detector finds without upsampling
+MIN_FACE = 80
+
+_models = {}
+
+
+def get_detector():
+    if 'detector' not in _models:
+        import dlib
+        _models['detector'] = dlib.get_frontal_face_detector()
+    return _models['detector']
+
+
+def get_predictor():
+    if 'predictor' not in _models:
+        import dlib
+        _models['predictor'] = dlib.shape_predictor(PREDICTOR_PATH)
+    return _models['predictor']
+
+
+def shape_to_np(shape, dtype="int"):
+    coords = np.zeros((68, 2), dtype=dtype)
+    for i in range(0, 68):
+        coords[i] = (shape.part(i).x, shape.part(i).y)
+    return coords
+
+
+class FaceDetector(object):
+    ''' dlib detection on a downscaled frame, landmarks at full resolution '''
+
+    def __init__(self, policy='full'):
+        self.spec = policy
+        self.policy, self.value, self.upsample = self.parse(policy)
+
+    @staticmethod
+    def parse(spec):
+        ''' (policy, value, upsample) of a policy spec '''
+        fields = dict(field.split(':') for field in spec.split(',') if ':' in field)
+        if spec.split(',')[0] == 'full':
+            return 'full', 1., int(fields.get('upsample', 1))
+        upsample = int(fields.pop('upsample', 0))
+        assert len(fields) == 1, 'bad face detection policy %r' % spec
+        (policy, value), = fields.items()
+        assert policy in ['scale', 'max_side', 'face_size'], 'bad face detection policy %r' % spec
+        return policy, float(value), upsample
+
+    def detection_scale(self, shape):
+        h, w = shape[:2]
+        if self.policy == 'full':
+            return 1.
+        if self.policy == 'scale':
+            return min(self.value, 1.)
+        if self.policy == 'max_side':
+            return min(self.value / max(h, w), 1.)
+        face = self.value * min(h, w) if self.value <= 1 else self.value
+        return min(1.5 * MIN_FACE / 2 ** self.upsample / face, 1.)
+
+    def detect(self, gray):
+        ''' dlib rectangles of the faces in full resolution coordinates '''
+        import dlib
+        scale = self.detection_scale(gray.shape)
+        if scale >= 1:
+            return list(get_detector()(gray, self.upsample))
+        small = cv2.resize(gray, (max(int(round(gray.shape[1] * scale)), 1),
+                                  max(int(round(gray.shape[0] * scale)), 1)),
+                           interpolation=cv2.INTER_AREA)
+        fx, fy = gray.shape[1] / small.shape[1], gray.shape[0] / small.shape[0]
+        return [dlib.rectangle(int(round(r.left() * fx)), int(round(r.top() * fy)),
+                               int(round(r.right() * fx)), int(round(r.bottom() * fy)))
+                for r in get_detector()(small, self.upsample)]
+
+    def landmarks(self, im):
+        ''' (68, 2) landmarks of the first face of an RGB frame, None without a face '''
+        gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
+        rects = self.detect(gray)
+        if not rects:
+            return None
+        return shape_to_np(get_predictor()(gray, rects[0]))
+
+
+_detector = FaceDetector()
+
+
+def set_policy(policy):
+    ''' policy of the shared detector, see the module docstring '''
+    global _detector
+    _detector = FaceDetector(policy)
+
+
+def face_landmarks(im):
+    ''' landmarks of the first face of an RGB frame with the shared detector '''
+    return _detector.landmarks(im)
+
+
+def inter_ocular(shape):
+    return max(np.linalg.norm(shape[36:42].mean(0) - shape[42:48].mean(0)), 1.)
+
+
+class LandmarkTracker(object):
+    '''Landmarks of consecutive frames of one video, detecting only on keyframes.
+
+    A detection frame runs the detector and the predictor, the frames after
+    it run only the predictor, on the last face rectangle moved along with
+    the face: recentered on the landmarks of the last frame, and with flow
+    also shifted by the median optical flow of those landmarks. The detector
+    runs again every keyframe_interval frames, after a frame without a
+    face, and when the fit degrades: the landmarks move more than
+    max_jitter inter-ocular distances on average, or their bounding box
+    drifts in position or size by more than max_drift of the rectangle
+    against the detection frame.
+    '''
+
+    def __init__(self, detector=None, keyframe_interval=25, max_jitter=0.25,
+                 max_drift=0.15, flow=False):
+        self.detector = _detector if detector is None else detector
+        self.keyframe_interval = keyframe_interval
+        self.max_jitter = max_jitter
+        self.max_drift = max_drift
+        self.flow = flow
+        self.stats = dict(frames=0, detections=0, jitter=0, drift=0, no_face=0)
+        self.reset()
+
+    def reset(self):
+        self.rect = None
+        self.shape = None
+        self.gray = None
+        self.fit = None
+        self.since_detection = 0
+
+    @staticmethod
+    def box_fit(shape, rect):
+        ''' landmark bounding box center and size relative to the rectangle '''
+        lo, hi = shape.min(0), shape.max(0)
+        size = np.float64([max(rect.width(), 1), max(rect.height(), 1)])
+        corner = np.float64([rect.left(), rect.top()])
+        return ((lo + hi) / 2 - corner) / size, (hi - lo) / size
+
+    def moved_rect(self, gray):
+        ''' last rectangle moved by the face motion since the last frame '''
+        import dlib
+        shift = np.zeros(2)
+        if self.flow:
+            points = self.shape.astype(np.float32).reshape(-1, 1, 2)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray, points, None)
+            ok = status.reshape(-1) == 1
+            if ok.any():
+                shift = np.median((moved - points).reshape(-1, 2)[ok], axis=0)
+        dx, dy = int(round(shift[0])), int(round(shift[1]))
+        return dlib.rectangle(self.rect.left() + dx, self.rect.top() + dy,
+                              self.rect.right() + dx, self.rect.bottom() + dy)
+
+    def detect(self, gray):
+        rects = self.detector.detect(gray)
+        self.stats['detections'] += 1
+        if not rects:
+            self.stats['no_face'] += 1
+            self.reset()
+            return None
+        self.rect = rects[0]
+        self.shape = shape_to_np(get_predictor()(gray, self.rect))
+        self.fit = self.box_fit(self.shape, self.rect)
+        self.gray = gray
+        self.since_detection = 0
+        return self.shape
+
+    def track(self, gray):
+        ''' landmarks from the predictor alone, None if the fit degraded '''
+        rect = self.moved_rect(gray)
+        shape = shape_to_np(get_predictor()(gray, rect))
+        jitter = np.linalg.norm(shape - self.shape, axis=1).mean() / inter_ocular(self.shape)
+        if jitter > self.max_jitter:
+            self.stats['jitter'] += 1
+            return None
+        center, size = self.box_fit(shape, rect)
+        if (np.abs(center - self.fit[0]).max() > self.max_drift or
+                np.abs(size / self.fit[1] - 1).max() > self.max_drift):
+            self.stats['drift'] += 1
+            return None
+        # recenter the rectangle on the face like on the detection frame
+        import dlib
+        dx, dy = np.round((center - self.fit[0]) * [rect.width(), rect.height()]).astype(int)
+        rect = dlib.rectangle(rect.left() + dx, rect.top() + dy,
+                              rect.right() + dx, rect.bottom() + dy)
+        self.rect, self.shape, self.gray = rect, shape, gray
+        self.since_detection += 1
+        return shape
+
+    def landmarks(self, im):
+        ''' (68, 2) landmarks of the next frame of the video, None without a face '''
+        self.stats['frames'] += 1
+        gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
+        if self.rect is not None and self.since_detection + 1 < self.keyframe_interval:
+            shape = self.track(gray)
+            if shape is not None:
+                return shape
+        return self.detect(gray)
+
+
+def list_frames(paths, sample, seed=0):
+    frames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                frames += [os.path.join(root, f) for f in files
+                           if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+        else:
+            frames.append(path)
+    frames.sort()
+    random.Random(seed).shuffle(frames)
+    return frames[:sample]
+
+
+def compare(frames, policies):
+    '''Per policy (seconds per frame, recall, landmark errors), and the
+    number of faces found by 'full', the reference of recall and errors.
+    '''
+    from PIL import Image
+    images = [np.array(Image.open(f).convert('RGB')) for f in frames]
+    results = {}
+    reference = None
+    for spec in ['full'] + [p for p in policies if p != 'full']:
+        detector = FaceDetector(spec)
+        begin = time.perf_counter()
+        found = [detector.landmarks(im) for im in images]
+        seconds = (time.perf_counter() - begin) / max(len(images), 1)
+        if reference is None:
+            reference = found
+        errors = []
+        for ref, lm in zip(reference, found):
+            if ref is None or lm is None:
+                continue
+            # mean point distance over the inter-ocular distance
+            errors.append(np.linalg.norm(ref - lm, axis=1).mean() / inter_ocular(ref))
+        hits = sum(ref is not None and lm is not None for ref, lm in zip(reference, found))
+        total = sum(ref is not None for ref in reference)
+        results[spec] = seconds, hits / max(total, 1), np.array(errors)
+    return results, sum(ref is not None for ref in reference)
+
+
+def load_video(video, sample):
+    ''' first sample frames of a video directory '''
+    from PIL import Image
+    names = sorted(f for f in os.listdir(video) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    return [np.array(Image.open(os.path.join(video, f)).convert('RGB')) for f in names[:sample]]
+
+
+def synthetic_video(im, frames, shift=0.05, zoom=0.08, roll=4., noise=2., seed=0):
+    '''frames of a still image moving like a talking head: a smooth shift
+    by up to shift of the frame, zoom, roll in degrees and sensor noise.
+    '''
+    rng = np.random.RandomState(seed)
+    h, w = im.shape[:2]
+    video = []
+    for t in range(frames):
+        a = 2 * np.pi * t / 75
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), roll * np.sin(1.3 * a), 1 + zoom * np.sin(a / 2))
+        M[:, 2] += (shift * w * np.sin(a), shift * h * np.sin(1.7 * a))
+        frame = cv2.warpAffine(im, M, (w, h), borderMode=cv2.BORDER_REFLECT)
+        video.append(np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8))
+    return video
+
+
+def compare_tracking(videos, policy='full', **tracker_args):
+    '''Tracked against per frame landmarks on lists of consecutive frames:
+    (seconds per frame with detection, with the tracker, summed tracker
+    stats, landmark errors).
+    '''
+    detector = FaceDetector(policy)
+    detect_seconds = track_seconds = 0.
+    errors = []
+    stats = dict(frames=0, detections=0, jitter=0, drift=0, no_face=0)
+    for images in videos:
+        begin = time.perf_counter()
+        reference = [detector.landmarks(im) for im in images]
+        detect_seconds += time.perf_counter() - begin
+        tracker = LandmarkTracker(detector, **tracker_args)
+        begin = time.perf_counter()
+        tracked = [tracker.landmarks(im) for im in images]
+        track_seconds += time.perf_counter() - begin
+        for ref, lm in zip(reference, tracked):
+            if ref is not None and lm is not None:
+                errors.append(np.linalg.norm(ref - lm, axis=1).mean() / inter_ocular(ref))
+        for k in stats:
+            stats[k] += tracker.stats[k]
+    frames = max(stats['frames'], 1)
+    return detect_seconds / frames, track_seconds / frames, stats, np.array(errors)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='speed and accuracy of face detection policies')
+    parser.add_argument('frames', nargs='+', help='frame files or directories')
+    parser.add_argument('--sample', type=int, default=200, help='frames drawn at random')
+    parser.add_argument('--policies', nargs='+', default=['full', 'scale:0.5', 'max_side:640', 'face_size:0.3'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--track', action='store_true', help='compare LandmarkTracker to per frame detection, frames are video directories')
+    parser.add_argument('--keyframe_interval', type=int, default=25)
+    parser.add_argument('--flow', action='store_true')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='with --track, frames are still images each moved into a video of --sample frames')
+    args = parser.parse_args()
+
+    if args.track:
+        if args.synthetic:
+            from PIL import Image
+            videos = []
+            for path in args.frames:
+                im = np.array(Image.open(path).convert('RGB'))
+                # at most 1280x720, as the frames of FF++ videos
+                scale = min(1280 / im.shape[1], 720 / im.shape[0], 1)
+                im = cv2.resize(im, (int(im.shape[1] * scale), int(im.shape[0] * scale)),
+                                interpolation=cv2.INTER_AREA)
+                videos.append(synthetic_video(im, args.sample, seed=args.seed))
+        else:
+            videos = [load_video(video, args.sample) for video in args.frames]
+        for spec in args.policies:
+            detect, track, stats, errors = compare_tracking(
+                videos, spec, keyframe_interval=args.keyframe_interval, flow=args.flow)
+            print('%-28s detect %7.1f ms/frame  track %7.1f ms/frame  x%5.2f  %.3f detections/frame '
+                  '(%d jitter, %d drift, %d no face)  landmark error %.4f mean %.4f max'
+                  % (spec, detect * 1e3, track * 1e3, detect / max(track, 1e-9),
+                     stats['detections'] / max(stats['frames'], 1), stats['jitter'],
+                     stats['drift'], stats['no_face'],
+                     errors.mean() if len(errors) else 0, errors.max() if len(errors) else 0))
+        raise SystemExit
+
+    frames = list_frames(args.frames, args.sample, args.seed)
+    results, faces = compare(frames, args.policies)
+    full = results['full'][0]
+    print('%d frames, %d faces found at full resolution' % (len(frames), faces))
+    for spec, (seconds, recall, errors) in results.items():
+        print('%-28s %7.1f ms/frame  x%5.2f  recall %.3f  landmark error %.4f mean %.4f max'
+              % (spec, seconds * 1e3, full / max(seconds, 1e-9), recall,
+                 errors.mean() if len(errors) else 0, errors.max() if len(errors) else 0))
@@ -1,99 +1,315 @@
+'''
+Align the frames of a face forensics split with celebahq_crop.
+
+    python -m data.processing.faceforensics_process_frames \
+        --source_dir_original original_sequences/youtube/c23/frames \
+        --source_dir_manipulated manipulated_sequences \
+        --output_dir faceforensics_aligned --split val.json --workers 8
+
+Every video of the split is one work unit of a process pool. A finished
+video that saved frames, or had no failures, gets
+<output_dir>/done/<split>/<video>/done.txt (pidfile.mark_job_done) and is
+skipped by later runs, --redo processes it again. Frames that fail
+are appended to <output_dir>/failures_<split>.jsonl, one json object per
+frame with the video, frame, stage and reason, and counted by reason in
+the summary printed at the end.
+
+With --source_type video the mp4 files are decoded directly, the original
+video (<source_dir_original>/<target>.mp4) and the fakes
+(<source_dir_manipulated>/<method>/c23/videos/<target>_<source>.mp4) in
+lockstep, so no frames have to be extracted with ffmpeg first. Frame j of
+a fake is aligned with frame j of the original, --stride and
+--frames_per_video bound the frames used per video. With --track the
+faces are detected on keyframes only and tracked in between, see
+face_detection.LandmarkTracker.
+'''
+
 import argparse
-from genericpath import isfile
 import os
-import numpy as np
+import time
+import json
+import traceback
+import multiprocessing
+import cv2
+from collections import Counter
 from tqdm import tqdm
 from PIL import Image
-import json
-import sys
-import numpy as np
-from data.processing.celebahq_crop import celebahq_crop
 from skimage import io
+from data.processing.celebahq_crop import celebahq_crop, five_points_of, PARITY_MAX_DIFF
+from data.processing import face_detection
+from utils import pidfile
 
-parser = argparse.ArgumentParser(description='Process and align face forensics frames')
-parser.add_argument('--source_dir_manipulated', required=True, help='source videos directory, e.g. manipulated_sequences/Deepfakes/c23/frames')
-parser.add_argument('--source_dir_original', required=True, help='original videos directory, e.g. original_sequences/youtube/c23/frames')
-parser.add_argument('--outsize', type=int, default=128, help='resize to this size')
-parser.add_argument('--output_dir', required=True, help='output directory')
-parser.add_argument('--split', default='val.json', help='Path to split json file')
+# output dir and name under manipulated_sequences of each fake method
+METHODS = [('DF', 'Deepfakes'), ('F2F', 'Face2Face'), ('FS', 'FaceSwap'), ('NT', 'NeuralTextures')]
+# methods whose frames are skipped when missing instead of failing the frame
+OPTIONAL = ['F2F', 'FS', 'NT']
+# for val/test partitions, just take this many detected frames per video
+# unless --frames_per_video is set
+EVAL_FRAMES = 100
 
-args = parser.parse_args()
-rnd = np.random.RandomState(0)
 
+class FrameError(Exception):
+    ''' failure of a frame at a stage of process_frame '''
 
-with open(args.split) as f:
-    split = json.load(f)
-split_name = os.path.splitext(os.path.basename(args.split))[0]
+    def __init__(self, stage, reason, message=''):
+        super(FrameError, self).__init__('%s: %s %s' % (stage, reason, message))
+        self.stage = stage
+        self.reason = reason
+        self.message = message
 
-outdir = args.output_dir
-os.makedirs(outdir, exist_ok=True)
-os.makedirs(os.path.join(outdir, 'original', split_name), exist_ok=True)
-os.makedirs(os.path.join(outdir, 'DF', split_name), exist_ok=True)
-os.makedirs(os.path.join(outdir, 'F2F', split_name), exist_ok=True)
-os.makedirs(os.path.join(outdir, 'FS', split_name), exist_ok=True)
-os.makedirs(os.path.join(outdir, 'NT', split_name), exist_ok=True)
-# os.makedirs(os.path.join(outdir, 'detections', split_name), exist_ok=True)
 
-for i, s in enumerate(tqdm(split)):
-    vidname = '_'.join(s)
-    vidname_orig = s[0] # take target sequence for original videos
-    # print("%d: %s" % (i, vidname))
+def run_stage(stage, fn, *args):
+    try:
+        return fn(*args)
+    except FrameError:
+        raise
+    except Exception as e:
+        raise FrameError(stage, type(e).__name__, str(e))
+
+
+def crop(im, outsize, landmarks=None, fast=False):
+    out = celebahq_crop(im, landmarks, outsize if fast else None)
+    if out is None:
+        raise FrameError('detect', 'no_face')
+    if fast:
+        return out
+    return out[0].resize((outsize, outsize), Image.LANCZOS), out[1]
+
+
+def done_dir(outdir, split_name, vidname):
+    return os.path.join(outdir, 'done', split_name, vidname)
+
+
+def frames_from_dirs(args, vidname, vidname_orig):
+    ''' (j, frame name, read) of the extracted frames of a video '''
     vidpath_orig = os.path.join(args.source_dir_original, vidname_orig)
+    for j, frame in enumerate(sorted(os.listdir(vidpath_orig))):
+        if j % args.stride:
+            continue
+
+        def read(name, frame=frame):
+            if name == 'original':
+                return run_stage('read', io.imread, os.path.join(vidpath_orig, frame))
+            path = os.path.join(args.source_dir_manipulated, dict(METHODS)[name],
+                                'c23', 'frames', vidname, frame)
+            if name in OPTIONAL and not os.path.isfile(path):
+                return None
+            return run_stage('read', io.imread, path)
+        yield j, frame, read
+
+
+def video_paths(args, vidname, vidname_orig):
+    paths = [('original', os.path.join(args.source_dir_original, vidname_orig + '.mp4'))]
+    for name, method in METHODS:
+        paths.append((name, os.path.join(args.source_dir_manipulated, method,
+                                         'c23', 'videos', vidname + '.mp4')))
+    return paths
+
+
+def frames_from_videos(args, vidname, vidname_orig):
+    '''(j, j, read) of the original and fake videos decoded in lockstep
+
+    Frame j of every video is frame j of the original, frames off the
+    stride are only grabbed, not decoded. A fake that is missing or ends
+    early has no frame, which fails the frame for DF and is skipped for
+    the others.
+    '''
+    captures = []
+    for name, path in video_paths(args, vidname, vidname_orig):
+        if os.path.isfile(path):
+            captures.append((name, cv2.VideoCapture(path)))
+    try:
+        j = 0
+        while True:
+            decode = j % args.stride == 0
+            frames = {}
+            for name, capture in captures:
+                if not capture.grab():
+                    continue
+                if decode:
+                    ok, im = capture.retrieve()
+                    frames[name] = cv2.cvtColor(im, cv2.COLOR_BGR2RGB) if ok else None
+            if decode and 'original' not in frames:
+                break
+            if decode:
+
+                def read(name, frames=frames):
+                    if name not in frames:
+                        if name in OPTIONAL:
+                            return None
+                        raise FrameError('read', 'missing_frame')
+                    if frames[name] is None:
+                        raise FrameError('read', 'decode_failed')
+                    return frames[name]
+                yield j, j, read
+            j += 1
+    finally:
+        for _, capture in captures:
+            capture.release()
+
+
+def process_frame(args, split_name, vidname, j, read, tracker=None):
+    ''' crop the original and the fakes of one frame, then save them all '''
+    orig = read('original')
+    landmarks = None
+    if tracker is not None:
+        shape = run_stage('detect', tracker.landmarks, orig)
+        if shape is None:
+            raise FrameError('detect', 'no_face')
+        landmarks = five_points_of(shape)
+    cropped = {}
+    cropped['original'], landmarks = run_stage('crop', crop, orig, args.outsize, landmarks, args.fast_crop)
+    for name, _ in METHODS:
+        im = read(name)
+        if im is None:
+            continue
+        # use original landmarks
+        cropped[name] = run_stage('crop', crop, im, args.outsize, landmarks, args.fast_crop)[0]
+    for name, im in cropped.items():
+        run_stage('save', im.save, os.path.join(
+            args.output_dir, name, split_name, '%s_%03d.png' % (vidname, j)))
+
+
+def frame_budget(args, split_name):
+    ''' max saved frames per video, None for all '''
+    if args.frames_per_video > 0:
+        return args.frames_per_video
+    return EVAL_FRAMES if split_name in ['test', 'val'] else None
+
+
+def process_video(task):
+    ''' all frames of a video, returns its summary and failures '''
+    args, split_name, s = task
+    vidname = '_'.join(s)
+    vidname_orig = s[0]  # take target sequence for original videos
+    result = dict(video=vidname, frames=0, failures=[], seconds=0., status='done')
+    if args.source_type == 'video':
+        source = os.path.join(args.source_dir_original, vidname_orig + '.mp4')
+        exists, frames = os.path.isfile(source), frames_from_videos
+    else:
+        source = os.path.join(args.source_dir_original, vidname_orig)
+        exists, frames = os.path.isdir(source), frames_from_dirs
+    if not exists:
+        result['status'] = 'missing'
+        result['failures'].append(dict(video=vidname, frame=None, stage='list',
+                                       reason='missing_video', message=source))
+        return result
+    budget = frame_budget(args, split_name)
+    tracker = None
+    if args.track:
+        tracker = face_detection.LandmarkTracker(
+            keyframe_interval=args.keyframe_interval, flow=args.track_flow)
+    begin = time.time()
+    for j, frame, read in frames(args, vidname, vidname_orig):
+        try:
+            process_frame(args, split_name, vidname, j, read, tracker)
+        except FrameError as e:
+            result['failures'].append(dict(video=vidname, frame=frame, stage=e.stage,
+                                           reason=e.reason, message=e.message))
+            continue
+        except Exception as e:
+            result['failures'].append(dict(video=vidname, frame=frame, stage='unknown',
+                                           reason=type(e).__name__,
+                                           message=traceback.format_exc()))
+            continue
+        result['frames'] += 1
+        if result['frames'] == budget:
+            break
+    result['seconds'] = time.time() - begin
+    if tracker is not None:
+        result['detections'] = tracker.stats['detections']
+        result['tracked'] = tracker.stats['frames']
+    # a video without any saved frame and with failures is retried by the next run
+    if result['frames'] or not result['failures']:
+        marker_dir = done_dir(args.output_dir, split_name, vidname)
+        os.makedirs(marker_dir, exist_ok=True)
+        pidfile.mark_job_done(marker_dir)
+    else:
+        result['status'] = 'failed'
+    return result
+
+
+def summary(results, skipped, failures, seconds):
+    frames = sum(r['frames'] for r in results)
+    worker_seconds = sum(r['seconds'] for r in results)
+    lines = ['[faceforensics]: %d videos processed, %d already done, %d missing, '
+             '%d without saved frames' % (
+                 sum(r['status'] == 'done' for r in results), skipped,
+                 sum(r['status'] == 'missing' for r in results),
+                 sum(r['status'] == 'failed' for r in results)),
+             '  %d frames in %.1fs, %.2f frames/s (%.2f frames/s per worker)'
+             % (frames, seconds, frames / max(seconds, 1e-9),
+                frames / max(worker_seconds, 1e-9)),
+             '  %d failures' % sum(failures.values())]
+    tracked = sum(r.get('tracked', 0) for r in results)
+    if tracked:
+        lines.insert(2, '  %d detections for %d tracked frames'
+                     % (sum(r.get('detections', 0) for r in results), tracked))
+    for (stage, reason), count in failures.most_common():
+        lines.append('    %6d  %s: %s' % (count, stage, reason))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process and align face forensics frames')
+    parser.add_argument('--source_dir_manipulated', required=True, help='manipulated videos directory, e.g. manipulated_sequences, holding <method>/c23/frames or with --source_type video <method>/c23/videos')
+    parser.add_argument('--source_dir_original', required=True, help='original videos directory, e.g. original_sequences/youtube/c23/frames or with --source_type video original_sequences/youtube/c23/videos')
+    parser.add_argument('--source_type', default='frames', choices=['frames', 'video'], help='frames: extracted frame directories, video: decode the mp4 files directly, without extracted frames')
+    parser.add_argument('--stride', type=int, default=1, help='use every stride-th frame of a video')
+    parser.add_argument('--frames_per_video', type=int, default=0, help='stop a video after this many saved frames, 0 saves all frames of train and %d of val and test' % EVAL_FRAMES)
+    parser.add_argument('--outsize', type=int, default=128, help='resize to this size')
+    parser.add_argument('--output_dir', required=True, help='output directory')
+    parser.add_argument('--split', default='val.json', help='Path to split json file')
+    parser.add_argument('--workers', type=int, default=4, help='videos processed in parallel, 0 runs in this process')
+    parser.add_argument('--fast_crop', action='store_true', help='warp the faces straight to outsize instead of resizing 1024 crops; faster but not pixel identical (mean abs diff about 2, max up to %d levels), see celebahq_crop.crop_parity' % PARITY_MAX_DIFF)
+    parser.add_argument('--face_detect', default='full', help='dlib face detection policy, e.g. max_side:640 or face_size:0.3, see face_detection.py')
+    parser.add_argument('--track', action='store_true', help='detect faces on keyframes only and track the landmarks in between with the shape predictor')
+    parser.add_argument('--keyframe_interval', type=int, default=25, help='--track: frames between forced detections')
+    parser.add_argument('--track_flow', action='store_true', help='--track: move the face rectangle by the optical flow of the landmarks')
+    parser.add_argument('--redo', action='store_true', help='process videos that already have a done marker')
+    args = parser.parse_args()
+    # before the pool forks, the workers keep the policy
+    face_detection.set_policy(args.face_detect)
+
+    with open(args.split) as f:
+        split = json.load(f)
+    split_name = os.path.splitext(os.path.basename(args.split))[0]
+
+    outdir = args.output_dir
+    for name in ['original'] + [name for name, _ in METHODS]:
+        os.makedirs(os.path.join(outdir, name, split_name), exist_ok=True)
+
+    tasks, skipped = [], 0
+    for s in split:
+        marker = os.path.join(done_dir(outdir, split_name, '_'.join(s)), 'done.txt')
+        if os.path.isfile(marker) and not args.redo:
+            skipped += 1
+            continue
+        tasks.append((args, split_name, s))
+
+    failures = Counter()
+    results = []
+    failure_log = os.path.join(outdir, 'failures_%s.jsonl' % split_name)
+    begin = time.time()
+    with open(failure_log, 'a') as log:
+        if args.workers > 0:
+            pool = multiprocessing.Pool(args.workers)
+            outputs = pool.imap_unordered(process_video, tasks)
+        else:
+            pool = None
+            outputs = map(process_video, tasks)
+        for result in tqdm(outputs, total=len(tasks)):
+            for failure in result.pop('failures'):
+                failures[failure['stage'], failure['reason']] += 1
+                log.write(json.dumps(failure) + '\n')
+            log.flush()
+            results.append(result)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print(summary(results, skipped, failures, time.time() - begin))
+    print('  failure log: %s' % failure_log)
+
 
-    if os.path.isdir(vidpath_orig):
-        original_video_frames = os.listdir(vidpath_orig)
-
-        counter = 0
-        for j, (orig) in enumerate(original_video_frames):
-            try:
-                # might return none or out of bounds error
-                    # use original landmarks
-
-                frame_path_DF = os.path.join(args.source_dir_manipulated, 'Deepfakes', 'c23', 'frames', vidname, orig)
-                frame_path_F2F = os.path.join(args.source_dir_manipulated, 'Face2Face', 'c23', 'frames', vidname, orig)
-                frame_path_FS = os.path.join(args.source_dir_manipulated, 'FaceSwap', 'c23', 'frames', vidname, orig)
-                frame_path_NT = os.path.join(args.source_dir_manipulated, 'NeuralTextures', 'c23', 'frames', vidname, orig)
-                orig_frame_path = os.path.join(args.source_dir_original, vidname_orig, orig)
-                frame_DF = io.imread(frame_path_DF)
-                orig = io.imread(orig_frame_path)
-                cropped_orig, landmarks = celebahq_crop(orig)
-                cropped_orig = cropped_orig.resize((args.outsize, args.outsize), Image.LANCZOS)
-                if isfile(frame_path_F2F):
-                    frame_F2F = io.imread(frame_path_F2F)
-                    cropped_F2F = (celebahq_crop(frame_F2F, landmarks)[0]
-                                .resize((args.outsize, args.outsize), Image.LANCZOS))
-                    cropped_F2F.save(os.path.join(outdir, 'F2F', split_name,
-                                            '%s_%03d.png' % (vidname, j)))
-                if isfile(frame_path_FS):
-                    frame_FS = io.imread(frame_path_FS)
-                    cropped_FS = (celebahq_crop(frame_FS, landmarks)[0]
-                                .resize((args.outsize, args.outsize), Image.LANCZOS))
-                    cropped_FS.save(os.path.join(outdir, 'FS', split_name,
-                                            '%s_%03d.png' % (vidname, j)))
-                if isfile(frame_path_NT):
-                    frame_NT = io.imread(frame_path_NT)
-                    cropped_NT = (celebahq_crop(frame_NT, landmarks)[0]
-                                .resize((args.outsize, args.outsize), Image.LANCZOS))
-                    cropped_NT.save(os.path.join(outdir, 'NT', split_name,
-                                            '%s_%03d.png' % (vidname, j)))
-                cropped_DF = (celebahq_crop(frame_DF, landmarks)[0]
-                            .resize((args.outsize, args.outsize), Image.LANCZOS))
-
-                # save the results
-                cropped_DF.save(os.path.join(outdir, 'DF', split_name,
-                                        '%s_%03d.png' % (vidname, j)))
-
-                cropped_orig.save(os.path.join(outdir, 'original', split_name,
-                                            '%s_%03d.png' % (vidname, j)))
-                # np.savez(os.path.join(outdir, 'detections', split_name,
-                #                       '%s_%03d.npz' % (vidname, j)),
-                #          lm=landmarks)
-                counter += 1
-
-                # for val/test partitions, just take 100 detected frames per video
-                if counter == 100 and split_name in ['test', 'val']:
-                    print("Processed 100 frames of %s" % vidname)
-                    print("Moving to next video")
-                    break
-            except:
-                print("Error:", sys.exc_info()[0])
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,26 @@
 from typing_extensions import final
 from PIL import Image
-import dlib
 import cv2
 import scipy.ndimage
 import numpy as np
 import torch
 
-detector = dlib.get_frontal_face_detector()
-predictor = dlib.shape_predictor('resources/shape_predictor_68_face_landmarks.dat')
-
-def shape_to_np(shape, dtype="int"):
-    # initialize the list of (x, y)-coordinates
-    coords = np.zeros((68, 2), dtype=dtype)
-
-    # loop over the 68 facial landmarks and convert them
-    # to a 2-tuple of (x, y)-coordinates
-    for i in range(0, 68):
-        coords[i] = (shape.part(i).x, shape.part(i).y)
-
-    # return the list of (x, y)-coordinates
-    return coords
+# dlib models are loaded on first use, see face_detection.set_policy
+from data.processing.face_detection import face_landmarks, shape_to_np
 
 def rot90(v):
     return np.array([-v[1], v[0]])
     
 def find_face_cvhull(im):
-    gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
-    rects = detector(gray, 1)
-    if not rects:
+    shape = face_landmarks(im)
+    if shape is None:
         return None
-    shape = predictor(gray, rects[0])
-    shape = shape_to_np(shape)
 
     hull = cv2.convexHull(shape)
     return hull
 
 def find_face_landmark(im):
-    gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
-    rects = detector(gray, 1)
-    if not rects:
-        return None
-    shape = predictor(gray, rects[0])
-    shape = shape_to_np(shape)
-
-    return shape
+    return face_landmarks(im)
 
 class Masks4D(object):
     def __call__(self, masks):
@@ -0,0 +1,136 @@
+import os
+import random
+import multiprocessing
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from data.processing.landmark_store import LandmarkStore
+
+_find_face_landmark = None
+
+
+def _init_worker():
+    # the dlib detector and predictor are loaded on the first frame of
+    # each worker; forked workers keep the face_detection policy
+    global _find_face_landmark
+    from data.processing.find_faces import find_face_landmark
+    _find_face_landmark = find_face_landmark
+
+
+def _detect_frame(args):
+    root, name = args
+    try:
+        path = os.path.join(root, name)
+        st = os.stat(path)
+        img = Image.open(path).convert('RGB')
+        landmark = _find_face_landmark(np.array(img))
+    except Exception as e:
+        return name, None, None, '%s: %s' % (type(e).__name__, e)
+    return name, [st.st_size, st.st_mtime_ns], landmark, None
+
+
+def extract_landmarks(store, names, num_workers=0, chunksize=4, flush_every=2048):
+    """Detect landmarks of the given frames on a process pool and stream
+    them into the landmark store.
+
+    Parameters:
+        store -- LandmarkStore, results are put() as they arrive
+        names -- frame names relative to store.root
+        num_workers -- pool size, 0 to use all cores
+        flush_every -- results between store flushes, so an interrupted
+        run keeps what it detected
+    Returns:
+        dict frame name -> landmarks, or None if no face was detected.
+        Frames that could not be read are left out.
+    """
+    results = {}
+    if not names:
+        return results
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(names))
+    tasks = [(store.root, name) for name in names]
+    if num_workers == 1:
+        _init_worker()
+        outputs = map(_detect_frame, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker)
+        outputs = pool.imap_unordered(_detect_frame, tasks, chunksize=chunksize)
+    errors = 0
+    try:
+        for name, key, landmark, error in tqdm(outputs, total=len(tasks),
+                                               desc='landmarks'):
+            if error is not None:
+                errors += 1
+                continue
+            store.put(name, landmark, key=key)
+            results[name] = landmark
+            if len(results) % flush_every == 0:
+                store.flush()
+    finally:
+        # also on errors and ctrl-c, the detections so far are kept
+        store.flush()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if errors:
+        print('landmarks: %d frames could not be read' % errors)
+    return results
+
+
+def select_frames(videos, store, frames_per_video=32, seed=0, num_workers=0):
+    """Pick up to frames_per_video frames with a detectable face per video.
+
+    Each video's frames are shuffled by a generator seeded from seed and
+    the video name, so the selection is reproducible. Candidates are taken
+    from the front of that order. All uncached candidates of all videos are
+    detected in one parallel batch per round, and videos that lost frames
+    to failed detections draw the next candidates in the following round.
+
+    Parameters:
+        videos -- dict video name -> list of frame names
+        store -- LandmarkStore used as cache and filled with new results
+    Returns:
+        list of selected frame names, dict frame name -> landmarks
+    """
+    orders, cursors, selected = {}, {}, {}
+    for vid in sorted(videos):
+        order = sorted(videos[vid])
+        random.Random('%s_%s' % (seed, vid)).shuffle(order)
+        orders[vid] = order
+        cursors[vid] = 0
+        selected[vid] = []
+    landmarks = {}
+
+    while True:
+        candidates = []
+        for vid, order in orders.items():
+            need = frames_per_video - len(selected[vid])
+            start = cursors[vid]
+            if need > 0 and start < len(order):
+                candidates.append((vid, order[start:start + need]))
+                cursors[vid] = start + need
+        if not candidates:
+            break
+        lookups = {}
+        for _, names in candidates:
+            for name in names:
+                lookups[name] = store.get(name)
+        missing = [name for name, lm in lookups.items()
+                   if lm is LandmarkStore.MISSING]
+        detected = extract_landmarks(store, missing, num_workers=num_workers)
+        for vid, names in candidates:
+            for name in names:
+                landmark = lookups[name]
+                if landmark is LandmarkStore.MISSING:
+                    landmark = detected.get(name)
+                if landmark is None:
+                    continue
+                selected[vid].append(name)
+                landmarks[name] = np.reshape(landmark, (-1, 2))
+
+    store.flush()
+    frames = [name for vid in orders for name in selected[vid]]
+    return frames, landmarks
@@ -0,0 +1,167 @@
+import random
+import numpy as np
+from data.dataset_util import video_name
+from data.processing.ann_index import RPForest, sample_neighbors
+
+
+def ann_options(opt):
+    """ LandmarkIndex ann argument from the donor_search options """
+    if getattr(opt, 'donor_search', 'exact') != 'ann':
+        return None
+    return dict(num_trees=getattr(opt, 'ann_trees', 8),
+                leaf_size=getattr(opt, 'ann_leaf_size', 64))
+
+
+class LandmarkIndex(object):
+    """Nearest-landmark lookup over a fixed pool of frames.
+
+    Landmarks are packed once into a contiguous float32 matrix together
+    with a per-row video id, so a query is a couple of array ops instead
+    of a python loop over the whole pool. The distance is the same one
+    used by I2GDataset.total_euclidean_distance: the sum over points of
+    the per-point euclidean distance.
+
+    With ann, candidates come from a random projection forest over the
+    normalized landmarks instead of all rows, which makes queries on
+    large pools sub-linear at the price of occasionally missing a
+    neighbour; queries it cannot answer fall back to the exact search.
+    """
+
+    def __init__(self, frame_names, landmarks, rerank=32, ann=None):
+        """
+        Parameters:
+            frame_names -- list of N frame names, the video id is the
+            prefix before the first '_'
+            landmarks -- dict or list, landmarks of each frame, (68, 2)
+            rerank -- number of rows that are scored with the exact
+            distance before the pruning bound is applied
+            ann -- None for the exact search, or RPForest keyword
+            arguments (num_trees, leaf_size, seed)
+        """
+        self.frame_names = list(frame_names)
+        if isinstance(landmarks, dict):
+            landmarks = [landmarks[name] for name in self.frame_names]
+        points = np.stack([np.reshape(lm, (-1, 2)) for lm in landmarks])
+        points = points.astype(np.float32)
+        self.flat = np.ascontiguousarray(points.reshape(len(points), -1))  # (N, 2P)
+        # x and y planes, (N, P) each, for the exact per-point distance
+        self.xs = np.ascontiguousarray(points[:, :, 0])
+        self.ys = np.ascontiguousarray(points[:, :, 1])
+        self.sq_norms = np.einsum('ij,ij->i', self.flat, self.flat)
+        videos = [video_name(name) for name in self.frame_names]
+        self.video_names, self.video_ids = np.unique(videos, return_inverse=True)
+        self.video_lookup = {v: i for i, v in enumerate(self.video_names)}
+        self.row_lookup = {name: i for i, name in enumerate(self.frame_names)}
+        self.rerank = rerank
+        self.memo = {}
+        self.forest = None if ann is None else RPForest(self.flat, **ann)
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def exact_distances(self, landmark, rows=None):
+        """ sum of per-point euclidean distances to the given rows """
+        landmark = np.reshape(landmark, (-1, 2)).astype(np.float32)
+        xs = self.xs if rows is None else self.xs[rows]
+        ys = self.ys if rows is None else self.ys[rows]
+        dx = xs - landmark[:, 0]
+        dx *= dx
+        dy = ys - landmark[:, 1]
+        dy *= dy
+        dx += dy
+        np.sqrt(dx, out=dx)
+        return dx.sum(-1)
+
+    def l2_distances(self, landmarks):
+        """ flattened l2 distance of a (Q, 2P) batch of queries to all rows """
+        landmarks = np.reshape(landmarks, (len(landmarks), -1)).astype(np.float32)
+        sq = (self.sq_norms[None, :] - 2 * landmarks.dot(self.flat.T)
+              + np.einsum('ij,ij->i', landmarks, landmarks)[:, None])
+        return np.sqrt(np.maximum(sq, 0))
+
+    def _exclude_mask(self, exclude_video):
+        if exclude_video is None or exclude_video not in self.video_lookup:
+            return None
+        return self.video_ids == self.video_lookup[exclude_video]
+
+    def query_batch(self, landmarks, exclude_videos=None, topk=1):
+        """Return the row indices of the topk nearest frames per query.
+
+        The flattened l2 distance is a lower bound of the summed per-point
+        distance, so it is computed for all rows with one matrix product and
+        only rows whose bound beats the current k-th exact distance are
+        rescored. The result is the exact topk, ordered by distance.
+        """
+        landmarks = np.reshape(landmarks, (len(landmarks), -1))
+        if exclude_videos is None:
+            exclude_videos = [None] * len(landmarks)
+        bounds = self.l2_distances(landmarks)
+        results = []
+        for q, (landmark, exclude) in enumerate(zip(landmarks, exclude_videos)):
+            bound = bounds[q]
+            excluded = self._exclude_mask(exclude)
+            if excluded is not None:
+                bound[excluded] = np.inf
+            valid = np.count_nonzero(np.isfinite(bound))
+            k = min(topk, valid)
+            if k == 0:
+                results.append(np.zeros(0, dtype=np.int64))
+                continue
+            m = min(max(k, self.rerank), valid)
+            rows = np.argpartition(bound, m - 1)[:m]
+            dists = self.exact_distances(landmark, rows)
+            kth = np.partition(dists, k - 1)[k - 1]
+            # rows whose lower bound is below the k-th exact distance may
+            # still win, small slack covers float32 rounding in the bound
+            extra = np.flatnonzero(bound <= kth * (1 + 1e-4) + 1e-3)
+            if len(extra) > len(rows):
+                rows = extra
+                dists = self.exact_distances(landmark, rows)
+            # stable ordering keeps the lowest row on ties, like the old loop
+            order = np.lexsort((rows, dists))[:k]
+            results.append(rows[order])
+        return results
+
+    def query_ann(self, landmark, exclude_video=None, topk=1):
+        """ approximate topk rows and their distances, None if too few candidates """
+        rows = self.forest.candidates(landmark)
+        if exclude_video in self.video_lookup:
+            # only the candidates are checked, no O(N) mask
+            rows = rows[self.video_ids[rows] != self.video_lookup[exclude_video]]
+        if len(rows) < topk:
+            return None
+        dists = self.exact_distances(landmark, rows)
+        order = np.lexsort((rows, dists))[:topk]
+        return rows[order], dists[order]
+
+    def query(self, landmark, exclude_video=None, topk=1, with_distances=False):
+        result = None
+        if self.forest is not None:
+            result = self.query_ann(landmark, exclude_video, topk)
+        if result is None:
+            rows = self.query_batch([landmark], [exclude_video], topk=topk)[0]
+            result = rows, self.exact_distances(landmark, rows)
+        return result if with_distances else result[0]
+
+    def search(self, landmark, exclude_video=None, topk=1, frame_name=None,
+               temperature=None):
+        """Frame name of the nearest frame, or a random pick among the topk.
+
+        If frame_name is given and belongs to the pool, landmark is taken to
+        be that frame's landmark and the neighbours are memoized per frame.
+        The pick is uniform, or weighted by distance with a temperature,
+        see sample_neighbors.
+        """
+        key = (frame_name, exclude_video, topk)
+        if frame_name in self.row_lookup and key in self.memo:
+            rows, dists = self.memo[key]
+        else:
+            rows, dists = self.query(landmark, exclude_video, topk=topk,
+                                     with_distances=True)
+            if frame_name in self.row_lookup:
+                self.memo[key] = rows, dists
+        if len(rows) == 0:
+            return None
+        if temperature is None:
+            return self.frame_names[random.choice(rows)]
+        return self.frame_names[sample_neighbors(rows, dists, 1, temperature)[0]]
@@ -0,0 +1,132 @@
+import os
+import json
+import numpy as np
+from utils.npy_append import append_rows
+
+
+class LandmarkStore(object):
+    """On-disk cache of 68 point landmarks for a folder of frames.
+
+    The cache is two files next to each other:
+        <prefix>.npy  -- (N, 68, 2) int32 array, opened memory-mapped
+        <prefix>.json -- frame name -> [file size, mtime_ns, row]
+    A row of -1 records a frame where no face was detected, so it is not
+    retried. An entry is only valid while the frame's size and mtime are
+    unchanged, so edited or replaced frames are detected again.
+    """
+
+    MISSING = object()
+
+    def __init__(self, prefix, root, num_points=68):
+        """
+        Parameters:
+            prefix -- path prefix of the cache files, e.g. frames_landmarks
+            root -- folder the frame names are relative to
+        """
+        self.prefix = prefix
+        self.root = root
+        self.num_points = num_points
+        self.array_path = prefix + '.npy'
+        self.index_path = prefix + '.json'
+        self.index = {}
+        self.landmarks = np.zeros((0, num_points, 2), dtype=np.int32)
+        if os.path.isfile(self.index_path) and os.path.isfile(self.array_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            self.landmarks = np.load(self.array_path, mmap_mode='r')
+        self.pending = {}
+
+    @staticmethod
+    def default_prefix(root):
+        # sits next to the frame folder, like the make_dataset file lists
+        return root.rstrip('/') + '_landmarks'
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def stat_key(self, name):
+        st = os.stat(os.path.join(self.root, name))
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, name):
+        """Return the cached landmarks of a frame, None if the frame has no
+        detectable face, or LandmarkStore.MISSING if it must be detected.
+        """
+        if name in self.pending:
+            return self.pending[name][1]
+        entry = self.index.get(name)
+        if entry is None:
+            return self.MISSING
+        try:
+            if self.stat_key(name) != entry[:2]:
+                return self.MISSING
+        except OSError:
+            return self.MISSING
+        row = entry[2]
+        if row < 0:
+            return None
+        return np.array(self.landmarks[row])
+
+    def put(self, name, landmark, key=None):
+        """ record the landmarks of a frame, None if no face was found """
+        if key is None:
+            key = self.stat_key(name)
+        if landmark is not None:
+            landmark = np.reshape(landmark, (self.num_points, 2)).astype(np.int32)
+        self.pending[name] = (list(key), landmark)
+
+    def flush(self):
+        """Write pending entries. New rows are appended to the array file
+        and changed rows written in place; the array is only rewritten when
+        the file is new or its header has no room for the larger shape.
+        """
+        if not self.pending:
+            return
+        old_rows = len(self.landmarks)
+        rows = {}
+        new_rows = []
+        for name, (key, landmark) in self.pending.items():
+            if landmark is None:
+                continue
+            entry = self.index.get(name)
+            if entry is not None and entry[2] >= 0:
+                rows[name] = entry[2]
+            else:
+                rows[name] = old_rows + len(new_rows)
+                new_rows.append(landmark)
+        new_rows = np.array(new_rows, dtype=np.int32).reshape(-1, self.num_points, 2)
+
+        # the array is reopened below, drop the read only map first
+        old = self.landmarks
+        self.landmarks = None
+        if not (old_rows and append_rows(self.array_path, new_rows)):
+            self._rewrite(old, new_rows)
+        del old
+        updated = [(row, self.pending[name][1]) for name, row in rows.items() if row < old_rows]
+        if updated:
+            landmarks = np.load(self.array_path, mmap_mode='r+')
+            for row, landmark in updated:
+                landmarks[row] = landmark
+            landmarks.flush()
+            del landmarks
+        for name, (key, landmark) in self.pending.items():
+            self.index[name] = key + [rows.get(name, -1)]
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+        self.pending = {}
+        self.landmarks = np.load(self.array_path, mmap_mode='r')
+
+    def _rewrite(self, old, new_rows):
+        tmp_path = self.array_path + '.tmp.npy'
+        landmarks = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.int32,
+            shape=(len(old) + len(new_rows), self.num_points, 2))
+        landmarks[:len(old)] = old
+        landmarks[len(old):] = new_rows
+        landmarks.flush()
+        del landmarks
+        os.replace(tmp_path, self.array_path)
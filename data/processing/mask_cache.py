@@ -0,0 +1,110 @@
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+from data.processing.DeepFakeMask import MASK_PARTS, part_hulls, rasterize_hulls
+
+
+class MaskCache(object):
+    """Part polygons of the DeepFakeMask hull types per frame.
+
+    The convex hulls of every part are computed once per landmark set and
+    persisted as a pickle next to the landmark store,
+        <landmark prefix>_masks.pkl -- name -> (landmarks, {type: hulls})
+    An entry is recomputed when the frame's landmarks changed. Masks are
+    rasterized as (H, W) uint8, 255 inside, at the requested shape. For
+    random_components the part masks of a frame are cropped to their
+    bounding boxes, kept in a small LRU and OR-ed together.
+    """
+
+    def __init__(self, path=None, max_rasters=1024):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.rasters = OrderedDict()
+        self.max_rasters = max_rasters
+        if path is not None and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+
+    @staticmethod
+    def default_path(landmark_prefix):
+        return landmark_prefix + '_masks.pkl'
+
+    def hulls(self, name, landmarks):
+        """ {mask type: list of int32 hulls} of a frame """
+        landmarks = np.asarray(landmarks, dtype=np.int32).reshape(-1, 2)
+        entry = self.entries.get(name)
+        if entry is None or not np.array_equal(entry[0], landmarks):
+            entry = (landmarks, {mask_type: part_hulls(landmarks, mask_type)
+                                 for mask_type in MASK_PARTS
+                                 if mask_type != 'random_components'})
+            self.entries[name] = entry
+            self.dirty = True
+        return entry[1]
+
+    def prepare(self, landmarks):
+        """ compute the hulls of all frames, dict name -> landmarks """
+        for name, landmark in landmarks.items():
+            self.hulls(name, landmark)
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    @staticmethod
+    def scaled(hulls, scale):
+        if scale is None or scale == (1, 1):
+            return hulls
+        scale = np.array(scale)
+        return [(hull * scale).astype(np.int32) for hull in hulls]
+
+    def part_rasters(self, name, landmarks, shape, scale=None):
+        """ (x, y, uint8 crop) of every extended part, cropped to the image """
+        key = (name, shape[:2], scale)
+        if key in self.rasters:
+            self.rasters.move_to_end(key)
+            return self.rasters[key]
+        h, w = shape[:2]
+        rasters = []
+        for hull in self.scaled(self.hulls(name, landmarks)['extended'], scale):
+            x, y, bw, bh = cv2.boundingRect(hull)
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + bw, w), min(y + bh, h)
+            if x1 <= x0 or y1 <= y0:
+                # keep the part indices aligned
+                rasters.append(None)
+                continue
+            crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            cv2.fillConvexPoly(crop, hull - np.int32([x0, y0]), 255)
+            rasters.append((x0, y0, crop))
+        self.rasters[key] = rasters
+        if len(self.rasters) > self.max_rasters:
+            self.rasters.popitem(last=False)
+        return rasters
+
+    def mask(self, name, landmarks, shape, mask_type, parts=None, scale=None):
+        """uint8 (H, W) mask of a frame, 255 inside.
+
+        parts -- indices of the random_components parts to combine
+        scale -- (sx, sy) from landmark to image coordinates
+        """
+        if mask_type == 'random_components':
+            rasters = self.part_rasters(name, landmarks, shape, scale)
+            mask = np.zeros(shape[:2], dtype=np.uint8)
+            for i in parts:
+                if rasters[i] is None:
+                    continue
+                x, y, crop = rasters[i]
+                roi = mask[y:y + crop.shape[0], x:x + crop.shape[1]]
+                cv2.bitwise_or(roi, crop, dst=roi)
+            return mask
+        hulls = self.scaled(self.hulls(name, landmarks)[mask_type], scale)
+        return rasterize_hulls(hulls, shape)
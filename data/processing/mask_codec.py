@@ -0,0 +1,211 @@
+"""
+Procedural I2G masks.
+
+An I2G blending mask is fully determined by the background landmarks, the
+hull type, the elastic deformation and the blur, so with
+generate_I2G.py --mask_format params only these are stored, one
+PARAMS_DTYPE record (317 bytes) per sample instead of a mask image:
+
+    <output>/real/mask_params.npy, <output>/fake/mask_params.npy
+        -- row n holds the record of face/<n>.png
+    <shard root>/mask_params.npy -- row i holds the record of index[i]
+
+render_mask(record) regenerates the float mask I2GDataset returned for
+the sample, at the stored size. render_mask(record, size) runs the
+pipeline at size x size directly, with the landmarks, deformation and
+blur scaled down and 4x supersampling, much cheaper than rendering at
+full size and downsampling.
+"""
+
+import os
+import numpy as np
+import cv2
+from PIL import Image
+import elasticdeform
+
+from data.processing.DeepFakeMask import part_hulls, rasterize_hulls
+from data.processing.mask_cache import MaskCache
+from data.processing.deform_bank import (ElasticDeformBank, random_displacement,
+                                         deform_maps, remap_mask)
+from utils.npy_append import append_rows
+
+MASK_TYPES = ['dfl_full', 'extended', 'components', 'facehull', 'random_components']
+DEFORM_NONE, DEFORM_GRID, DEFORM_BANK = 0, 1, 2
+NUM_LANDMARKS = 68
+# render_mask at a smaller size works at up to this many times the size
+SUPERSAMPLE = 4
+
+PARAMS_DTYPE = np.dtype([
+    ('label', 'u1'),          # 1 real (all ones mask), 0 fake
+    ('mask_type', 'u1'),      # index in MASK_TYPES
+    ('parts', 'u1'),          # random_components: bit i set if part i is used
+    ('flip', 'u1'),
+    ('deform', 'u1'),         # DEFORM_*
+    ('points', 'u1'),
+    ('blur', 'u1'),           # gaussian kernel size
+    ('size', '<u2'),          # side of the output mask
+    ('height', '<u2'),        # frame the mask was built on
+    ('width', '<u2'),
+    ('deform_seed', '<i8'),   # grid: displacement seed, bank: bank seed
+    ('deform_index', '<i4'),  # bank: field number
+    ('sigma', '<f4'),
+    ('scale', '<f8', (2,)),   # landmark to frame coordinates
+    ('landmarks', '<i2', (NUM_LANDMARKS, 2)),
+])
+
+
+def params_path(root):
+    return os.path.join(root, 'mask_params.npy')
+
+
+def make_params(label, size, **fields):
+    """ 0-d PARAMS_DTYPE record """
+    record = np.zeros((), dtype=PARAMS_DTYPE)
+    record['label'] = label
+    record['size'] = size
+    record['scale'] = 1
+    for k, v in fields.items():
+        record[k] = v
+    return record
+
+
+def parts_to_bits(parts):
+    return sum(1 << i for i in parts)
+
+
+def bits_to_parts(bits):
+    return [i for i in range(8) if int(bits) >> i & 1]
+
+
+def to_bytes(record):
+    """ uint8 view of a record, collates into a (N, itemsize) tensor """
+    return np.frombuffer(record.tobytes(), dtype=np.uint8)
+
+
+def from_bytes(array):
+    """ records from a (N, itemsize) uint8 array """
+    return np.ascontiguousarray(array, dtype=np.uint8).view(PARAMS_DTYPE).reshape(-1)
+
+
+def hull_mask(record, shape, scale):
+    """ uint8 (H, W) hull mask, the same pixels as MaskCache.mask """
+    mask_type = MASK_TYPES[record['mask_type']]
+    landmarks = record['landmarks'].astype(np.int32)
+    if mask_type == 'random_components':
+        hulls = part_hulls(landmarks, 'extended')
+        hulls = [hulls[i] for i in bits_to_parts(record['parts'])]
+    else:
+        hulls = part_hulls(landmarks, mask_type)
+    return rasterize_hulls(MaskCache.scaled(hulls, scale), shape)
+
+
+def displacement(record):
+    if record['deform'] == DEFORM_BANK:
+        bank = ElasticDeformBank(sigma=float(record['sigma']),
+                                 points=int(record['points']),
+                                 seed=int(record['deform_seed']))
+        return bank.displacement((int(record['height']), int(record['width'])),
+                                 int(record['deform_index']))
+    rng = np.random.RandomState(int(record['deform_seed']))
+    return random_displacement(rng, float(record['sigma']), int(record['points']))
+
+
+def deform(mask, record, factor=(1., 1.)):
+    """ elastic deformation of the record, displacements scaled by (fy, fx) """
+    if record['deform'] == DEFORM_NONE:
+        return mask
+    grid = displacement(record)
+    grid[0] *= factor[0]
+    grid[1] *= factor[1]
+    if record['deform'] == DEFORM_BANK:
+        return remap_mask(mask, deform_maps(mask.shape[:2], grid))
+    return elasticdeform.deform_grid(mask, grid)
+
+
+def gaussian_sigma(ksize):
+    """ sigma OpenCV derives for a kernel size """
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def render_mask(record, size=None):
+    """float32 (size, size) mask of a record, 1 where the face is untouched
+
+    Without size (or at the stored size) this is the mask I2GDataset
+    produced, before it was quantized to uint8.
+    """
+    out = int(record['size'])
+    size = out if size is None else size
+    if record['label'] == 1:
+        return np.ones((size, size), dtype=np.float32)
+    height, width = int(record['height']), int(record['width'])
+    scale = tuple(float(s) for s in record['scale'])
+    blur = int(record['blur'])
+    if size == out:
+        mask = hull_mask(record, (height, width), scale).astype(np.float32) / 255
+        mask = deform(mask, record)
+        mask = cv2.GaussianBlur(mask, (blur, blur), 0)
+        mask = Image.fromarray(mask).resize((out, out), Image.BILINEAR)
+        mask = 1 - np.array(mask)
+    else:
+        # supersampled, the hull is rasterized without antialiasing
+        work = size * int(np.clip(out // size, 1, SUPERSAMPLE))
+        fx, fy = work / width, work / height
+        mask = hull_mask(record, (work, work), (scale[0] * fx, scale[1] * fy))
+        mask = deform(mask.astype(np.float32) / 255, record, (fy, fx))
+        sigma = gaussian_sigma(blur) * (fx + fy) / 2
+        ksize = 2 * int(np.ceil(3 * sigma)) + 1
+        mask = cv2.GaussianBlur(mask, (ksize, ksize), sigma)
+        if work != size:
+            mask = cv2.resize(mask, (size, size), interpolation=cv2.INTER_AREA)
+        mask = 1 - mask
+    if record['flip']:
+        mask = np.flip(mask, 1).copy()
+    return mask
+
+
+def render_mask_image(record, size=None):
+    """ 'L' image of render_mask, quantized like the saved mask images """
+    return Image.fromarray(np.uint8(render_mask(record, size) * 255), 'L')
+
+
+class MaskParamsWriter(object):
+    """ mask_params.npy of a generation run, flushes append the new records """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.flushed = 0
+
+    def __len__(self):
+        return self.flushed + len(self.records)
+
+    def resume(self, count):
+        """ keep the first count records of an existing run """
+        records = np.load(self.path, mmap_mode='r') if os.path.isfile(self.path) else []
+        assert len(records) >= count, 'only %d records in %s' % (len(records), self.path)
+        self.records = []
+        self.rewrite(np.array(records[:count], dtype=PARAMS_DTYPE))
+        del records
+
+    def rewrite(self, records):
+        tmp_path = self.path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, records)
+        os.replace(tmp_path, self.path)
+        self.flushed = len(records)
+
+    def append(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        new = np.array(self.records, dtype=PARAMS_DTYPE).reshape(-1)
+        if not (self.flushed and append_rows(self.path, new)):
+            if self.flushed:
+                # no room in the header, the only case that reads the file back
+                new = np.concatenate([np.load(self.path), new])
+            self.rewrite(new)
+        else:
+            self.flushed += len(new)
+        self.records = []
+
+    def close(self):
+        self.flush()
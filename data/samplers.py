@@ -0,0 +1,36 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class BalancedBatchSampler(Sampler):
+    """Batches with exactly as many real as fake samples.
+
+    For I2GDataset with sampling 'balanced', where index 2k is frame k as
+    a real sample and 2k+1 the same frame as a fake one. Every epoch the
+    frames are shuffled once for the real half and once for the fake half
+    of the batches, so each frame is used once as real and once as fake.
+    The real/fake split is fixed by the indices, not by state in the
+    workers, so it holds for any number of workers.
+    """
+
+    def __init__(self, data_source, batch_size, shuffle=True):
+        assert batch_size % 2 == 0, 'batch_size must be even'
+        self.data_source = data_source
+        self.half = batch_size // 2
+        self.shuffle = shuffle
+
+    def num_frames(self):
+        return len(self.data_source) // 2
+
+    def __iter__(self):
+        n = self.num_frames()
+        if self.shuffle:
+            real, fake = torch.randperm(n).tolist(), torch.randperm(n).tolist()
+        else:
+            real = fake = list(range(n))
+        for start in range(0, n, self.half):
+            yield ([2 * k for k in real[start:start + self.half]] +
+                   [2 * k + 1 for k in fake[start:start + self.half]])
+
+    def __len__(self):
+        return (self.num_frames() + self.half - 1) // self.half
@@ -0,0 +1,240 @@
+import os
+import numpy as np
+import torch.utils.data as data
+from PIL import Image
+from . import transforms
+from data.processing import mask_codec
+from utils.npy_append import append_rows
+
+INDEX_DTYPE = np.dtype([
+    ('shard', '<i4'),
+    ('offset', '<i4'),
+    ('label', 'u1'),
+    ('seed', '<i8'),
+    ('source', '<i4'),   # line in paths.txt, -1 for none
+    ('partner', '<i4'),
+])
+
+
+def is_shard_dir(path):
+    return path is not None and os.path.isfile(os.path.join(path, 'index.npy'))
+
+
+def path_table(root):
+    return os.path.join(root, 'paths.txt')
+
+
+def load_paths(root, count=None):
+    ''' first count lines of the path table, all without count '''
+    paths = []
+    if os.path.isfile(path_table(root)):
+        with open(path_table(root), encoding='utf-8') as f:
+            paths = f.read().split('\n')[:-1]
+    return paths if count is None else paths[:count]
+
+
+def shard_paths(root, shard):
+    return (os.path.join(root, 'faces_%05d.npy' % shard),
+            os.path.join(root, 'masks_%05d.npy' % shard))
+
+
+class ShardWriter(object):
+    """Append uint8 faces and masks to fixed-size memory-mappable shards.
+
+    root/faces_00000.npy -- (shard_size, H, W, 3) uint8
+    root/masks_00000.npy -- (shard_size, H, W) uint8
+    root/index.npy       -- one INDEX_DTYPE record per written sample
+    root/paths.txt       -- source and partner paths of the index, one per line
+    The last shard is only filled up to its entries in the index. Flushes
+    append the new records and paths, index.npy is only rewritten on
+    resume.
+    With mask_params the masks are not stored, root/mask_params.npy holds
+    the mask_codec record of every sample instead.
+    """
+
+    def __init__(self, root, image_size, shard_size=4096, mask_params=False):
+        self.root = root
+        self.image_size = image_size
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+        self.records = []
+        self.flushed = 0
+        self.paths = []
+        self.path_ids = {}
+        self.paths_flushed = 0
+        self.faces = None
+        self.masks = None
+        self.shard = -1
+        self.params = None
+        if mask_params:
+            self.params = mask_codec.MaskParamsWriter(mask_codec.params_path(root))
+
+    def __len__(self):
+        return len(self.records)
+
+    def open_shard(self, shard):
+        faces_path, masks_path = shard_paths(self.root, shard)
+        size = self.image_size
+        self.faces = np.lib.format.open_memmap(
+            faces_path, mode='w+', dtype=np.uint8,
+            shape=(self.shard_size, size, size, 3))
+        if self.params is None:
+            self.masks = np.lib.format.open_memmap(
+                masks_path, mode='w+', dtype=np.uint8,
+                shape=(self.shard_size, size, size))
+        self.shard = shard
+
+    def resume(self, count):
+        """ keep the first count samples of an existing run, drop the rest """
+        index = np.load(os.path.join(self.root, 'index.npy'))
+        assert len(index) >= count, 'only %d samples in %s' % (len(index), self.root)
+        assert index.dtype == INDEX_DTYPE, 'index of an older format in %s' % self.root
+        self.records = index[:count].tolist()
+        # keep the paths these records use, a crash may have left more
+        used = max([max(r[4], r[5]) for r in self.records] + [-1]) + 1
+        self.paths = load_paths(self.root, used)
+        assert len(self.paths) == used, 'only %d paths in %s' % (len(self.paths), path_table(self.root))
+        self.path_ids = {p: i for i, p in enumerate(self.paths)}
+        self.rewrite_paths()
+        self.rewrite_index()
+        if self.params is not None:
+            self.params.resume(count)
+        shard, offset = divmod(count, self.shard_size)
+        if offset:
+            faces_path, masks_path = shard_paths(self.root, shard)
+            self.faces = np.load(faces_path, mmap_mode='r+')
+            if self.params is None:
+                self.masks = np.load(masks_path, mmap_mode='r+')
+            self.shard = shard
+
+    def append(self, face, mask, label, source='', partner='', seed=-1, params=None):
+        """ face: (H, W, 3) uint8, mask: (H, W) uint8, params: mask_codec record """
+        shard, offset = divmod(len(self.records), self.shard_size)
+        if shard != self.shard:
+            self.flush()
+            self.open_shard(shard)
+        self.faces[offset] = face
+        if self.params is None:
+            self.masks[offset] = mask
+        else:
+            self.params.append(params)
+        self.records.append((shard, offset, label, seed,
+                             self.path_id(source), self.path_id(partner)))
+
+    def path_id(self, path):
+        if not path:
+            return -1
+        if path not in self.path_ids:
+            if '\n' in path:
+                raise ValueError('newline in path %r' % path)
+            self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+        return self.path_ids[path]
+
+    def rewrite_paths(self):
+        tmp_path = path_table(self.root) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(p + '\n' for p in self.paths)
+        os.replace(tmp_path, path_table(self.root))
+        self.paths_flushed = len(self.paths)
+
+    def rewrite_index(self):
+        index = np.array(self.records, dtype=INDEX_DTYPE)
+        tmp_path = os.path.join(self.root, 'index.tmp.npy')
+        np.save(tmp_path, index)
+        os.replace(tmp_path, os.path.join(self.root, 'index.npy'))
+        self.flushed = len(self.records)
+
+    def flush(self):
+        if self.faces is not None:
+            self.faces.flush()
+        if self.masks is not None:
+            self.masks.flush()
+        if self.params is not None:
+            self.params.flush()
+        # paths before the records that refer to them
+        if self.flushed == 0:
+            self.rewrite_paths()
+        else:
+            with open(path_table(self.root), 'a', encoding='utf-8') as f:
+                f.writelines(p + '\n' for p in self.paths[self.paths_flushed:])
+            self.paths_flushed = len(self.paths)
+        new = np.array(self.records[self.flushed:], dtype=INDEX_DTYPE)
+        if not (self.flushed and append_rows(os.path.join(self.root, 'index.npy'), new)):
+            self.rewrite_index()
+        self.flushed = len(self.records)
+
+    def close(self):
+        self.flush()
+        self.faces = None
+        self.masks = None
+
+
+class ShardPairedDataset(data.Dataset):
+    """Paired real/fake dataset read from shards written by generate_I2G.py
+
+    Returns the same keys as PairedDataset(with_mask=True). Shards are
+    memory-mapped lazily in each worker and samples are sliced without
+    copying until the transforms. Runs written with --mask_format params
+    have their masks rendered from mask_params.npy, at mask_size if given.
+    """
+
+    def __init__(self, opt, root, is_val=False, real_label=1, mask_size=None):
+        super().__init__()
+        self.root = root
+        self.index = np.load(os.path.join(root, 'index.npy'))
+        self.paths = load_paths(root)
+        self.mask_params = None
+        if os.path.isfile(mask_codec.params_path(root)):
+            self.mask_params = np.load(mask_codec.params_path(root))
+        self.mask_size = mask_size
+        self.real_ids = np.flatnonzero(self.index['label'] == real_label)
+        self.fake_ids = np.flatnonzero(self.index['label'] != real_label)
+        self.real_size = len(self.real_ids)
+        self.fake_size = len(self.fake_ids)
+        assert(self.real_size > 0 and self.fake_size > 0)
+        self.shards = {}
+        self.transform = transforms.get_transform(opt, for_val=is_val)
+        self.orig_transform = transforms.get_mask_transform(opt, for_val=is_val)
+        self.opt = opt
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            faces_path, masks_path = shard_paths(self.root, shard)
+            masks = None
+            if self.mask_params is None:
+                masks = np.load(masks_path, mmap_mode='r')
+            self.shards[shard] = (np.load(faces_path, mmap_mode='r'), masks)
+        return self.shards[shard]
+
+    def get_sample(self, i):
+        """ face array, mask 'L' image, path """
+        record = self.index[i]
+        faces, masks = self.get_shard(int(record['shard']))
+        offset = int(record['offset'])
+        # older runs store the path itself instead of its line in paths.txt
+        source = record['source']
+        if self.index.dtype == INDEX_DTYPE:
+            source = self.paths[source] if source >= 0 else ''
+        path = '%s:%d' % (source, i)
+        if masks is None:
+            mask = mask_codec.render_mask_image(self.mask_params[i], self.mask_size)
+        else:
+            mask = Image.fromarray(masks[offset], 'L')
+        return faces[offset], mask, path
+
+    def __getitem__(self, index):
+        real_face, real_mask, real_path = self.get_sample(
+            self.real_ids[index % self.real_size])
+        fake_face, fake_mask, fake_path = self.get_sample(
+            self.fake_ids[index % self.fake_size])
+        return {'manipulated': self.transform(Image.fromarray(fake_face)),
+                'original': self.transform(Image.fromarray(real_face)),
+                'path_manipulated': fake_path,
+                'path_original': real_path,
+                'mask_original': self.orig_transform(real_mask),
+                'mask_manipulated': self.orig_transform(fake_mask),
+                }
+
+    def __len__(self):
+        return max(self.real_size, self.fake_size)
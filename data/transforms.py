@@ -1,8 +1,10 @@
 import torchvision.transforms as transforms
 import torchvision.transforms.functional as F
+import torch.nn.functional as nnF
 import logging
 import PIL.Image
 import numpy as np
+import torch
 
 def get_transform(opt, for_val=False):
     transform_list = []
@@ -42,10 +44,55 @@ def get_mask_transform(opt, for_val=False):
     #     opt.loadSize, interpolation=PIL.Image.LANCZOS))
     # transform_list.append(transforms.CenterCrop(opt.fineSize))
     transform_list.append(transforms.ToTensor())
+    if getattr(opt, 'mask_size', 0):
+        # PCL targets at the feature map resolution, the model then skips
+        # its own downsampling
+        transform_list.append(MaskResize(opt.mask_size))
     
     transform = transforms.Compose(transform_list)
     return transform
 
+class MaskResize(object):
+    # same sampling as the model's UpsamplingBilinear2d (align_corners=True)
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, mask):
+        # mask: (C, H, W) tensor
+        if mask.shape[-2:] == (self.size, self.size):
+            return mask
+        return nnF.interpolate(mask[None], size=(self.size, self.size),
+                               mode='bilinear', align_corners=True)[0]
+
+def get_batch_transform(opt, for_val=False):
+    # tensor-side counterpart of get_transform for batches blended on device,
+    # without the random JPEG of I2GDataset and AllAugmentations, which run on
+    # PIL images
+    return BatchTransform(flip=not for_val, erase=not for_val)
+
+class BatchTransform(object):
+    def __init__(self, flip=True, erase=True, mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225)):
+        self.flip = flip
+        # the RandomErasing of get_transform, drawn per image
+        self.erase = transforms.RandomErasing() if erase else None
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def __call__(self, images, masks):
+        # images: (N, 3, H, W) in [0, 1], masks: (N, 1, H, W)
+        if self.flip:
+            flip = torch.rand(images.shape[0], device=images.device) < 0.5
+            flip = flip.view(-1, 1, 1, 1)
+            images = torch.where(flip, images.flip(3), images)
+            masks = torch.where(flip, masks.flip(3), masks)
+        mean = self.mean.to(images.device)
+        std = self.std.to(images.device)
+        images = (images - mean) / std
+        if self.erase is not None:
+            images = torch.stack([self.erase(image) for image in images])
+        return images, masks
+
 ### additional augmentations ### 
 
 class AllAugmentations(object):
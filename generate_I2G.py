@@ -3,10 +3,15 @@ import os
 from numpy.core.numeric import Inf
 import torch
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
-from data.I2G_dataset import I2GDataset
+from torch.utils.data import DataLoader, Subset
+from data.I2G_dataset import I2GDataset, sample_seed
+from data.shard_dataset import ShardWriter
+from data.processing import mask_codec
+from utils.image_writer import AsyncImageWriter, ImageWriteError
 import argparse
+import json
 import sys
+import time
 
 class Struct:
     def __init__(self, **entries):
@@ -18,6 +23,42 @@ parser.add_argument("--batch_size", type=int, default=512, help="batch size to g
 parser.add_argument("--out_size", type=int, default=256, help="image output size")
 parser.add_argument("--output_dir", type=str, required=True, help="path to store output images")
 parser.add_argument("--output_max", type=int, default=140000, help="max output image number")
+parser.add_argument("--output_format", type=str, default='png', choices=['png', 'shard'],
+                    help="png: one file per face and mask, shard: packed uint8 .npy shards with an index")
+parser.add_argument("--shard_size", type=int, default=4096, help="faces per shard file")
+parser.add_argument("--mask_format", type=str, default='png', choices=['png', 'params'],
+                    help="png: store every mask, params: store the mask_codec parameters "
+                         "(mask_params.npy) the training datasets render the masks from")
+parser.add_argument("--image_format", type=str, default='png', choices=['png', 'webp'],
+                    help="file format of --output_format png, webp is lossless")
+parser.add_argument("--compress_level", type=int, default=6,
+                    help="png compress_level 0-9, or webp method 0-6")
+parser.add_argument("--num_writers", type=int, default=4,
+                    help="image encoder processes, 0 saves in the main loop")
+parser.add_argument("--writer_queue", type=int, default=256,
+                    help="max images waiting for the encoders")
+parser.add_argument("--seed", type=int, default=None,
+                    help="run seed: samples depend only on (seed, pass, index) and the run can be resumed")
+parser.add_argument("--checkpoint_every", type=int, default=20,
+                    help="batches between checkpoints: writes are flushed, and seeded runs save the manifest")
+parser.add_argument("--deform_bank", type=int, default=0,
+                    help="precomputed elastic deformation fields, 0 deforms every mask with elasticdeform")
+parser.add_argument("--deform_bank_refresh", type=int, default=0,
+                    help="replace a drawn deformation field every this many draws, 0 keeps the bank fixed")
+parser.add_argument("--frame_cache_mb", type=int, default=0,
+                    help="MB of decoded frames shared by the data workers, 0 disables the cache")
+parser.add_argument("--landmark_cache", type=str, default='',
+                    help="path prefix of the landmark cache (<prefix>.npy, <prefix>.json), empty uses <real_im_path>_landmarks")
+parser.add_argument("--landmark_workers", type=int, default=0,
+                    help="processes detecting the landmarks of uncached frames, 0 uses all cores")
+parser.add_argument("--donor_search", type=str, default='exact', choices=['exact', 'ann'],
+                    help="exact nearest landmarks, or candidates from a random projection forest for large pools")
+parser.add_argument("--donor_topk", type=int, default=1,
+                    help="donor is picked among this many nearest frames")
+parser.add_argument("--donor_temperature", type=float, default=None,
+                    help="pick donors weighted by exp(-d / (T * mean d)), 0 takes the nearest, unset is uniform")
+parser.add_argument("--ann_trees", type=int, default=8, help="trees of the --donor_search ann forest")
+parser.add_argument("--ann_leaf_size", type=int, default=64, help="max frames per leaf of the ann forest")
 args = parser.parse_args()
 
 opt = {
@@ -26,38 +67,156 @@ opt = {
     'batch_size': args.batch_size,
     'loadSize': args.out_size,
     'fineSize': args.out_size,
-    'output_dir': args.output_dir
+    'output_dir': args.output_dir,
+    'seed': args.seed,
+    'deform_bank': args.deform_bank,
+    'deform_bank_refresh': args.deform_bank_refresh,
+    'frame_cache_mb': args.frame_cache_mb,
+    'landmark_cache': args.landmark_cache,
+    'landmark_workers': args.landmark_workers,
+    'donor_search': args.donor_search,
+    'donor_topk': args.donor_topk,
+    'donor_temperature': args.donor_temperature,
+    'ann_trees': args.ann_trees,
+    'ann_leaf_size': args.ann_leaf_size
 }
 opt = Struct(**opt)
 
-os.makedirs(os.path.join(opt.output_dir, 'real', 'face'), exist_ok=True)
-os.makedirs(os.path.join(opt.output_dir, 'real', 'mask'), exist_ok=True)
-os.makedirs(os.path.join(opt.output_dir, 'fake', 'face'), exist_ok=True)
-os.makedirs(os.path.join(opt.output_dir, 'fake', 'mask'), exist_ok=True)
-count_real = 0
-count_fake = 0
+# settings a resumed run must share with the run that wrote the manifest
+RUN_KEYS = ['real_im_path', 'batch_size', 'out_size', 'output_format',
+            'image_format', 'shard_size', 'seed', 'deform_bank',
+            'deform_bank_refresh', 'mask_format']
+manifest_path = os.path.join(opt.output_dir, 'manifest.json')
 
+
+def load_manifest():
+    if args.seed is None or not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for k in RUN_KEYS:
+        if manifest['args'].get(k) != getattr(args, k):
+            sys.exit('%s: %s=%r, resumed run has %r' % (
+                manifest_path, k, manifest['args'].get(k), getattr(args, k)))
+    return manifest
+
+
+def checkpoint(progress):
+    # everything counted in progress must be on disk before it is recorded,
+    # mask params also in unseeded runs, so they match the faces after a crash
+    if args.output_format == 'shard':
+        writer.flush()
+    else:
+        try:
+            writer.drain()
+        except ImageWriteError as e:
+            if args.seed is None:
+                sys.exit(str(e))
+            # the manifest keeps the last checkpoint, a resumed run regenerates from there
+            sys.exit('%s, %s not updated, rerun to resume from its last checkpoint'
+                     % (e, manifest_path))
+        for params_writer in params_writers.values():
+            params_writer.flush()
+    if args.seed is None:
+        return
+    manifest = dict(args=vars(args), **progress)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+os.makedirs(opt.output_dir, exist_ok=True)
+manifest = load_manifest()
+if manifest is not None:
+    progress = {k: manifest[k] for k in ['pass', 'batch', 'count_real', 'count_fake']}
+    print('resuming %s at pass %d batch %d' % (manifest_path, progress['pass'],
+                                              progress['batch']))
+else:
+    progress = {'pass': 0, 'batch': 0, 'count_real': 0, 'count_fake': 0}
+
+mask_params = args.mask_format == 'params'
+# label -> mask_params.npy writer of --output_format png --mask_format params
+params_writers = {}
+if args.output_format == 'shard':
+    writer = ShardWriter(opt.output_dir, args.out_size, args.shard_size,
+                         mask_params=mask_params)
+    if manifest is not None:
+        writer.resume(progress['count_real'] + progress['count_fake'])
+else:
+    writer = AsyncImageWriter(args.num_writers, args.writer_queue,
+                              args.image_format, args.compress_level)
+    for label, split in [(1, 'real'), (0, 'fake')]:
+        os.makedirs(os.path.join(opt.output_dir, split, 'face'), exist_ok=True)
+        if mask_params:
+            params_writers[label] = mask_codec.MaskParamsWriter(
+                mask_codec.params_path(os.path.join(opt.output_dir, split)))
+            if manifest is not None:
+                params_writers[label].resume(
+                    progress['count_real'] if label == 1 else progress['count_fake'])
+        else:
+            os.makedirs(os.path.join(opt.output_dir, split, 'mask'), exist_ok=True)
+count_real = progress['count_real']
+count_fake = progress['count_fake']
+start_time = time.time()
+start_count = count_real + count_fake
+
+# one dataset for all passes, so the frame cache survives between them
+dset = I2GDataset(opt, os.path.join(opt.real_im_path), orig_transform=True)
 while count_real <= args.output_max or count_fake <= args.output_max:
-    dset = I2GDataset(opt, os.path.join(opt.real_im_path), orig_transform=True)
-    dset.get32frames()
-    dl = DataLoader(dset, batch_size=opt.batch_size,
+    if args.seed is not None:
+        dset.get32frames(seed='%d_%d' % (args.seed, progress['pass']))
+        dset.set_seed(args.seed, progress['pass'])
+    else:
+        dset.get32frames()
+    total_batches = (len(dset) + opt.batch_size - 1) // opt.batch_size
+    # batches already on disk are not generated again, samples keep
+    # their dataset index so their seeds do not change
+    first_batch = progress['batch']
+    dl = DataLoader(Subset(dset, range(first_batch * opt.batch_size, len(dset))),
+                    batch_size=opt.batch_size,
                     num_workers=opt.nThreads, pin_memory=False,
                     shuffle=False)
-    total_batches = len(dl)
     print(total_batches)
-    for i, ims in enumerate(dl):
+    for i, ims in enumerate(dl, first_batch):
         if i % 20 == 0:
-            print('finished: {}/{}'.format(i, total_batches))
-        for j in range(len(ims['img'])):
-            img_save = transforms.ToPILImage()(ims['img'][j]).convert("RGB")
-            mask_save = transforms.ToPILImage()(ims['mask'][j]).convert("L")
-            if ims['label'][j] == 1:
-                img_save.save(os.path.join(opt.output_dir, 'real', 'face', '%d.png') % count_real)
-                mask_save.save(os.path.join(opt.output_dir, 'real', 'mask', '%d.png') % count_real)
+            rate = (count_real + count_fake - start_count) / (time.time() - start_time)
+            status = writer.status() if args.output_format == 'png' else ''
+            if dset.frame_cache is not None:
+                status += '  ' + str(dset.frame_cache)
+            print('finished: {}/{}  {:.1f} img/s generated  {}'.format(
+                i, total_batches, rate, status))
+        # same float -> uint8 conversion as ToPILImage
+        faces = (ims['img'] * 255).byte().permute(0, 2, 3, 1).numpy()
+        masks = (ims['mask'][:, 0] * 255).byte().numpy()
+        params = mask_codec.from_bytes(ims['mask_params'].numpy())
+        for j in range(len(faces)):
+            label = int(ims['label'][j])
+            if args.output_format == 'shard':
+                writer.append(faces[j], masks[j], label,
+                              source=ims['path'][j], partner=ims['partner'][j],
+                              seed=int(ims['seed'][j]), params=params[j])
+            else:
+                split, count = ('real', count_real) if label == 1 else ('fake', count_fake)
+                writer.write(os.path.join(opt.output_dir, split, 'face', '%d' % count), faces[j])
+                if mask_params:
+                    params_writers[label].append(params[j])
+                else:
+                    writer.write(os.path.join(opt.output_dir, split, 'mask', '%d' % count), masks[j])
+            if label == 1:
                 count_real += 1
             else:
-                img_save.save(os.path.join(opt.output_dir, 'fake', 'face', '%d.png') % count_fake)
-                mask_save.save(os.path.join(opt.output_dir, 'fake', 'mask', '%d.png') % count_fake)
                 count_fake += 1
+        progress.update(batch=i + 1, count_real=count_real, count_fake=count_fake)
+        if (i + 1) % args.checkpoint_every == 0:
+            checkpoint(progress)
         # if count_real >= 100:
         #     sys.exit('exit')
+    progress.update({'pass': progress['pass'] + 1, 'batch': 0})
+    checkpoint(progress)
+
+writer.close()
+for params_writer in params_writers.values():
+    params_writer.close()
+print('generated %d real, %d fake in %.0fs' % (count_real, count_fake,
+                                               time.time() - start_time))
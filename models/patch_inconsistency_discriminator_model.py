@@ -82,7 +82,10 @@ class PatchInconsistencyDiscriminatorModel(BaseModel):
 
         n, h, w, h_, w_ = self.const_logit.shape
         masks = self.masks
-        masks = self.mask_down_sampling(masks).reshape(n, h, w)
+        if masks.shape[-2:] != (h, w):
+            # full resolution masks, --mask_size gives them at (h, w) already
+            masks = self.mask_down_sampling(masks)
+        masks = masks.reshape(n, h, w)
 
         masks_out = masks
 
@@ -15,5 +15,20 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--lr_policy', default='constant', help='lr schedule [constant|plateau]')
         parser.add_argument('--patience', type=int, default=10, help='will stop training if val metric does not improve for this many epochs')
         parser.add_argument('--max_epochs', type=int, help='maximum epochs to train, if not specified, will stop based on patience, or whichever is sooner')
+        parser.add_argument('--batched_blend', action='store_true', help='train_I2G: color transfer, blur and composite the fakes per batch on the device instead of in the data workers; the blur is scaled to loadSize, and the random JPEG and AllAugmentations steps are not applied, only flip and RandomErasing')
+        parser.add_argument('--deform_bank', type=int, default=0, help='I2G: number of precomputed elastic deformation fields applied with cv2.remap, 0 deforms every mask with elasticdeform')
+        parser.add_argument('--deform_bank_refresh', type=int, default=0, help='I2G: replace a drawn deformation field every this many draws, 0 keeps the bank fixed')
+        parser.add_argument('--frame_cache_mb', type=int, default=0, help='I2G: MB of decoded frames shared by the data workers, 0 disables the cache')
+        parser.add_argument('--sampling', default='alternate', choices=['alternate', 'balanced', 'pair'], help='I2G: alternate real/fake per data worker, balanced: exact 50/50 batches with each frame used as real and as fake, pair: real and fake of a frame from one decode')
+        parser.add_argument('--mask_size', type=int, default=0, help='datasets return the PCL masks at this size, e.g. 16 for resnet34_layer4 at 256, so the model does not resample them; 0 returns full resolution masks')
+        parser.add_argument('--landmark_cache', default='', help='I2G: path prefix of the landmark cache (<prefix>.npy, <prefix>.json), empty uses <real_im_path>_landmarks')
+        parser.add_argument('--landmark_workers', type=int, default=0, help='I2G: processes detecting the landmarks of uncached frames, 0 uses all cores')
+        parser.add_argument('--face_detect', default='full', help='dlib face detection policy of I2G frame selection and PairedMaskDataset: full, scale:<s>, max_side:<px> or face_size:<px or fraction of the shorter side>, optionally with ,upsample:<n>; see data/processing/face_detection.py')
+        parser.add_argument('--donor_search', default='exact', choices=['exact', 'ann'], help='I2G: exact nearest landmarks, or candidates from a random projection forest for large real pools')
+        parser.add_argument('--donor_topk', type=int, default=1, help='I2G: donor is picked among this many nearest frames')
+        parser.add_argument('--donor_temperature', type=float, default=None, help='I2G: pick donors with probability exp(-d / (T * mean d)) among the topk, 0 takes the nearest; unset picks uniformly')
+        parser.add_argument('--ann_trees', type=int, default=8, help='I2G: trees of the --donor_search ann forest')
+        parser.add_argument('--ann_leaf_size', type=int, default=64, help='I2G: max frames per leaf of the --donor_search ann forest')
+        parser.add_argument('--frame_cache_size', type=int, default=0, help='I2G: resize cached frames to this square size, which distorts non square frames; 0 caches them at their decoded size')
 
         self.isTrain = True
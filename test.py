@@ -9,6 +9,7 @@ from utils import imutil
 from torch.utils.data import DataLoader
 from data.unpaired_dataset import UnpairedMaskDataset
 from data.paired_dataset import PairedDataset
+from data.dataset_util import group_by_video
 from sklearn import metrics
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -71,7 +72,8 @@ def run_eval(opt, output_dir):
             prediction_raw.append(predictions.raw)
             if opt.model == 'patch_inconsistency_discriminator':
                 prediction_mask.append(predictions.mask)
-            # paths.extend(data['path'])
+            paths.extend(data['path_original'])
+            paths.extend(data['path_manipulated'])
 
 
     # compute and save metrics
@@ -91,6 +93,13 @@ def run_eval(opt, output_dir):
                         np.concatenate(labels),
                         os.path.join(output_dir, 'metrics_avg_after_softmax'))
 
+        # save precision, recall, AP metrics, per video avg after softmax
+        video_preds, video_labels = video_predictions(
+            np.concatenate(prediction_avg_after_softmax),
+            np.concatenate(labels), paths)
+        compute_metrics(video_preds, video_labels,
+                        os.path.join(output_dir, 'metrics_video_avg_after_softmax'))
+
         # save precision, recall, AP metrics, on raw patches
         # this can be slow, so will not plot AP curve
         patch_preds = np.concatenate(prediction_raw, axis=0) # N2HW
@@ -199,6 +208,18 @@ def run_eval_openmfc(opt):
 
 
 
+def video_predictions(predictions, labels, paths):
+    # average the frame predictions of each (video, label) pair
+    video_preds, video_labels = [], []
+    for video, idx in group_by_video(paths).items():
+        idx = np.array(idx)
+        for label in np.unique(labels[idx]):
+            sel = idx[labels[idx] == label]
+            video_preds.append(predictions[sel].mean(axis=0))
+            video_labels.append(label)
+    return np.stack(video_preds), np.array(video_labels)
+
+
 def compute_metrics(predictions, labels, save_path, threshold=0.5, plot=True):
     # save precision, recall, AP metrics on voted predictions
     print("Computing metrics for %s" % save_path)
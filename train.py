@@ -14,6 +14,7 @@ import pdb
 from torch.utils.data import DataLoader
 from data.I2G_dataset import I2GDataset
 from data.paired_dataset import PairedDataset
+from data.shard_dataset import ShardPairedDataset, is_shard_dir
 from utils import pidfile, util
 import utils.logging
 from PIL import Image
@@ -26,12 +27,17 @@ def train(opt):
         WITH_MASK = True
     else:
         WITH_MASK = False
-    if not WITH_MASK:
+    if is_shard_dir(opt.real_im_path):
+        # shards written by generate_I2G.py --output_format shard
+        dset = ShardPairedDataset(opt, opt.real_im_path,
+                                  mask_size=opt.mask_size or None)
+    elif not WITH_MASK:
         dset = PairedDataset(opt, os.path.join(opt.real_im_path, 'train'),
                             os.path.join(opt.fake_im_path, 'train'), with_mask=WITH_MASK)
     else:
         dset = PairedDataset(opt, os.path.join(opt.real_im_path),
-                            os.path.join(opt.fake_im_path), with_mask=WITH_MASK)
+                            os.path.join(opt.fake_im_path), with_mask=WITH_MASK,
+                            mask_size=opt.mask_size or None)
 
     # halves batch size since each batch returns both real and fake ims
     dl = DataLoader(dset, batch_size=opt.batch_size // 2,
@@ -194,12 +200,16 @@ def validate(model, opt):
         WITH_MASK = True
     else:
         WITH_MASK = False
-    if not WITH_MASK:
+    if is_shard_dir(opt.real_im_path):
+        val_dset = ShardPairedDataset(opt, opt.real_im_path, is_val=True,
+                                      mask_size=opt.mask_size or None)
+    elif not WITH_MASK:
         val_dset = PairedDataset(opt, os.path.join(opt.real_im_path, 'val'),
                             os.path.join(opt.fake_im_path, 'val'), with_mask=WITH_MASK)
     else:
         val_dset = PairedDataset(opt, os.path.join(opt.real_im_path),
-                            os.path.join(opt.fake_im_path), with_mask=WITH_MASK)
+                            os.path.join(opt.fake_im_path), with_mask=WITH_MASK,
+                            mask_size=opt.mask_size or None)
 
     val_dl = DataLoader(val_dset, batch_size=opt.batch_size,
                         num_workers=opt.nThreads, pin_memory=False,
@@ -13,20 +13,60 @@ import torchvision.transforms as transforms
 import pdb
 from torch.utils.data import DataLoader
 from data.I2G_dataset import I2GDataset
+from data.samplers import BalancedBatchSampler
+from data.processing.blend_utils.batch_blend import BatchCompositor
+from data.transforms import get_batch_transform
 from utils import pidfile, util
 import utils.logging
 from PIL import Image
 
 
+def get_compositor(opt):
+    if not opt.batched_blend:
+        return None
+    device = 'cuda:%d' % opt.gpu_ids[0] if opt.gpu_ids else None
+    return BatchCompositor(device=device)
+
+
+def get_loader(dset, opt):
+    # samples per batch stay opt.batch_size in every sampling mode
+    sampling = getattr(opt, 'sampling', 'alternate')
+    if sampling == 'balanced':
+        return DataLoader(dset, batch_sampler=BalancedBatchSampler(dset, opt.batch_size),
+                          num_workers=opt.nThreads, pin_memory=False)
+    # pair: every item is a real and a fake sample
+    batch_size = opt.batch_size // 2 if sampling == 'pair' else opt.batch_size
+    return DataLoader(dset, batch_size=batch_size,
+                      num_workers=opt.nThreads, pin_memory=False,
+                      shuffle=True)
+
+
+def get_batch(ims, opt, compositor=None, batch_transform=None):
+    # images, masks and labels of a batch on the device
+    if compositor is not None:
+        images, masks = compositor(ims['background'], ims['foreground'],
+                                   ims['hull'], ims['deformed'], ims['scale'])
+        images, masks = batch_transform(images, masks)
+    else:
+        images = ims['img']
+        masks = ims['mask']
+    labels = ims['label']
+    if images.dim() == 5:
+        # sampling pair: (N, 2, C, H, W) real and fake of each frame
+        images, masks, labels = images.flatten(0, 1), masks.flatten(0, 1), labels.flatten()
+    return (images.to(opt.gpu_ids[0]), masks.to(opt.gpu_ids[0]),
+            labels.to(opt.gpu_ids[0]))
+
+
 def train(opt):
     torch.manual_seed(opt.seed)
 
     dset = I2GDataset(opt, os.path.join(opt.real_im_path, 'train'))
     # halves batch size since each batch returns both real and fake ims
-    dset.get32frames()
-    dl = DataLoader(dset, batch_size=opt.batch_size,
-                    num_workers=opt.nThreads, pin_memory=False,
-                    shuffle=True)
+    dset.get32frames(seed=opt.seed)
+    dl = get_loader(dset, opt)
+    compositor = get_compositor(opt)
+    batch_transform = get_batch_transform(opt)
 
     # setup class labeling
     assert(opt.fake_class_id in [0, 1])
@@ -58,9 +98,8 @@ def train(opt):
         epoch_iter = 0
 
         for i, ims in enumerate(dl):
-            images = ims['img'].to(opt.gpu_ids[0])
-            masks = ims['mask'].to(opt.gpu_ids[0])
-            labels = ims['label'].to(opt.gpu_ids[0])
+            images, masks, labels = get_batch(ims, opt, compositor,
+                                              batch_transform)
 
             batch_im = images
             batch_mask = masks
@@ -156,14 +195,14 @@ def train(opt):
 
         logging.info('End of epoch %d \t Time Taken: %d sec' %
                      (epoch, time.time() - epoch_start_time))
+        if dset.frame_cache is not None:
+            logging.info(str(dset.frame_cache))
         model.update_learning_rate(
             metric=val_losses[model.val_metric + '_val'])
         epoch += 1
 
-        dset.get32frames()
-        dl = DataLoader(dset, batch_size=opt.batch_size,
-                        num_workers=opt.nThreads, pin_memory=False,
-                        shuffle=True)
+        dset.get32frames(seed=opt.seed + epoch)
+        dl = get_loader(dset, opt)
 
     # save model at the end of training
     visualizer.save_final_plots()
@@ -180,19 +219,18 @@ def validate(model, opt):
     assert(not model.net_D.training)
 
     val_dset = I2GDataset(opt, os.path.join(opt.real_im_path, 'val'), is_val=True)
-    val_dset.get32frames()
-    val_dl = DataLoader(val_dset, batch_size=opt.batch_size,
-                        num_workers=opt.nThreads, pin_memory=False,
-                        shuffle=True)
+    val_dset.get32frames(seed=opt.seed)
+    val_dl = get_loader(val_dset, opt)
     val_losses = OrderedDict([(k + '_val', util.AverageMeter())
                               for k in model.loss_names])
     fake_label = opt.fake_class_id
     real_label = 1 - fake_label
+    compositor = get_compositor(opt)
+    batch_transform = get_batch_transform(opt, for_val=True)
     val_start_time = time.time()
     for i, ims in enumerate(val_dl):
-        images = ims['img'].to(opt.gpu_ids[0])
-        masks = ims['mask'].to(opt.gpu_ids[0])
-        labels = ims['label'].to(opt.gpu_ids[0])
+        images, masks, labels = get_batch(ims, opt, compositor,
+                                          batch_transform)
 
         inputs = dict(ims=images,
                       masks=masks,
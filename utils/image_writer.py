@@ -0,0 +1,125 @@
+'''
+Utility for saving images on a pool of encoder processes, so the caller
+only hands over uint8 arrays and keeps producing.
+
+    writer = AsyncImageWriter(num_workers=4, fmt='png', compress_level=1)
+    writer.write('out/0.png', array)
+    writer.close()
+
+The queue is bounded: write() blocks once queue_size images are waiting,
+which keeps memory flat when encoding is slower than generation.
+'''
+
+import multiprocessing as mp
+import time
+from PIL import Image
+
+FORMATS = {
+    'png': '.png',
+    'webp': '.webp',
+}
+
+
+def save_params(fmt, compress_level=6):
+    if fmt == 'png':
+        return dict(format='PNG', compress_level=compress_level)
+    if fmt == 'webp':
+        # lossless webp, method trades encode time for size like compress_level
+        return dict(format='WEBP', lossless=True, quality=100,
+                    method=min(compress_level, 6))
+    raise ValueError('unknown image format %s' % fmt)
+
+
+class ImageWriteError(RuntimeError):
+    ''' images handed to the writer that did not reach the disk '''
+
+
+def save_image(path, array, params):
+    Image.fromarray(array).save(path, **params)
+
+
+def _writer_loop(queue, params, done, errors):
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        path, array = item
+        try:
+            save_image(path, array, params)
+        except Exception as e:
+            print('image writer: %s: %s' % (path, e))
+            with errors.get_lock():
+                errors.value += 1
+        with done.get_lock():
+            done.value += 1
+
+
+class AsyncImageWriter(object):
+    def __init__(self, num_workers=4, queue_size=256, fmt='png',
+                 compress_level=6):
+        self.ext = FORMATS[fmt]
+        self.params = save_params(fmt, compress_level)
+        self.num_workers = num_workers
+        self.submitted = 0
+        self.start_time = time.time()
+        self.done = mp.Value('l', 0)
+        self.errors = mp.Value('l', 0)
+        self.workers = []
+        if num_workers > 0:
+            self.queue = mp.Queue(maxsize=queue_size)
+            for _ in range(num_workers):
+                p = mp.Process(target=_writer_loop, daemon=True,
+                               args=(self.queue, self.params, self.done,
+                                     self.errors))
+                p.start()
+                self.workers.append(p)
+
+    def write(self, path, array):
+        ''' path without extension, array (H, W) or (H, W, 3) uint8 '''
+        path = path + self.ext
+        self.submitted += 1
+        if not self.workers:
+            save_image(path, array, self.params)
+            self.done.value += 1
+            return
+        self.queue.put((path, array))
+
+    def queue_depth(self):
+        if not self.workers:
+            return 0
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # not available on macOS
+            return self.submitted - self.done.value
+
+    def rate(self):
+        ''' images written per second since the writer was created '''
+        return self.done.value / max(time.time() - self.start_time, 1e-6)
+
+    def status(self):
+        return '%.1f img/s written, queue %d' % (self.rate(),
+                                                  self.queue_depth())
+
+    def drain(self):
+        '''block until every submitted image is handled, raises
+        ImageWriteError if any of them failed to save
+        '''
+        while self.done.value < self.submitted:
+            if not all(p.is_alive() for p in self.workers):
+                raise RuntimeError('image writer process exited')
+            time.sleep(0.01)
+        self.check()
+
+    def check(self):
+        if self.errors.value:
+            raise ImageWriteError('image writer: %d of %d images failed to save'
+                                  % (self.errors.value, self.submitted))
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for p in self.workers:
+            p.join()
+        self.workers = []
+        self.check()
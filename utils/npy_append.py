@@ -0,0 +1,45 @@
+'''
+Append rows to an existing .npy file without rewriting it.
+
+The rows are written after the data and then the first axis of the shape
+in the header is grown in place. numpy pads the header of the files it
+writes, so this works until the row count gains many more digits; then
+append_rows returns False and the caller rewrites the file. A crash
+between the two writes leaves bytes after the data that the old header
+does not count, which np.load ignores.
+'''
+
+import struct
+import numpy as np
+
+
+def append_rows(path, rows):
+    ''' append rows (M, ...) matching the array in path, False if the header has no room '''
+    fmt = np.lib.format
+    rows = np.ascontiguousarray(rows)
+    if len(rows) == 0:
+        return True
+    with open(path, 'r+b') as f:
+        version = fmt.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = fmt.read_array_header_1_0(f)
+            size_format = '<H'
+        else:
+            shape, fortran_order, dtype = fmt.read_array_header_2_0(f)
+            size_format = '<I'
+        offset = f.tell()
+        if fortran_order or dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:]:
+            return False
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            fmt.dtype_to_descr(dtype), (shape[0] + len(rows),) + tuple(shape[1:]))
+        header_size = offset - len(fmt.magic(*version)) - struct.calcsize(size_format)
+        if len(header) + 1 > header_size:
+            return False
+        # rows first, the header only counts them once they are written
+        f.seek(offset + shape[0] * rows[:1].nbytes)
+        f.write(rows.tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(fmt.magic(*version) + struct.pack(size_format, header_size) +
+                (header.ljust(header_size - 1) + '\n').encode('latin1'))
+    return True